@@ -4,34 +4,44 @@ It replaces the BaseURL from the origin with BASE_URL, which points
 to the SegmentProxy lambda.
 """
 
-import binascii
 import logging
-import re
-from typing import Dict, List, Optional, Union
-import urllib
-from xml.sax.saxutils import unescape
+import time
 
 import azure.functions as func
 
-import requests
+# pylint: disable=relative-beyond-top-level
+from ..shared_code import metrics
+from ..shared_code.admission import Overloaded, admission_control
+from ..shared_code.cache import ManifestCache
+from ..shared_code.functions import client_request, http_response, warm_up
+from ..shared_code.hedging import hedge_policy
+from ..shared_code.manifest import IncrementalRewriter
+from ..shared_code.pipeline import (AZURE_ROUTES, ManifestPipeline, OriginRequest,
+    overloaded_response)
+from ..shared_code.request import fetch
 
-baseurl_re = re.compile(r'<BaseURL>(?P<url>[^<]+)</BaseURL>')
+# The rewritten manifests are kept for as long as this function
+# instance stays warm, so that polling a live manifest that has not
+# changed only needs a conditional request to origin
+manifest_cache = ManifestCache.from_environment()
 
-# pylint: disable=relative-beyond-top-level
-from ..shared_code import constants
-from ..shared_code.request import decode_url, encode_url, fetch
+# The previous version of each live manifest, so that only the part of
+# the manifest that has changed needs to be rewritten
+manifest_rewriter = IncrementalRewriter.from_environment()
 
-def url_replacer(media_url: List[str], match: re.match) -> str:
-    """
-    Used in the regexp replacer function to wrap BaseURL
-    elements to point to the SegmentProxy lambda.
-    
-    For example <BaseURL>http://example.site/foo</BaseURL> becomes
-    <BaseURL>http://my.lambda/api/media/http%3A%2F%2Fexample.site%2Ffoo/</BaseURL>
-    """
-    origin_url = unescape(match.group('url'))
-    origin_url = encode_url(origin_url)
-    return ''.join(media_url + [origin_url, r'/</BaseURL>'])
+# The alternate BaseURLs of each manifest are shared with the
+# SegmentProxy function, which uses them for hedged requests
+pipeline = ManifestPipeline(AZURE_ROUTES, manifest_cache, manifest_rewriter,
+                            hedging=hedge_policy())
+
+# The origin connection pool is created in the background while the
+# function host finishes starting this function, rather than by the
+# first request
+warm_up()
+
+# Limits the concurrent origin requests of all of the functions in this
+# worker process
+admission = admission_control()
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -39,38 +49,25 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     manifest so that all requsts for media segments will be directed
     to the SegmentProxy lambda.
     """
-    manifest = req.route_params.get('manifest')
-    logging.debug('Processing manifest request %s', manifest)
-    manifest_url = decode_url(manifest)
-    logging.debug('Manifest origin URL: %s', manifest_url)
-    origin = fetch(manifest_url, req.headers, req.params)
-    
+    started = time.perf_counter()
     try:
-        mimetype = origin.headers['Content-Type']
-    except KeyError:
-        mimetype = 'text/dash+xml'
-    body: Optional[Union[bytes, str]] = None
-    if 'text' in mimetype or 'dash+xml' in mimetype:
-        body = origin.text
-    else:
-        body = origin.content
-    headers = {}
-    for key, value in origin.headers.items():
-        if key.lower() not in constants.EXCLUDED_HTTP_HEADERS:
-            headers[key] = value
-    if 'Connection' in headers:
-        del headers['Connection']
-    if origin.status_code == 200 and mimetype == 'application/dash+xml':
-        # replace the original BaseURL with a URL that points to the 
-        # SegmentProxy lambda
-        parts = urllib.parse.urlparse(req.url)
-        media_url = ['<BaseURL>', 'http://', parts.hostname]
-        if parts.port and parts.port != 80:
-            media_url.append(f':{parts.port}')
-        media_url.append('/api/media/')
+        response = proxy_manifest(req)
+    except Overloaded as err:
+        logging.info('%s', err)
+        response = http_response(overloaded_response(err))
+    metrics.record_request('manifest', response.status_code, time.perf_counter() - started)
+    return response
 
-        # modify all BaseURL elements to point to the SegmentProxy lambda,
-        # with a URL that wraps the original origin URL
-        body = baseurl_re.sub(lambda match: url_replacer(media_url, match), body)
-    return func.HttpResponse(body=body, status_code=origin.status_code,
-         mimetype=mimetype, headers=headers)
+def proxy_manifest(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Respond using the cached manifest, or fetch the manifest from origin
+    and rewrite it
+    """
+    request = client_request(req)
+    result = pipeline.begin(request, req.route_params.get('manifest'))
+    if isinstance(result, OriginRequest):
+        with admission.admit(result.url):
+            origin = fetch(result.url, result.headers, result.query)
+            result = pipeline.complete(request, result, origin.status_code, origin.headers,
+                                       origin.content)
+    return http_response(result)
@@ -0,0 +1,27 @@
+"""
+Lambda function that reports the request metrics of this function app
+instance, using the Prometheus text format.
+"""
+import azure.functions as func
+
+# pylint: disable=relative-beyond-top-level
+from ..shared_code import metrics
+from ..shared_code.admission import admission_control
+from ..shared_code.hedging import hedge_policy
+from ..shared_code.request import pool_stats
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    An httpTrigger lambda that returns the metrics recorded by the
+    ManifestProxy and SegmentProxy lambdas that have run in this
+    instance, along with the origin connection pool, admission control
+    and hedged request statistics.
+    """
+    # pylint: disable=unused-argument
+    stats = dict(pool=pool_stats(), admission=admission_control().stats())
+    hedging = hedge_policy()
+    if hedging is not None:
+        stats['hedging'] = hedging.stats()
+    body = metrics.REGISTRY.render(stats)
+    return func.HttpResponse(body=body, status_code=200, mimetype='text/plain',
+        headers={'Content-Type': metrics.CONTENT_TYPE})
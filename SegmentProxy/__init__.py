@@ -4,42 +4,108 @@ It converts it into a "free" box, which is an ISO BMFF defined
 box that has no defined content.
 """
 
-import binascii
 import logging
-from typing import Dict, Optional
-import urllib
+import time
 
 import azure.functions as func
 
 # pylint: disable=relative-beyond-top-level
-from ..shared_code.constants import PIFF_UUID, FREE_UUID
-from ..shared_code.request import fetch, decode_url
+from ..shared_code import metrics
+from ..shared_code.admission import Overloaded, admission_control
+from ..shared_code.constants import SEGMENT_CHUNK_SIZE
+from ..shared_code.functions import client_request, http_response, warm_up
+from ..shared_code.hedging import hedge_policy, hedged_fetch
+from ..shared_code.pipeline import (AZURE_ROUTES, ClientRequest, MediaPipeline, Response,
+    overloaded_response)
+from ..shared_code.ranges import fetch_index, probe_headers
+from ..shared_code.request import fetch
+
+# The box boundaries of the media files that have been requested using
+# Range requests are kept by the pipeline while the function app is
+# running, along with the response times of each origin
+pipeline = MediaPipeline(AZURE_ROUTES, hedging=hedge_policy())
+
+# The origin connection pool is created in the background while the
+# function host finishes starting this function, rather than by the
+# first request
+warm_up()
+
+# Limits the concurrent origin requests of all of the functions in this
+# worker process, and the size of the segments being buffered
+admission = admission_control()
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """
     An httpTrigger lambda that will remove the PIFF box in DASH
     media segments by translating them into "free" boxes.
     """
-    logging.info('Processing media request %s %s',
-        req.route_params.get('origin'), req.route_params.get('path'))
+    started = time.perf_counter()
     logging.debug("url=%s", req.url)
+    request = client_request(req)
+    origin_url = pipeline.origin_url(req.route_params.get('origin'),
+                                     req.route_params.get('path'))
+    try:
+        if 'Range' in req.headers:
+            response = proxy_range(request, origin_url)
+        else:
+            response = proxy_segment(request, origin_url)
+    except Overloaded as err:
+        logging.info('%s', err)
+        response = http_response(overloaded_response(err))
+    metrics.record_bytes('out', len(response.get_body()))
+    metrics.record_request('media', response.status_code, time.perf_counter() - started)
+    return response
 
-    # extract the original BaseURL from the URL that triggered this
-    # function and then append the segment path, to create a URL
-    # to fetch from origin.
-    base_url = decode_url(req.route_params.get('origin'))
-    origin_url = urllib.parse.urljoin(base_url, req.route_params.get('path'))
+def proxy_segment(request: ClientRequest, origin_url: str) -> func.HttpResponse:
+    """
+    Fetch a media segment from origin and patch it
+    """
+    result = pipeline.begin(request, origin_url)
+    if isinstance(result, Response):
+        return http_response(result)
+    with admission.admit(result.url) as ticket:
+        origin = hedged_fetch(pipeline.hedging, result, ticket)
+        try:
+            transform = pipeline.transform(request, result, origin.status_code, origin.headers)
+            ticket.response_started(origin.headers)
+            # replace PIFF_UUID with FREE_UUID while reading the segment, so
+            # that the body does not need to be copied again to patch it
+            body = b''.join(transform.patch(metrics.timed_chunks(
+                origin.iter_content(chunk_size=SEGMENT_CHUNK_SIZE))))
+        finally:
+            origin.close()
+    transform.finish()
+    return func.HttpResponse(body=body, status_code=transform.status_code,
+         mimetype=transform.mimetype, headers=transform.headers)
 
-    origin = fetch(origin_url, req.headers, req.params)
-    try:
-        mimetype = origin.headers['Content-Type']
-    except KeyError:
-        mimetype = 'application/octet-stream'
-    body: Optional[bytes] = origin.content
-    if origin.status_code == 200 and 'text' not in mimetype:
-        # replace PIFF_UUID with FREE_UUID
-        pos = body.find(PIFF_UUID)
-        if pos > 0:
-            body = body[:pos] + FREE_UUID + body[pos+len(PIFF_UUID):]
-    return func.HttpResponse(body=body, status_code=origin.status_code,
-         mimetype=mimetype, headers=origin.headers)
+def proxy_range(request: ClientRequest, origin_url: str) -> func.HttpResponse:
+    """
+    Fetch part of a media file from origin. The range requested from
+    origin is widened to start at a box boundary, so that the PIFF
+    boxes that overlap the requested range can be patched.
+    """
+    rng = pipeline.begin_range(request, origin_url)
+    with admission.admit(origin_url) as ticket:
+        if rng.needs_index:
+            index, probes = fetch_index(origin_url, probe_headers(request.headers),
+                                        request.query)
+            pipeline.index_fetched(rng, index, probes)
+        origin_request = pipeline.range_origin(request, rng)
+        origin = fetch(origin_request.url, origin_request.headers, origin_request.query,
+                       stream=True)
+        try:
+            mimetype = origin.headers.get('Content-Type', 'application/octet-stream')
+            response = pipeline.range_response(rng, origin.status_code, origin.headers)
+            ticket.response_started(origin.headers)
+            body = b''
+            if response.send_body:
+                chunks = metrics.timed_chunks(
+                    origin.iter_content(chunk_size=SEGMENT_CHUNK_SIZE))
+                if response.slicer is not None:
+                    chunks = response.slicer.patch(chunks)
+                body = b''.join(chunks)
+        finally:
+            origin.close()
+    pipeline.range_finished(response)
+    return func.HttpResponse(body=body, status_code=response.status_code,
+         mimetype=mimetype, headers=response.headers)
@@ -0,0 +1,6 @@
+"""
+Benchmarks for the dashpiff services.
+Each benchmark is run from the root of the repository, for example:
+
+    python3 -m benchmarks.piff_patch
+"""
@@ -0,0 +1,85 @@
+"""
+Times wrapping a catalogue of manifest URLs using the create route,
+comparing one pipeline call per URL with one batch request using a JSON
+array and using newline delimited JSON. The time of the per URL calls
+does not include the HTTP round trip of each request, which the batch
+request avoids. Before timing, it checks that every URL of the batch
+can be decoded back to its manifest URL.
+
+    python3 -m benchmarks.batch_create --urls 100000
+"""
+import argparse
+import json
+import time
+from typing import Callable, List, Tuple
+
+# pylint: disable=relative-beyond-top-level
+from shared_code.batch import NDJSON_MIMETYPE
+from shared_code.pipeline import PROXY_ROUTES, ClientRequest, create_url
+from shared_code.request import decode_url
+
+CREATE_URL = 'http://proxy.example:8001/create'
+
+def catalogue(count: int) -> List[str]:
+    """
+    The manifest URLs of a catalogue of assets
+    """
+    return [f'https://cdn{idx % 4}.example/vod/asset{idx}/manifest.mpd?token=t{idx}'
+            for idx in range(count)]
+
+def single_requests(urls: List[str]) -> int:
+    """
+    Wrap each URL using its own request. Returns the number of URLs.
+    """
+    for url in urls:
+        create_url(PROXY_ROUTES, ClientRequest(CREATE_URL, {}, {'url': url}), 'GET')
+    return len(urls)
+
+def batch_request(body: bytes, content_type: str) -> bytes:
+    """
+    Wrap all of the URLs using one request
+    """
+    request = ClientRequest(CREATE_URL, {'Content-Type': content_type}, None)
+    return create_url(PROXY_ROUTES, request, 'POST', body).body
+
+def check(urls: List[str], body: bytes) -> None:
+    """
+    Check that each wrapped URL decodes to its manifest URL
+    """
+    prefix = CREATE_URL.replace(PROXY_ROUTES.create, PROXY_ROUTES.manifest)
+    results = json.loads(batch_request(body, 'application/json'))
+    if len(results) != len(urls):
+        raise AssertionError(f'Expected {len(urls)} results, got {len(results)}')
+    for url, result in zip(urls, results):
+        path, _, query = result['url'][len(prefix):].partition('?')
+        if f'{decode_url(path)}?{query}' != url:
+            raise AssertionError(f'{url} wrapped as {result["url"]}')
+
+def main():
+    """
+    Check the batch results and then time each method
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--urls', type=int, default=100000,
+                        help='Number of manifest URLs in the catalogue [%(default)s]')
+    options = parser.parse_args()
+    urls = catalogue(options.urls)
+    json_body = bytes(json.dumps(urls), 'utf-8')
+    ndjson_body = bytes('\n'.join(urls), 'utf-8')
+    check(urls, json_body)
+    tests: List[Tuple[str, Callable[[], object]]] = [
+        ('one request per URL', lambda: single_requests(urls)),
+        ('batch JSON array', lambda: batch_request(json_body, 'application/json')),
+        ('batch NDJSON', lambda: batch_request(ndjson_body, NDJSON_MIMETYPE)),
+    ]
+    print(f'{len(urls)} manifest URLs')
+    print(f'{"method":<22} {"seconds":>8} {"us/url":>8}')
+    for name, func in tests:
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        print(f'{name:<22} {elapsed:8.2f} {1e6 * elapsed / len(urls):8.1f}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Measures the cold start of each Azure function, without needing the
+Azure Functions host. Each function is loaded in a new Python process,
+in the same way as the host loads it (as a sub-package of "__app__"),
+using a stub of the azure.functions module. It reports the time taken
+to import the function, the number of modules it imported, and the
+latency of its first and second invocations, with the fake origin
+providing the manifests and media segments.
+
+    python3 -m benchmarks.cold_start --runs 5
+
+The --delay argument waits between loading the function and its first
+invocation, to allow the background warm up of the origin connection
+pool (see DASHPIFF_WARM_URLS) to complete, as it would while the
+function host is idle.
+
+The --importtime argument lists the slowest imports of each function,
+using "python -X importtime".
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+from shared_code.request import encode_url
+
+from .proxy_load import start_process
+
+# A minimal stand-in for the azure.functions package, which provides the
+# parts of HttpRequest and HttpResponse that are used by the functions
+AZURE_FUNCTIONS_STUB = '''
+class HttpRequest:
+    def __init__(self, method, url, headers=None, params=None, route_params=None,
+                 body=b''):
+        self.method = method
+        self.url = url
+        self.headers = {key.lower(): value for key, value in (headers or {}).items()}
+        self.params = params or {}
+        self.route_params = route_params or {}
+        self.body = body
+
+    def get_body(self):
+        return self.body
+
+
+class HttpResponse:
+    def __init__(self, body=None, status_code=200, headers=None, mimetype=None,
+                 charset='utf-8'):
+        if isinstance(body, str):
+            body = body.encode(charset)
+        self.body = body or b''
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.mimetype = mimetype
+
+    def get_body(self):
+        return self.body
+'''
+
+# Loads one function in a new process, then invokes it twice
+CHILD_SCRIPT = '''
+import importlib, json, sys, time
+modules = len(sys.modules)
+started = time.perf_counter()
+import azure.functions as func
+stub = time.perf_counter() - started
+started = time.perf_counter()
+module = importlib.import_module('__app__.' + sys.argv[1])
+imported = time.perf_counter() - started - stub
+modules = len(sys.modules) - modules
+request = json.loads(sys.argv[2])
+time.sleep(float(sys.argv[3]))
+timings = []
+for _ in range(2):
+    started = time.perf_counter()
+    response = module.main(func.HttpRequest(**request))
+    timings.append(time.perf_counter() - started)
+    if response.status_code != 200:
+        raise AssertionError(f'{sys.argv[1]} failed: {response.status_code}')
+print(json.dumps(dict(imported=imported, modules=modules, first=timings[0],
+                      second=timings[1])))
+'''
+
+def create_app_dir(root: str) -> str:
+    """
+    Create a directory that contains the stub azure.functions package
+    and an "__app__" link to this function app
+    """
+    functions = os.path.join(root, 'azure', 'functions')
+    os.makedirs(functions)
+    with open(os.path.join(root, 'azure', '__init__.py'), 'wt') as out:
+        out.write('')
+    with open(os.path.join(functions, '__init__.py'), 'wt') as out:
+        out.write(AZURE_FUNCTIONS_STUB)
+    os.symlink(os.getcwd(), os.path.join(root, '__app__'))
+    return root
+
+def function_requests(origin_port: int) -> Dict[str, Dict]:
+    """
+    The request used to invoke each function
+    """
+    origin = f'http://127.0.0.1:{origin_port}'
+    host = 'http://func.example'
+    manifest = encode_url(f'{origin}/dash/manifest.mpd')
+    base_url = encode_url(f'{origin}/dash/')
+    return {
+        'URLCreate': dict(method='GET', url=f'{host}/api/create',
+                          params={'url': f'{origin}/dash/manifest.mpd'}),
+        'ManifestProxy': dict(method='GET', url=f'{host}/api/dash/{manifest}',
+                              headers={'Accept-Encoding': 'gzip'},
+                              route_params={'manifest': manifest}),
+        'SegmentProxy': dict(method='GET', url=f'{host}/api/media/{base_url}/v1/1.m4s',
+                             route_params={'origin': base_url, 'path': 'v1/1.m4s'}),
+        'Metrics': dict(method='GET', url=f'{host}/api/metrics'),
+    }
+
+def run_function(app_dir: str, name: str, request: Dict, importtime: bool,
+                 delay: float = 0, warm_urls: str = '') -> Dict:
+    """
+    Load and invoke one function in a new Python process
+    """
+    env = os.environ.copy()
+    env['PYTHONPATH'] = app_dir
+    env['DASHPIFF_WARM_URLS'] = warm_urls
+    args = [sys.executable]
+    if importtime:
+        args += ['-X', 'importtime']
+    args += ['-c', CHILD_SCRIPT, name, json.dumps(request), str(delay)]
+    result = subprocess.run(args, env=env, cwd=app_dir, capture_output=True, text=True,
+                            check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    if importtime:
+        timings['importtime'] = result.stderr
+    return timings
+
+def slowest_imports(importtime: str, count: int) -> List[str]:
+    """
+    The modules with the largest cumulative import time, from the
+    output of "python -X importtime"
+    """
+    rows = []
+    for line in importtime.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3:
+            continue
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue
+        rows.append((cumulative, fields[2].strip()))
+    rows.sort(reverse=True)
+    return [f'{cumulative / 1000.0:8.1f} ms  {name}' for cumulative, name in rows[:count]]
+
+def main():
+    """
+    Measure the cold start of each function
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Number of cold starts of each function [%(default)s]')
+    parser.add_argument('--functions', default='URLCreate,ManifestProxy,SegmentProxy,Metrics',
+                        help='Comma separated list of functions [%(default)s]')
+    parser.add_argument('--origin-port', type=int, default=8767)
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Seconds between loading and invoking each function [%(default)s]')
+    parser.add_argument('--importtime', action='store_true',
+                        help='List the slowest imports of each function')
+    options = parser.parse_args()
+    origin = start_process(['benchmarks.fake_origin', '--port', str(options.origin_port)],
+                           options.origin_port)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            app_dir = create_app_dir(tmpdir)
+            requests = function_requests(options.origin_port)
+            print(f'{"function":<14} {"import ms":>9} {"modules":>7} {"first ms":>9} '
+                  f'{"second ms":>9}')
+            for name in options.functions.split(','):
+                runs = [run_function(app_dir, name, requests[name], False, options.delay,
+                                     f'http://127.0.0.1:{options.origin_port}/')
+                        for _ in range(options.runs)]
+                print(f'{name:<14} '
+                      f'{1000 * statistics.median([r["imported"] for r in runs]):9.1f} '
+                      f'{statistics.median([r["modules"] for r in runs]):7.0f} '
+                      f'{1000 * statistics.median([r["first"] for r in runs]):9.1f} '
+                      f'{1000 * statistics.median([r["second"] for r in runs]):9.1f}')
+                if options.importtime:
+                    timings = run_function(app_dir, name, requests[name], True)
+                    for line in slowest_imports(timings['importtime'], 10):
+                        print('    ' + line)
+    finally:
+        origin.terminate()
+        origin.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+A local stand-in for a DASH origin server, that serves a synthetic
+manifest and synthetic media segments that contain PIFF boxes. Segments
+requested from a path that contains "/clear/" do not contain any PIFF
+boxes.
+
+    python3 -m benchmarks.fake_origin --port 8765 --latency 0.02
+"""
+import argparse
+import asyncio
+from typing import Dict, Optional
+
+from .synthetic import make_manifest, make_segment
+
+MANIFEST_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" minBufferTime="PT2S"
+     mediaPresentationDuration="PT60S" profiles="urn:mpeg:dash:profile:isoff-live:2011">
+  <Period id="1" start="PT0S">
+    <BaseURL>{base_url}</BaseURL>
+    <AdaptationSet mimeType="video/mp4" segmentAlignment="true">
+      <SegmentTemplate timescale="1000" duration="2000" startNumber="1"
+                       initialization="$RepresentationID$/init.mp4"
+                       media="$RepresentationID$/$Number$.m4s"/>
+      <Representation id="v1" bandwidth="2000000" width="1280" height="720"/>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+class FakeOrigin:
+    """
+    An asyncio HTTP server that responds to every *.mpd request with
+    the same manifest and to every other request with the same segment.
+    If "periods" is set, the manifest is a multi-period manifest from
+    make_manifest(), rather than a single period manifest.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, port: int, latency: float = 0.0, segment_size: int = 1024 * 1024,
+                 fragments: int = 1, piff: bool = True, max_age: int = 60,
+                 periods: int = 0) -> None:
+        self.port = port
+        self.latency = latency
+        self.max_age = max_age
+        self.periods = periods
+        self.segment = make_segment(segment_size, fragments, piff)
+        self.clear_segment = make_segment(segment_size, fragments, piff=False)
+        self.requests = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def manifest(self) -> bytes:
+        """
+        The body of a manifest request
+        """
+        if self.periods:
+            return make_manifest(self.periods)
+        base_url = f'http://127.0.0.1:{self.port}/dash/'
+        return MANIFEST_TEMPLATE.format(base_url=base_url).encode('utf-8')
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        """
+        Handle the keep-alive requests of one connection
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                headers: Dict[str, str] = {}
+                while True:
+                    hdr = await reader.readline()
+                    if hdr in {b'\r\n', b'\n', b''}:
+                        break
+                    name, _, value = str(hdr, 'latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                self.requests += 1
+                path = str(line, 'latin-1').split()[1].split('?')[0]
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if path.endswith('.mpd'):
+                    body = self.manifest()
+                    mimetype = 'application/dash+xml'
+                elif '/clear/' in path:
+                    body = self.clear_segment
+                    mimetype = 'video/mp4'
+                else:
+                    body = self.segment
+                    mimetype = 'video/mp4'
+                writer.write((f'HTTP/1.1 200 OK\r\nContent-Type: {mimetype}\r\n'
+                              f'Content-Length: {len(body)}\r\n'
+                              f'Cache-Control: public, max-age={self.max_age}\r\n'
+                              'ETag: "fake-origin"\r\n\r\n').encode('latin-1'))
+                writer.write(body)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        """
+        Serve requests until cancelled
+        """
+        self.server = await asyncio.start_server(
+            self.handle_connection, '127.0.0.1', self.port, reuse_address=True, backlog=1024)
+        async with self.server:
+            await self.server.serve_forever()
+
+
+def main():
+    """
+    Run the fake origin from the command line
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8765, help='HTTP port [%(default)s]')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Delay (in seconds) before each response [%(default)s]')
+    parser.add_argument('--segment-size', type=int, default=1024 * 1024,
+                        help='Size of each media segment [%(default)s]')
+    parser.add_argument('--fragments', type=int, default=1,
+                        help='Number of moof boxes in each segment [%(default)s]')
+    parser.add_argument('--no-piff', dest='piff', action='store_false',
+                        help='Do not include PIFF boxes in the segments')
+    parser.add_argument('--periods', type=int, default=0,
+                        help='Number of periods in the manifest, 0 for a single ' +
+                        'period manifest [%(default)s]')
+    options = parser.parse_args()
+    origin = FakeOrigin(options.port, options.latency, options.segment_size,
+                        options.fragments, options.piff, periods=options.periods)
+    try:
+        asyncio.run(origin.serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Reproducible benchmark of the pyproxy server. It starts the fake origin
+and the proxy, then drives each scenario at each level of concurrency
+and reports requests per second, p50/p99 latency and time to first
+byte, along with the CPU time and memory used by the proxy processes.
+
+The scenarios are:
+
+    manifest       a multi-period manifest, whose BaseURLs are rewritten
+    segment-piff   media segments that contain PIFF boxes
+    segment-clear  media segments that do not contain any PIFF boxes
+
+The results are written as JSON, so that runs can be compared. If a
+baseline is given, the exit status is non-zero when any result is worse
+than the baseline by more than the tolerance:
+
+    python3 -m benchmarks.harness --output new.json --baseline old.json
+
+CPU and memory use are read from /proc, so are only available on Linux.
+"""
+import argparse
+import asyncio
+import datetime
+import glob
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+from pyproxy.proxy import create_parser
+from shared_code.request import encode_url
+
+from .proxy_load import run_load, start_process
+
+ORIGIN_PORT = 8765
+PROXY_PORT = 8766
+
+SCENARIOS = {
+    'manifest': '/mpd/{origin}',
+    'segment-piff': '/media/{base_url}/v1/1.m4s',
+    'segment-clear': '/media/{clear_base_url}/v1/1.m4s',
+}
+
+# Results where a larger value is better. For all other compared
+# results, a smaller value is better.
+HIGHER_IS_BETTER = {'req_per_sec'}
+
+COMPARED_RESULTS = ['req_per_sec', 'p50_ms', 'p99_ms', 'ttfb_p50_ms', 'ttfb_p99_ms',
+                    'cpu_ms_per_request']
+
+def scenario_url(scenario: str) -> str:
+    """
+    The proxy URL that is requested by a scenario
+    """
+    origin = f'http://127.0.0.1:{ORIGIN_PORT}'
+    path = SCENARIOS[scenario].format(
+        origin=encode_url(f'{origin}/dash/live.mpd'),
+        base_url=encode_url(f'{origin}/dash/'),
+        clear_base_url=encode_url(f'{origin}/clear/'))
+    return f'http://127.0.0.1:{PROXY_PORT}{path}'
+
+def process_tree(pid: int) -> List[int]:
+    """
+    The given process and all of its descendants, e.g. the proxy workers
+    """
+    pids = [pid]
+    for children in glob.glob(f'/proc/{pid}/task/*/children'):
+        try:
+            with open(children, 'rt') as src:
+                for child in src.read().split():
+                    pids += process_tree(int(child))
+        except OSError:
+            pass
+    return pids
+
+def cpu_seconds(pids: List[int]) -> Optional[float]:
+    """
+    Total user and system CPU time used by the given processes
+    """
+    total = 0.0
+    try:
+        ticks = os.sysconf('SC_CLK_TCK')
+        for pid in pids:
+            with open(f'/proc/{pid}/stat', 'rt') as src:
+                # the fields after the command name, which might contain spaces
+                fields = src.read().rpartition(')')[2].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+    return total
+
+def memory_bytes(pids: List[int], field: str) -> Optional[int]:
+    """
+    The sum of a memory field, such as "VmRSS" (resident set size) or
+    "VmHWM" (peak resident set size), of the given processes
+    """
+    total = 0
+    try:
+        for pid in pids:
+            with open(f'/proc/{pid}/status', 'rt') as src:
+                for line in src:
+                    if line.startswith(field + ':'):
+                        total += int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    return total
+
+def run_scenario(proxy: subprocess.Popen, scenario: str, concurrency: int,
+                 options: argparse.Namespace) -> Dict:
+    """
+    Run one scenario and measure the resources used by the proxy
+    """
+    url = scenario_url(scenario)
+    if options.warmup > 0:
+        asyncio.run(run_load(url, concurrency, options.warmup, options.timeout))
+    pids = process_tree(proxy.pid)
+    cpu_before = cpu_seconds(pids)
+    result = asyncio.run(run_load(url, concurrency, options.duration, options.timeout))
+    cpu_after = cpu_seconds(pids)
+    result['scenario'] = scenario
+    result['cpu_seconds'] = None
+    result['cpu_ms_per_request'] = None
+    if cpu_before is not None and cpu_after is not None:
+        result['cpu_seconds'] = cpu_after - cpu_before
+        if result['requests']:
+            result['cpu_ms_per_request'] = 1000.0 * result['cpu_seconds'] / result['requests']
+    result['rss_bytes'] = memory_bytes(pids, 'VmRSS')
+    result['peak_rss_bytes'] = memory_bytes(pids, 'VmHWM')
+    return result
+
+def git_revision() -> Optional[str]:
+    """
+    The commit that is being benchmarked
+    """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_key(result: Dict) -> str:
+    """
+    Used to match a result with the same result in the baseline
+    """
+    return f'{result["server"]} {result["scenario"]} {result["concurrency"]}'
+
+def compare(results: List[Dict], baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Find the results that are worse than the baseline by more than the
+    given fraction
+    """
+    previous = {result_key(result): result for result in baseline['results']}
+    regressions: List[str] = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        for name in COMPARED_RESULTS:
+            new_value = result.get(name)
+            old_value = old.get(name)
+            if not new_value or not old_value:
+                continue
+            if name in HIGHER_IS_BETTER:
+                change = (old_value - new_value) / old_value
+            else:
+                change = (new_value - old_value) / old_value
+            if change > tolerance:
+                regressions.append(f'{result_key(result)}: {name} {old_value:.2f} -> '
+                                   f'{new_value:.2f} ({100.0 * change:.0f}% worse)')
+    return regressions
+
+def main():
+    """
+    Run every scenario against each server mode
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS.keys()),
+                        help='Comma separated list of scenarios [%(default)s]')
+    parser.add_argument('--servers', default='threaded,asyncio',
+                        help='Server modes to test [%(default)s]')
+    parser.add_argument('--concurrency', default='1,10,50',
+                        help='Comma separated list of concurrent clients [%(default)s]')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='Duration (in seconds) of each run [%(default)s]')
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help='Duration (in seconds) of the warm up before each run ' +
+                        '[%(default)s]')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='Client request timeout in seconds [%(default)s]')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Origin response delay in seconds [%(default)s]')
+    parser.add_argument('--segment-size', type=int, default=512 * 1024,
+                        help='Size of each media segment [%(default)s]')
+    parser.add_argument('--fragments', type=int, default=4,
+                        help='Number of moof boxes in each segment [%(default)s]')
+    parser.add_argument('--periods', type=int, default=10,
+                        help='Number of periods in the manifest [%(default)s]')
+    parser.add_argument('--proxy-args',
+                        default='--cache-size 0 --manifest-cache-size 0 --coalesce-timeout 0',
+                        help='Additional pyproxy arguments. The caches are disabled by ' +
+                        'default, so that every request is proxied [%(default)s]')
+    parser.add_argument('--output', help='Filename for the JSON results')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Fraction by which a result can be worse than the baseline ' +
+                        '[%(default)s]')
+    options = parser.parse_args()
+
+    proxy_argv = ['--port', str(PROXY_PORT)] + shlex.split(options.proxy_args)
+    report: Dict = {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'options': vars(options),
+        'proxy_options': vars(create_parser().parse_args(proxy_argv)),
+        'results': [],
+    }
+    origin = start_process(['benchmarks.fake_origin', '--port', str(ORIGIN_PORT),
+                            '--latency', str(options.latency),
+                            '--segment-size', str(options.segment_size),
+                            '--fragments', str(options.fragments),
+                            '--periods', str(options.periods)], ORIGIN_PORT)
+    print(f'{"server":<9} {"scenario":<14} {"clients":>7} {"req/s":>8} {"p50 ms":>8} '
+          f'{"p99 ms":>8} {"ttfb p99":>8} {"cpu ms/r":>8} {"RSS MB":>7} {"errors":>6}')
+    try:
+        for server in options.servers.split(','):
+            proxy = start_process(['pyproxy.proxy', '--server', server] + proxy_argv,
+                                  PROXY_PORT)
+            try:
+                for scenario in options.scenarios.split(','):
+                    for concurrency in [int(c) for c in options.concurrency.split(',')]:
+                        result = run_scenario(proxy, scenario, concurrency, options)
+                        result['server'] = server
+                        report['results'].append(result)
+                        cpu = result['cpu_ms_per_request']
+                        rss = result['rss_bytes']
+                        print(f'{server:<9} {scenario:<14} {concurrency:7d} '
+                              f'{result["req_per_sec"]:8.1f} {result["p50_ms"]:8.1f} '
+                              f'{result["p99_ms"]:8.1f} {result["ttfb_p99_ms"]:8.1f} '
+                              f'{"-" if cpu is None else f"{cpu:.2f}":>8} '
+                              f'{"-" if rss is None else f"{rss / 1048576:.1f}":>7} '
+                              f'{result["errors"]:6d}')
+            finally:
+                proxy.terminate()
+                proxy.wait()
+    finally:
+        origin.terminate()
+        origin.wait()
+    if options.output:
+        with open(options.output, 'wt') as dest:
+            json.dump(report, dest, indent=2)
+    if options.baseline:
+        with open(options.baseline, 'rt') as src:
+            baseline = json.load(src)
+        regressions = compare(report['results'], baseline, options.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
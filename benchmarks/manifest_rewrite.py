@@ -0,0 +1,129 @@
+"""
+Compares the throughput and peak memory use of the byte-level BaseURL
+rewriter with the original implementation, which decoded the manifest,
+used a regular expression substitution and then encoded the result.
+It also measures the cost of each poll of a live manifest that gains
+one new Period, with and without the incremental rewriter.
+
+    python3 -m benchmarks.manifest_rewrite --corpus ~/mpds
+"""
+import argparse
+import os
+import re
+import timeit
+import tracemalloc
+from typing import Callable, List, Tuple
+from xml.sax.saxutils import unescape
+
+# pylint: disable=relative-beyond-top-level
+from shared_code.manifest import IncrementalRewriter, proxy_prefix, rewrite_base_urls
+from shared_code.request import encode_url
+
+from .synthetic import make_manifest
+
+REQUEST_URL = 'http://proxy.example:8001/mpd/manifest.mpd'
+MEDIA_PATH = '/media/'
+
+ORIGINAL_BASEURL_RE = re.compile(r'<BaseURL>(?P<url>[^<]+)</BaseURL>')
+
+def original_rewrite(body: bytes) -> int:
+    """
+    The original implementation, that decodes the manifest and creates
+    a new string before encoding it to send to the client
+    """
+    text = body.decode('utf-8')
+    media_url = ['<BaseURL>'] + proxy_prefix(REQUEST_URL) + [MEDIA_PATH]
+
+    def url_replacer(match: re.Match) -> str:
+        origin_url = encode_url(unescape(match.group('url')))
+        return ''.join(media_url + [origin_url, r'/</BaseURL>'])
+
+    return len(bytes(ORIGINAL_BASEURL_RE.sub(url_replacer, text), 'utf-8'))
+
+def byte_rewrite(body: bytes) -> int:
+    """
+    The byte-level rewriter, that returns parts which are written to
+    the client one after the other
+    """
+    size = 0
+    for part in rewrite_base_urls(body, REQUEST_URL, MEDIA_PATH):
+        size += len(part)
+    return size
+
+def live_polls(previous: bytes, current: bytes, repeat: int) -> Tuple[float, float]:
+    """
+    Time taken (in seconds) to rewrite a live manifest after one new
+    Period has been added, with a full rewrite and with the
+    incremental rewriter
+    """
+    full = timeit.timeit(lambda: byte_rewrite(current), number=repeat) / repeat
+    rewriter = IncrementalRewriter(256 * 1024 * 1024)
+
+    def poll() -> None:
+        # alternate between the two versions, so that every rewrite
+        # has a change to process
+        rewriter.rewrite('live', current, REQUEST_URL, MEDIA_PATH)
+        rewriter.rewrite('live', previous, REQUEST_URL, MEDIA_PATH)
+
+    rewriter.rewrite('live', previous, REQUEST_URL, MEDIA_PATH)
+    incremental = timeit.timeit(poll, number=repeat) / (2 * repeat)
+    return full, incremental
+
+def peak_memory(func: Callable[[bytes], int], body: bytes) -> int:
+    """
+    The peak number of bytes allocated while rewriting the manifest
+    """
+    tracemalloc.start()
+    try:
+        func(body)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def load_corpus(directory: str) -> List[Tuple[str, bytes]]:
+    """
+    Load every *.mpd file in the given directory
+    """
+    corpus: List[Tuple[str, bytes]] = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.mpd'):
+            with open(os.path.join(directory, name), 'rb') as src:
+                corpus.append((name, src.read()))
+    return corpus
+
+def main():
+    """
+    Run the benchmark for each manifest in the corpus
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--corpus', help='Directory of *.mpd files to use')
+    parser.add_argument('--periods', default='10,50,200',
+                        help='Number of periods in each synthetic manifest [%(default)s]')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of times to rewrite each manifest [%(default)s]')
+    options = parser.parse_args()
+    if options.corpus:
+        corpus = load_corpus(options.corpus)
+    else:
+        corpus = [(f'{periods} periods', make_manifest(periods))
+                  for periods in [int(p) for p in options.periods.split(',')]]
+    print(f'{"manifest":<20} {"KB":>7} {"method":<10} {"ms/mpd":>8} {"MB/s":>8} '
+          f'{"peak KB":>8}')
+    for name, body in corpus:
+        size_mb = len(body) / (1024.0 * 1024.0)
+        for method, func in [('regex', original_rewrite), ('bytes', byte_rewrite)]:
+            duration = timeit.timeit(lambda func=func: func(body),
+                                     number=options.repeat) / options.repeat
+            peak = peak_memory(func, body)
+            print(f'{name[:20]:<20} {len(body) // 1024:7d} {method:<10} '
+                  f'{duration * 1000:8.2f} {size_mb / duration:8.1f} {peak // 1024:8d}')
+    print(f'\n{"live periods":<20} {"KB":>7} {"full ms":>8} {"incr ms":>8}')
+    for periods in [int(p) for p in options.periods.split(',')]:
+        previous = make_manifest(periods)
+        current = make_manifest(periods + 1)
+        full, incremental = live_polls(previous, current, options.repeat)
+        print(f'{periods:<20} {len(current) // 1024:7d} {full * 1000:8.2f} '
+              f'{incremental * 1000:8.2f}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Compares the time taken to patch the PIFF boxes using the box index
+with the time taken by the original bytes.find() implementation
+"""
+import argparse
+import timeit
+
+# pylint: disable=relative-beyond-top-level
+from shared_code.constants import PIFF_UUID, FREE_UUID, SEGMENT_CHUNK_SIZE
+from shared_code.isobmff import PiffStreamPatcher, patch_piff_boxes
+
+from .synthetic import make_segment
+
+def find_and_replace(body: bytes) -> int:
+    """
+    The original implementation, that only patches the first match
+    """
+    pos = body.find(PIFF_UUID)
+    if pos > 0:
+        body = body[:pos] + FREE_UUID + body[pos+len(PIFF_UUID):]
+        return 1
+    return 0
+
+def box_index(body: bytes) -> int:
+    """
+    Patch a copy of the segment, as the origin response is immutable
+    """
+    data = bytearray(body)
+    return patch_piff_boxes(data)
+
+def stream_patcher(body: bytes) -> int:
+    """
+    Patch the segment in chunks, as it would arrive from origin
+    """
+    view = memoryview(body)
+    patcher = PiffStreamPatcher()
+    for pos in range(0, len(body), SEGMENT_CHUNK_SIZE):
+        patcher.feed(view[pos:pos + SEGMENT_CHUNK_SIZE])
+    patcher.flush()
+    return patcher.boxes_patched
+
+def main():
+    """
+    Run the benchmark for each segment size
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1,5,10,25,50',
+                        help='Segment sizes in MB [%(default)s]')
+    parser.add_argument('--fragments', type=int, default=4,
+                        help='Number of moof boxes per segment [%(default)s]')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of times to patch each segment [%(default)s]')
+    options = parser.parse_args()
+    print(f'{"size":>6} {"method":<16} {"ms/segment":>10} {"MB/s":>8} {"patched":>8}')
+    for size in [int(s) for s in options.sizes.split(',')]:
+        body = make_segment(size * 1024 * 1024, options.fragments)
+        for name, func in [('bytes.find', find_and_replace), ('box index', box_index),
+                           ('stream patcher', stream_patcher)]:
+            duration = timeit.timeit(lambda func=func: func(body),
+                                     number=options.repeat) / options.repeat
+            print(f'{size:>4}MB {name:<16} {duration * 1000:10.2f} '
+                  f'{size / duration:8.0f} {func(body):>8}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Times the request pipeline that is shared by the pyproxy servers and
+the Azure functions, without any network I/O, using the routes of each
+deployment. For manifests it measures an uncached request (rewrite and
+compression) and a poll that is answered from the manifest cache. For
+media segments it measures patching a segment with the stream
+transform, with and without a segment cache.
+
+    python3 -m benchmarks.pipeline --periods 20 --segment-size 2
+"""
+import argparse
+import gzip
+import timeit
+from typing import Callable, List, Tuple
+
+# pylint: disable=relative-beyond-top-level
+from shared_code.cache import ManifestCache, SegmentCache
+from shared_code.constants import FREE_UUID, PIFF_UUID, SEGMENT_CHUNK_SIZE
+from shared_code.isobmff import find_piff_boxes
+from shared_code.manifest import IncrementalRewriter
+from shared_code.pipeline import (AZURE_ROUTES, PROXY_ROUTES, ClientRequest,
+    ManifestPipeline, MediaPipeline, OriginRequest, Response, Routes)
+from shared_code.request import encode_url
+
+from .synthetic import make_manifest, make_segment
+
+MANIFEST_URL = 'https://origin.example/live/manifest.mpd'
+BASE_URL = 'https://origin.example/live/video/'
+HOSTS = {PROXY_ROUTES: 'http://proxy.example:8001', AZURE_ROUTES: 'http://func.example'}
+
+def manifest_request(pipeline: ManifestPipeline, host: str, body: bytes,
+                     headers: dict) -> Response:
+    """
+    One manifest request, where origin responds with "body" if the
+    pipeline needs to make an origin request
+    """
+    path = encode_url(MANIFEST_URL)
+    request = ClientRequest(f'{host}{pipeline.routes.manifest}{path}',
+                            {'Accept-Encoding': 'gzip'}, None)
+    result = pipeline.begin(request, path)
+    if isinstance(result, OriginRequest):
+        result = pipeline.complete(request, result, 200, headers, body)
+    return result
+
+def media_request(pipeline: MediaPipeline, host: str, segment: bytes) -> int:
+    """
+    One media segment request, where origin responds with "segment".
+    Returns the number of bytes sent to the client.
+    """
+    path = encode_url(BASE_URL) + '/1.m4s'
+    request = ClientRequest(f'{host}{pipeline.routes.media}{path}', {}, None)
+    origin_url = pipeline.origin_url_from_path(path)
+    result = pipeline.begin(request, origin_url)
+    if isinstance(result, Response):
+        return result.content_length
+    headers = {'Content-Type': 'video/mp4', 'Content-Length': str(len(segment)),
+               'Cache-Control': 'max-age=60'}
+    transform = pipeline.transform(request, result, 200, headers)
+    view = memoryview(segment)
+    chunks = [view[pos:pos + SEGMENT_CHUNK_SIZE]
+              for pos in range(0, len(segment), SEGMENT_CHUNK_SIZE)]
+    sent = sum([len(part) for part in transform.patch(chunks)])
+    transform.finish()
+    return sent
+
+def check(routes: Routes, body: bytes, segment: bytes) -> None:
+    """
+    Check that both deployments produce a correct response
+    """
+    pipeline = ManifestPipeline(routes, ManifestCache(64 * 1024 * 1024))
+    response = manifest_request(pipeline, HOSTS[routes], body,
+                                {'Content-Type': 'application/dash+xml'})
+    rewritten = gzip.decompress(response.body)
+    if HOSTS[routes].encode('ascii') + routes.media.encode('ascii') not in rewritten:
+        raise AssertionError(f'BaseURL not rewritten for {routes}')
+    media = MediaPipeline(routes)
+    if media_request(media, HOSTS[routes], segment) != len(segment):
+        raise AssertionError(f'Patched segment has the wrong length for {routes}')
+
+def main():
+    """
+    Time each pipeline stage for both deployments
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--periods', type=int, default=20,
+                        help='Number of Periods in the manifest [%(default)s]')
+    parser.add_argument('--segment-size', type=int, default=2,
+                        help='Size (in MB) of the media segment [%(default)s]')
+    parser.add_argument('--repeat', type=int, default=5)
+    options = parser.parse_args()
+    body = make_manifest(options.periods)
+    segment = make_segment(options.segment_size * 1024 * 1024, fragments=4)
+    boxes = len(find_piff_boxes(segment))
+    patched = bytes(b''.join(MediaPipeline(PROXY_ROUTES).transform(
+        ClientRequest('http://proxy.example/', {}, None),
+        OriginRequest(BASE_URL, {}, None, BASE_URL, None), 200,
+        {'Content-Type': 'video/mp4'}).patch([segment])))
+    # the mdat payloads also contain PIFF_UUID, which must not be changed
+    if (patched.count(FREE_UUID) != boxes or
+            patched.count(PIFF_UUID) != segment.count(PIFF_UUID) - boxes):
+        raise AssertionError('PIFF boxes were not patched')
+    cacheable = {'Content-Type': 'application/dash+xml', 'Cache-Control': 'max-age=60'}
+    uncacheable = {'Content-Type': 'application/dash+xml', 'Cache-Control': 'no-store'}
+    print(f'manifest {len(body)} bytes, segment {len(segment)} bytes')
+    print(f'{"routes":<8} {"test":<22} {"ms/request":>10}')
+    for name, routes in [('pyproxy', PROXY_ROUTES), ('azure', AZURE_ROUTES)]:
+        check(routes, body, segment)
+        host = HOSTS[routes]
+        cached = ManifestPipeline(routes, ManifestCache(64 * 1024 * 1024),
+                                  IncrementalRewriter(64 * 1024 * 1024))
+        manifest_request(cached, host, body, cacheable)
+        segment_cache = MediaPipeline(routes, SegmentCache(64 * 1024 * 1024))
+        media_request(segment_cache, host, segment)
+        tests: List[Tuple[str, Callable[[], object]]] = [
+            ('manifest uncached', lambda r=routes, h=host: manifest_request(
+                ManifestPipeline(r), h, body, uncacheable)),
+            ('manifest cache hit', lambda p=cached, h=host: manifest_request(
+                p, h, body, cacheable)),
+            ('segment patch', lambda r=routes, h=host: media_request(
+                MediaPipeline(r), h, segment)),
+            ('segment cache hit', lambda p=segment_cache, h=host: media_request(
+                p, h, segment)),
+        ]
+        for test, func in tests:
+            elapsed = min(timeit.repeat(func, number=1, repeat=options.repeat))
+            print(f'{name:<8} {test:<22} {1000 * elapsed:10.3f}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Load test that compares the concurrency ceiling of the threaded and
+asyncio modes of the pyproxy server. Each simulated player holds one
+keep-alive connection and repeatedly requests a media segment.
+
+    python3 -m benchmarks.proxy_load --concurrency 50,200,500
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from pyproxy.asyncproxy import AsyncOriginClient, OriginError
+from shared_code.request import encode_url
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    """
+    Wait for a server to start listening on the given port
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start on port {port}')
+
+def start_process(args: List[str], port: int) -> subprocess.Popen:
+    """
+    Start a Python module as a sub-process
+    """
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.getcwd()
+    proc = subprocess.Popen([sys.executable, '-m'] + args, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return proc
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Simple nearest-rank percentile
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+async def run_load(url: str, concurrency: int, duration: float, timeout: float) -> Dict:
+    """
+    Run "concurrency" simulated players for "duration" seconds
+    """
+    client = AsyncOriginClient(pool_size=concurrency, retries=0, connect_timeout=timeout,
+                               read_timeout=timeout)
+    latencies: List[float] = []
+    first_bytes: List[float] = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def player():
+        nonlocal errors
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                response = await client.get(url, {}, None)
+                ttfb = time.monotonic() - start
+                await response.read()
+                response.close()
+                if response.status_code != 200:
+                    errors += 1
+                    continue
+            except (OSError, OriginError, asyncio.IncompleteReadError):
+                errors += 1
+                continue
+            latencies.append(time.monotonic() - start)
+            first_bytes.append(ttfb)
+
+    start = time.monotonic()
+    await asyncio.gather(*[player() for _ in range(concurrency)])
+    elapsed = time.monotonic() - start
+    client.close()
+    total = len(latencies) + errors
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'error_rate': (errors / total) if total else 0.0,
+        'req_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000.0,
+        'p99_ms': percentile(latencies, 99) * 1000.0,
+        'ttfb_p50_ms': percentile(first_bytes, 50) * 1000.0,
+        'ttfb_p99_ms': percentile(first_bytes, 99) * 1000.0,
+    }
+
+def main():
+    """
+    Run the load test against each server mode
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--concurrency', default='10,50,100,250,500',
+                        help='Comma separated list of concurrent players [%(default)s]')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='Duration (in seconds) of each run [%(default)s]')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Origin response delay in seconds [%(default)s]')
+    parser.add_argument('--segment-size', type=int, default=64 * 1024,
+                        help='Size of each media segment [%(default)s]')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='Client request timeout in seconds [%(default)s]')
+    parser.add_argument('--servers', default='threaded,asyncio',
+                        help='Server modes to test [%(default)s]')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of proxy worker processes [%(default)s]')
+    parser.add_argument('--max-error-rate', type=float, default=0.01,
+                        help='Error rate that marks the concurrency ceiling [%(default)s]')
+    options = parser.parse_args()
+    origin_port = 8765
+    proxy_port = 8766
+    origin = start_process(['benchmarks.fake_origin', '--port', str(origin_port),
+                            '--latency', str(options.latency),
+                            '--segment-size', str(options.segment_size)], origin_port)
+    base_url = encode_url(f'http://127.0.0.1:{origin_port}/dash/')
+    url = f'http://127.0.0.1:{proxy_port}/media/{base_url}/v1/1.m4s'
+    try:
+        for server in options.servers.split(','):
+            proxy = start_process(['pyproxy.proxy', '--port', str(proxy_port),
+                                   '--server', server, '--cache-size', '0',
+                                   '--coalesce-timeout', '0',
+                                   '--pool-size', '1000',
+                                   '--workers', str(options.workers)], proxy_port)
+            ceiling = 0
+            try:
+                print(f'{server} server')
+                print(f'{"players":>8} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>9} {"errors":>7}')
+                for concurrency in [int(c) for c in options.concurrency.split(',')]:
+                    result = asyncio.run(run_load(url, concurrency, options.duration,
+                                                  options.timeout))
+                    print(f'{concurrency:8d} {result["req_per_sec"]:8.1f} '
+                          f'{result["p50_ms"]:8.1f} {result["p99_ms"]:9.1f} '
+                          f'{result["errors"]:7d}')
+                    if result['error_rate'] <= options.max_error_rate:
+                        ceiling = concurrency
+            finally:
+                proxy.terminate()
+                proxy.wait()
+            print(f'{server} concurrency ceiling with {options.workers} worker(s): '
+                  f'{ceiling} players\n')
+    finally:
+        origin.terminate()
+        origin.wait()
+
+if __name__ == "__main__":
+    main()
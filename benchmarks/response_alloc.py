@@ -0,0 +1,208 @@
+"""
+Measures the memory allocated (using tracemalloc) to patch a media
+segment and write it to a client socket, comparing the original
+approach of creating a patched copy of the segment with the stream
+patcher, which sends memoryview slices of each origin chunk with the
+patched bytes spliced in.
+
+It then measures a media segment request made to the threaded pyproxy
+server, using a fake origin. This includes the origin HTTP client, the
+segment cache and request coalescing of the default options, and the
+server with the segment cache disabled. The memory that is still
+allocated once the response has been sent is the cached segment.
+
+    python3 -m benchmarks.response_alloc --sizes 1,10,50
+"""
+import argparse
+import itertools
+import os
+import socket
+import subprocess
+import threading
+import tracemalloc
+from typing import Callable, Iterator, List, Tuple
+
+# pylint: disable=relative-beyond-top-level
+from pyproxy.proxy import ProxyDaemon, create_parser
+from pyproxy.zerocopy import send_buffers
+from shared_code.constants import FREE_UUID, PIFF_UUID, SEGMENT_CHUNK_SIZE
+from shared_code.isobmff import PiffStreamPatcher, find_piff_boxes
+from shared_code.request import encode_url
+
+from .proxy_load import start_process, wait_for_port
+from .synthetic import make_segment
+
+ORIGIN_PORT = 8791
+PROXY_PORTS = {'defaults': 8792, 'no cache': 8793}
+PROXY_ARGS = {'defaults': [], 'no cache': ['--cache-size', '0']}
+
+# every request is for a different segment, so that none are cache hits
+_segment_numbers = itertools.count(1)
+
+class SocketDrain:
+    """
+    A socket pair where everything written to the client socket is read
+    and discarded by a background thread, using a pre-allocated buffer
+    """
+
+    def __init__(self) -> None:
+        self.client, self.server = socket.socketpair()
+        self.received = 0
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self) -> None:
+        """
+        Read from the server socket until it is closed
+        """
+        buf = bytearray(SEGMENT_CHUNK_SIZE)
+        while True:
+            size = self.server.recv_into(buf)
+            if not size:
+                break
+            self.received += size
+
+    def close(self) -> None:
+        """
+        Close the socket pair
+        """
+        self.client.close()
+        self.thread.join()
+        self.server.close()
+
+def origin_chunks(body: bytes) -> Iterator[memoryview]:
+    """
+    The segment as it would arrive from origin
+    """
+    view = memoryview(body)
+    for pos in range(0, len(body), SEGMENT_CHUNK_SIZE):
+        yield view[pos:pos + SEGMENT_CHUNK_SIZE]
+
+def concatenate(body: bytes, sock: socket.socket) -> None:
+    """
+    The original implementation, which created a new copy of the
+    segment for each PIFF box
+    """
+    for pos in find_piff_boxes(body):
+        body = body[:pos] + FREE_UUID + body[pos + len(PIFF_UUID):]
+    sock.sendall(body)
+
+def patched_copy(body: bytes, sock: socket.socket) -> None:
+    """
+    Copy the segment into a bytearray and patch it in place
+    """
+    data = bytearray(body)
+    for pos in find_piff_boxes(data):
+        data[pos:pos + len(FREE_UUID)] = FREE_UUID
+    sock.sendall(data)
+
+def stream_views(body: bytes, sock: socket.socket) -> None:
+    """
+    Patch each chunk as it arrives and write the memoryview slices and
+    the patched bytes with one sendmsg() call per chunk
+    """
+    patcher = PiffStreamPatcher()
+    for chunk in origin_chunks(body):
+        send_buffers(sock, patcher.feed_parts(chunk))
+    send_buffers(sock, [patcher.flush()])
+
+def measure(func: Callable[[bytes, socket.socket], None], body: bytes) -> int:
+    """
+    Peak number of bytes allocated while sending one response
+    """
+    drain = SocketDrain()
+    try:
+        tracemalloc.start()
+        func(body, drain.client)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        drain.close()
+    return peak
+
+def start_proxies() -> List[ProxyDaemon]:
+    """
+    Start a threaded proxy server for each set of options
+    """
+    proxies: List[ProxyDaemon] = []
+    for name, port in PROXY_PORTS.items():
+        # the access log is used so that requests are not logged to stderr
+        args = ['--port', str(port), '--access-log', os.devnull] + PROXY_ARGS[name]
+        proxy = ProxyDaemon(create_parser().parse_args(args), None)
+        proxy.start()
+        wait_for_port(port)
+        proxies.append(proxy)
+    return proxies
+
+def proxy_request(port: int) -> int:
+    """
+    Request a media segment from the proxy, reading the response into a
+    pre-allocated buffer. Returns the number of bytes received.
+    """
+    path = (f'/media/{encode_url(f"http://127.0.0.1:{ORIGIN_PORT}/dash/")}/v1/'
+            f'{next(_segment_numbers)}.m4s')
+    buf = bytearray(SEGMENT_CHUNK_SIZE)
+    received = 0
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.sendall(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n'
+                     'Connection: close\r\n\r\n'.encode('ascii'))
+        while True:
+            size = sock.recv_into(buf)
+            if not size:
+                return received
+            received += size
+
+def measure_proxy(port: int) -> Tuple[int, int]:
+    """
+    Peak number of bytes allocated while the proxy handles one request,
+    and the number of bytes that are still allocated afterwards
+    """
+    proxy_request(port)  # warm up the connection pool to origin
+    tracemalloc.start()
+    proxy_request(port)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, current
+
+def main():
+    """
+    Run the benchmark for each segment size
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1,5,10,25,50',
+                        help='Segment sizes in MB [%(default)s]')
+    parser.add_argument('--fragments', type=int, default=4,
+                        help='Number of moof boxes per segment [%(default)s]')
+    options = parser.parse_args()
+    sizes = [int(s) for s in options.sizes.split(',')]
+    methods: List = [('concatenate', concatenate), ('patched copy', patched_copy),
+                     ('stream views', stream_views)]
+    print(f'{"size":>6} {"method":<14} {"peak KB":>10}')
+    for size in sizes:
+        body = make_segment(size * 1024 * 1024, options.fragments)
+        for name, func in methods:
+            peak = measure(func, body)
+            print(f'{size:>4}MB {name:<14} {peak // 1024:10d}')
+    proxies = start_proxies()
+    print(f'\n{"size":>6} {"proxy":<14} {"peak KB":>10} {"cached KB":>10} {"other KB":>10}')
+    try:
+        for size in sizes:
+            origin: subprocess.Popen = start_process(
+                ['benchmarks.fake_origin', '--port', str(ORIGIN_PORT),
+                 '--segment-size', str(size * 1024 * 1024),
+                 '--fragments', str(options.fragments)], ORIGIN_PORT)
+            try:
+                for name, port in PROXY_PORTS.items():
+                    peak, current = measure_proxy(port)
+                    print(f'{size:>4}MB {name:<14} {peak // 1024:10d} {current // 1024:10d} '
+                          f'{(peak - current) // 1024:10d}')
+            finally:
+                origin.terminate()
+                origin.wait()
+    finally:
+        for proxy in proxies:
+            proxy.stop()
+
+if __name__ == "__main__":
+    main()
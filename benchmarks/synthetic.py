@@ -0,0 +1,73 @@
+"""
+Generates synthetic DASH content for use by the benchmarks
+"""
+import os
+import struct
+
+# pylint: disable=relative-beyond-top-level
+from shared_code.constants import PIFF_UUID
+
+def make_box(box_type: bytes, payload: bytes) -> bytes:
+    """
+    Create an ISO BMFF box
+    """
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def make_uuid_box(usertype: bytes, payload: bytes) -> bytes:
+    """
+    Create an ISO BMFF box that uses the "uuid" extended type
+    """
+    return struct.pack('>I4s', 24 + len(payload), b'uuid') + usertype + payload
+
+def make_fragment(mdat_size: int, piff: bool = True, samples: int = 48) -> bytes:
+    """
+    Create one moof + mdat movie fragment. The PIFF_UUID is also placed
+    at the start of the mdat payload, to check that media data is not
+    modified when the PIFF boxes are patched.
+    """
+    traf = [make_box(b'tfhd', b'\0' * 8), make_box(b'trun', b'\0' * (12 + 8 * samples))]
+    if piff:
+        traf.insert(1, make_uuid_box(PIFF_UUID, b'\0' * (8 + 16 * samples)))
+    moof = make_box(b'moof', make_box(b'mfhd', b'\0' * 8) + make_box(b'traf', b''.join(traf)))
+    payload = PIFF_UUID + os.urandom(max(0, mdat_size - len(PIFF_UUID)))
+    return moof + make_box(b'mdat', payload)
+
+def make_segment(size: int, fragments: int = 1, piff: bool = True) -> bytes:
+    """
+    Create a media segment of approximately "size" bytes that contains
+    the given number of movie fragments.
+    """
+    styp = make_box(b'styp', b'msdh\0\0\0\0msdhmsix')
+    mdat_size = max(16, size // fragments)
+    return styp + b''.join([make_fragment(mdat_size, piff) for _ in range(fragments)])
+
+def make_manifest(periods: int, languages: int = 8, representations: int = 6) -> bytes:
+    """
+    Create a multi-period, multi-language manifest, similar to the
+    manifests used for long live events. Each period, adaptation set and
+    representation has its own BaseURL, some of which use attributes
+    or a namespace prefix.
+    """
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:dvb="urn:dvb:dash:extensions:2014-1"'
+             ' type="dynamic" minimumUpdatePeriod="PT2S"'
+             ' profiles="urn:mpeg:dash:profile:isoff-live:2011">',
+             '  <BaseURL serviceLocation="cdn-a" dvb:priority="1">https://cdn-a.example/live/</BaseURL>',
+             '  <BaseURL serviceLocation="cdn-b" dvb:priority="2">https://cdn-b.example/live/</BaseURL>']
+    for period in range(periods):
+        lines.append(f'  <Period id="p{period}" start="PT{period * 600}S">')
+        lines.append(f'    <BaseURL>\n      period-{period}/\n    </BaseURL>')
+        for lang in range(languages):
+            lines.append(f'    <AdaptationSet id="{lang}" lang="l{lang}" mimeType="audio/mp4">')
+            lines.append(f'      <BaseURL>audio/l{lang}/?token=abc&amp;p={period}</BaseURL>')
+            lines.append('      <SegmentTemplate timescale="48000" media="$Number$.m4s"'
+                         ' initialization="init.mp4" startNumber="1" duration="96000"/>')
+            for rep in range(representations):
+                lines.append(f'      <Representation id="a{lang}-{rep}" bandwidth="{64000 * (rep + 1)}"'
+                             ' codecs="mp4a.40.2" audioSamplingRate="48000">')
+                lines.append(f'        <BaseURL>r{rep}/</BaseURL>')
+                lines.append('      </Representation>')
+            lines.append('    </AdaptationSet>')
+        lines.append('  </Period>')
+    lines.append('</MPD>')
+    return '\n'.join(lines).encode('utf-8')
@@ -0,0 +1,99 @@
+"""
+Compares the original encode_url and decode_url functions with the
+current versions, both with and without their LRU memo. Before timing,
+it checks that random URLs, which contain many of the escaped
+characters, survive an encode and decode round trip. The original
+decode_url did not, as it decoded "!!0" as "!:".
+
+    python3 -m benchmarks.url_codec --urls 100000
+"""
+import argparse
+import random
+import timeit
+from typing import Callable, List, Tuple
+
+# pylint: disable=relative-beyond-top-level
+from shared_code.request import ESCAPE_TABLE, decode_url, encode_url
+
+# characters that need escaping are much more likely than in real URLs
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789-._=&%' + '!:/#~?' * 8
+
+def original_encode(url: str) -> str:
+    """
+    The original implementation of encode_url
+    """
+    for in_chr, out_str in ESCAPE_TABLE:
+        url = url.replace(in_chr, out_str)
+    return url
+
+def original_decode(url: str) -> str:
+    """
+    The original implementation of decode_url
+    """
+    for in_chr, out_str in reversed(ESCAPE_TABLE):
+        url = url.replace(out_str, in_chr)
+    return url
+
+def random_url(rand: random.Random) -> str:
+    """
+    Create a random URL
+    """
+    path = ''.join(rand.choice(ALPHABET) for _ in range(rand.randint(0, 60)))
+    return f'https://cdn{rand.randint(0, 9)}.example/{path}'
+
+def round_trip_failures(encode: Callable[[str], str], decode: Callable[[str], str],
+                        urls: List[str]) -> int:
+    """
+    Count the URLs that are changed by encoding and then decoding them
+    """
+    return sum(1 for url in urls if decode(encode(url)) != url)
+
+def session_urls(rand: random.Random, count: int, distinct: int) -> List[str]:
+    """
+    The BaseURLs that would be decoded by the segment requests of a
+    playback session, which re-use a small number of BaseURLs
+    """
+    base_urls = [encode_url(f'https://cdn.example/live/event{idx}/video/r{idx % 6}/')
+                 for idx in range(distinct)]
+    return [rand.choice(base_urls) for _ in range(count)]
+
+def main():
+    """
+    Check the round trip and then time each implementation
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--urls', type=int, default=100000,
+                        help='Number of URLs to encode and decode [%(default)s]')
+    parser.add_argument('--distinct', type=int, default=24,
+                        help='Number of distinct BaseURLs in a session [%(default)s]')
+    parser.add_argument('--seed', type=int, default=1)
+    options = parser.parse_args()
+    rand = random.Random(options.seed)
+
+    urls = [random_url(rand) for _ in range(options.urls)]
+    urls += ['!0', '!!0', '!!!1', 'x!', '!']
+    print(f'round trip failures of {len(urls)} random URLs:')
+    print(f'  original   {round_trip_failures(original_encode, original_decode, urls)}')
+    failures = round_trip_failures(encode_url.__wrapped__, decode_url.__wrapped__, urls)
+    print(f'  current    {failures}')
+    if failures:
+        raise AssertionError('URL codec round trip failed')
+
+    encoded = session_urls(rand, options.urls, options.distinct)
+    decoded = [original_decode(url) for url in encoded]
+    tests: List[Tuple[str, Callable[[str], str], List[str]]] = [
+        ('encode original', original_encode, decoded),
+        ('encode unmemoized', encode_url.__wrapped__, decoded),
+        ('encode memoized', encode_url, decoded),
+        ('decode original', original_decode, encoded),
+        ('decode unmemoized', decode_url.__wrapped__, encoded),
+        ('decode memoized', decode_url, encoded),
+    ]
+    print(f'{"method":<20} {"ns/url":>8}')
+    for name, func, values in tests:
+        elapsed = min(timeit.repeat(lambda f=func, v=values: [f(url) for url in v],
+                                    number=1, repeat=5))
+        print(f'{name:<20} {1e9 * elapsed / len(values):8.0f}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Summarises an access log written by the proxy (see the --access-log
+argument), printing the number of requests, the error rate, the cache
+hit ratio and the latency percentiles of each route and origin host.
+
+    python3 -m pyproxy.access_report access.log
+
+By default the latency is the total time taken to handle each request.
+The --field argument selects a different timing, such as "origin_ttfb".
+"""
+import argparse
+from collections import defaultdict
+import json
+import sys
+from typing import Dict, Iterable, Iterator, List, Sequence, TextIO, Tuple
+
+# pylint: disable=relative-beyond-top-level
+from shared_code.accesslog import CACHE_HIT
+from shared_code.hedging import host_of
+
+PERCENTILES = (50, 90, 95, 99)
+
+GroupKey = Tuple[str, str]
+
+def read_records(files: Iterable[TextIO]) -> Iterator[Dict]:
+    """
+    Generator that parses each line of the access log files, skipping
+    lines that are incomplete
+    """
+    for src in files:
+        for line in src:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """
+    The given percentile of a sorted list of values
+    """
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def group_records(records: Iterable[Dict], field: str) -> Dict[GroupKey, Dict]:
+    """
+    Collect the timings of the requests for each route and origin host
+    """
+    groups: Dict[GroupKey, Dict] = defaultdict(
+        lambda: {'requests': 0, 'errors': 0, 'hits': 0, 'bytes': 0, 'times': []})
+    for record in records:
+        url = record.get('url')
+        key = (record.get('route', 'other'), host_of(url) if url else '-')
+        group = groups[key]
+        group['requests'] += 1
+        if record.get('status', 0) >= 500 or record.get('status', 0) == 0:
+            group['errors'] += 1
+        if record.get('cache') == CACHE_HIT:
+            group['hits'] += 1
+        group['bytes'] += record.get('bytes', 0)
+        if record.get(field) is not None:
+            group['times'].append(record[field])
+    return groups
+
+def report(groups: Dict[GroupKey, Dict], field: str) -> List[str]:
+    """
+    The lines of the summary table
+    """
+    columns = ' '.join([f'{f"p{pct} ms":>9}' for pct in PERCENTILES])
+    lines = [f'{"route":<9} {"origin":<36} {"requests":>8} {"errors":>7} {"hits":>6} '
+             f'{"MB":>9} {columns} {"max ms":>9}   ({field})']
+    for (route, origin), group in sorted(groups.items()):
+        times = sorted(group['times'])
+        if times:
+            values = ' '.join([f'{1000 * percentile(times, pct):9.1f}' for pct in PERCENTILES])
+            slowest = f'{1000 * times[-1]:9.1f}'
+        else:
+            values = ' '.join([f'{"-":>9}' for _ in PERCENTILES])
+            slowest = f'{"-":>9}'
+        hits = 100.0 * group['hits'] / group['requests']
+        lines.append(f'{route:<9} {origin:<36} {group["requests"]:8d} {group["errors"]:7d} '
+                     f'{hits:5.1f}% {group["bytes"] / 1048576.0:9.1f} {values} {slowest}')
+    return lines
+
+def main():
+    """
+    Print the summary of the access log files
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='Access log files, or stdin if not given')
+    parser.add_argument('--field', default='latency', choices=['latency', 'origin_ttfb'],
+                        help='The timing to summarise [%(default)s]')
+    options = parser.parse_args()
+    files: List[TextIO] = [sys.stdin]
+    if options.files:
+        files = [open(name, 'rt', encoding='utf-8') # pylint: disable=consider-using-with
+                 for name in options.files]
+    try:
+        groups = group_records(read_records(files), options.field)
+    finally:
+        if options.files:
+            for src in files:
+                src.close()
+    for line in report(groups, options.field):
+        print(line)
+
+if __name__ == "__main__":
+    main()
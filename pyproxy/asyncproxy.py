@@ -0,0 +1,1045 @@
+"""
+An asyncio implementation of the HTTP proxy. Each client connection is
+handled by a coroutine rather than by its own thread, and origin
+requests are made using a non-blocking HTTP client.
+"""
+import asyncio
+from email.parser import Parser
+import functools
+import html
+from http import HTTPStatus
+from http.client import HTTPMessage
+import json
+import logging
+import socket
+import ssl
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Mapping, Optional, Tuple, Union
+import urllib.parse
+import zlib
+
+from requests.structures import CaseInsensitiveDict
+
+# pylint: disable=relative-beyond-top-level
+from shared_code import metrics
+from shared_code.accesslog import CACHE_BYPASS, CACHE_HIT, AccessLog, AccessRecord
+from shared_code.admission import AdmissionControl, Overloaded, Ticket
+from shared_code.constants import EXCLUDED_HTTP_HEADERS, SEGMENT_CHUNK_SIZE
+from shared_code.hedging import HedgePlan, HedgePolicy, is_good_response
+from shared_code.isobmff import Buffer
+from shared_code.pipeline import (PROXY_ROUTES, ClientRequest, ManifestPipeline, MediaPipeline,
+    MediaTransform, OriginRequest, RangeRequest, Response, create_url, overloaded_response)
+from shared_code.ranges import MAX_INDEX_PROBES, MediaIndex, RangeSlicer, probe_headers
+from shared_code.request import decode_url, origin_request
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+PoolKey = Tuple[str, str, int]
+
+class OriginError(Exception):
+    """
+    Failed to get a response from origin
+    """
+
+
+# The content encodings that AsyncOriginResponse is able to decode
+DECODABLE_ENCODINGS = frozenset({'gzip', 'deflate', 'identity'})
+
+# The Accept-Encoding header of an origin request that did not specify one
+DEFAULT_ACCEPT_ENCODING = 'gzip, deflate'
+
+def origin_accept_encoding(accept_encoding: Optional[str]) -> str:
+    """
+    The Accept-Encoding header to send to origin, which is the one given
+    by the caller without any encodings that cannot be decoded. Media,
+    Range and probe requests use "identity", so that byte offsets refer
+    to the uncompressed file.
+    """
+    if not accept_encoding:
+        return DEFAULT_ACCEPT_ENCODING
+    codings = [coding.strip() for coding in accept_encoding.split(',')
+               if coding.split(';')[0].strip().lower() in DECODABLE_ENCODINGS]
+    return ', '.join(codings) or 'identity'
+
+
+class AsyncOriginResponse:
+    """
+    The response to an origin request. The body is read from the origin
+    connection as it is consumed, and the connection is returned to the
+    pool once all of the body has been read.
+    """
+
+    def __init__(self, client: "AsyncOriginClient", key: PoolKey, conn: Connection,
+                 status_code: int, reason: str, headers: CaseInsensitiveDict) -> None:
+        self.client = client
+        self.key = key
+        self.reader, self.writer = conn
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.keep_alive = 'close' not in headers.get('Connection', '').lower()
+        self.body_done = status_code in {204, 304} or 100 <= status_code < 200
+        self.closed = False
+        # the time (in seconds) from sending the request until the
+        # response headers were received
+        self.ttfb = 0.0
+        self.decoder = None
+        if headers.get('Content-Encoding', '').lower() in {'gzip', 'deflate'}:
+            self.decoder = zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+    async def _read(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self.client.read_timeout)
+        except asyncio.TimeoutError as err:
+            raise OriginError(f'Timeout reading from {self.key[1]}') from err
+
+    async def iter_raw(self, chunk_size: int) -> AsyncIterator[bytes]:
+        """
+        Generator that yields the body as it was sent by origin
+        """
+        if self.body_done:
+            return
+        reader = self.reader
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            while True:
+                line = await self._read(reader.readline())
+                try:
+                    remaining = int(line.split(b';')[0].strip(), 16)
+                except ValueError as err:
+                    raise OriginError(f'Invalid chunk header {line!r}') from err
+                if remaining == 0:
+                    # discard any trailers
+                    while (await self._read(reader.readline())) not in {b'\r\n', b'\n', b''}:
+                        pass
+                    break
+                while remaining:
+                    data = await self._read(reader.read(min(remaining, chunk_size)))
+                    if not data:
+                        raise OriginError('Origin connection closed part way through a chunk')
+                    remaining -= len(data)
+                    yield data
+                await self._read(reader.readline())
+        elif 'Content-Length' in self.headers:
+            remaining = int(self.headers['Content-Length'])
+            while remaining:
+                data = await self._read(reader.read(min(remaining, chunk_size)))
+                if not data:
+                    raise OriginError('Origin connection closed part way through the body')
+                remaining -= len(data)
+                yield data
+        else:
+            self.keep_alive = False
+            while True:
+                data = await self._read(reader.read(chunk_size))
+                if not data:
+                    break
+                yield data
+        self.body_done = True
+
+    async def iter_content(self, chunk_size: int = SEGMENT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """
+        Generator that yields the decoded body as it is received from origin
+        """
+        async for data in metrics.async_timed_chunks(self.iter_raw(chunk_size)):
+            if self.decoder is not None:
+                data = self.decoder.decompress(data)
+            if data:
+                yield data
+        if self.decoder is not None:
+            data = self.decoder.flush()
+            if data:
+                yield data
+
+    async def read(self) -> bytes:
+        """
+        Read the complete body
+        """
+        parts: List[bytes] = []
+        async for data in self.iter_content():
+            parts.append(data)
+        return b''.join(parts)
+
+    async def text(self) -> str:
+        """
+        Read the complete body, as a string
+        """
+        charset = 'utf-8'
+        for param in self.headers.get('Content-Type', '').split(';')[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'charset' and value:
+                charset = value.strip('"')
+        body = await self.read()
+        try:
+            return str(body, charset, errors='replace')
+        except LookupError:
+            return str(body, 'utf-8', errors='replace')
+
+    def close(self) -> None:
+        """
+        Release the origin connection
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.body_done and self.keep_alive:
+            self.client.release(self.key, (self.reader, self.writer))
+        else:
+            self.writer.close()
+
+
+class AsyncOriginClient:
+    """
+    A non-blocking HTTP client, that keeps a pool of keep-alive
+    connections to each origin server
+    """
+
+    def __init__(self, pool_size: int = 10, retries: int = 2,
+                 connect_timeout: float = 3.05, read_timeout: float = 30.0) -> None:
+        self.pool_size = pool_size
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle: Dict[PoolKey, List[Connection]] = {}
+        self.ssl_context: Optional[ssl.SSLContext] = None
+        self.host_stats: Dict[str, Dict[str, int]] = {}
+
+    async def get(self, url: str, headers: Mapping, params: Optional[Dict]) -> AsyncOriginResponse:
+        """
+        Make an HTTP GET request to origin. The HTTP headers and query
+        parameters from the client request are copied into the origin
+        request.
+        """
+        origin_url, origin_headers = origin_request(url, headers, params)
+        logging.debug("Origin request %s", origin_url)
+        parts = urllib.parse.urlsplit(origin_url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key: PoolKey = (parts.scheme, parts.hostname, port)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        lines = [f'GET {target} HTTP/1.1', f'Host: {parts.netloc.rpartition("@")[2]}']
+        accept_encoding: Optional[str] = None
+        for name, value in origin_headers.items():
+            if name.lower() == 'accept-encoding':
+                accept_encoding = value
+            elif name.lower() not in {'host', 'content-length'}:
+                lines.append(f'{name}: {value}')
+        lines += [f'Accept-Encoding: {origin_accept_encoding(accept_encoding)}',
+                  'Connection: keep-alive', '', '']
+        request = '\r\n'.join(lines).encode('latin-1')
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            conn: Optional[Connection] = None
+            reused = False
+            try:
+                conn, reused = await self._connect(key)
+                response = await self._send(key, conn, request)
+                response.ttfb = time.perf_counter() - started
+                metrics.record_stage('origin_ttfb', response.ttfb)
+                return response
+            except (OSError, asyncio.IncompleteReadError, OriginError) as err:
+                if conn is not None:
+                    conn[1].close()
+                # a keep-alive connection might have been closed by origin
+                # before this request was sent, which does not count as a retry
+                if not reused:
+                    attempt += 1
+                if attempt > self.retries:
+                    raise OriginError(f'Request to {origin_url} failed: {err}') from err
+                logging.debug('Retrying request to %s: %s', origin_url, err)
+
+    async def _connect(self, key: PoolKey) -> Tuple[Connection, bool]:
+        scheme, host, port = key
+        stats = self.host_stats.setdefault(f'{scheme}://{host}:{port}', {
+            'requests': 0, 'connections': 0, 'hits': 0})
+        stats['requests'] += 1
+        idle = self.idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                stats['hits'] += 1
+                return (reader, writer), True
+            writer.close()
+        ssl_context: Optional[ssl.SSLContext] = None
+        if scheme == 'https':
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            ssl_context = self.ssl_context
+        started = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=ssl_context), self.connect_timeout)
+        except asyncio.TimeoutError as err:
+            raise OriginError(f'Timeout connecting to {host}:{port}') from err
+        metrics.record_stage('origin_connect', time.perf_counter() - started)
+        stats['connections'] += 1
+        return conn, False
+
+    async def _send(self, key: PoolKey, conn: Connection,
+                    request: bytes) -> AsyncOriginResponse:
+        reader, writer = conn
+        writer.write(request)
+        await writer.drain()
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+        except asyncio.TimeoutError as err:
+            raise OriginError(f'Timeout waiting for response from {key[1]}') from err
+        if not line:
+            raise OriginError('Connection closed by origin')
+        try:
+            _, status, reason = str(line, 'latin-1').rstrip('\r\n').split(' ', 2)
+        except ValueError:
+            _, status = str(line, 'latin-1').split()
+            reason = ''
+        headers = CaseInsensitiveDict()
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+            if line in {b'\r\n', b'\n', b''}:
+                break
+            name, _, value = str(line, 'latin-1').partition(':')
+            name = name.strip()
+            value = value.strip()
+            if name in headers:
+                headers[name] = f'{headers[name]}, {value}'
+            else:
+                headers[name] = value
+        return AsyncOriginResponse(self, key, conn, int(status), reason, headers)
+
+    def release(self, key: PoolKey, conn: Connection) -> None:
+        """
+        Return a connection to the pool, once a response has been read
+        """
+        idle = self.idle.setdefault(key, [])
+        if len(idle) < self.pool_size:
+            idle.append(conn)
+        else:
+            conn[1].close()
+
+    def close(self) -> None:
+        """
+        Close all idle connections
+        """
+        for idle in self.idle.values():
+            for _, writer in idle:
+                writer.close()
+        self.idle = {}
+
+    def stats(self) -> Dict:
+        """
+        Connection re-use statistics for each origin host
+        """
+        total_requests = sum(host['requests'] for host in self.host_stats.values())
+        total_hits = sum(host['hits'] for host in self.host_stats.values())
+        return {
+            'requests': total_requests,
+            'connections': sum(host['connections'] for host in self.host_stats.values()),
+            'hits': total_hits,
+            'reuse_ratio': (total_hits / total_requests) if total_requests else 0.0,
+            'hosts': dict(self.host_stats),
+        }
+
+
+class AsyncRequest:
+    """
+    A request from a client of the asyncio proxy
+    """
+
+    def __init__(self, method: str, target: str, version: str, headers: HTTPMessage,
+                 reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self.path = target
+        self.query: Optional[Dict] = None
+        if '?' in target:
+            self.path, qry = target.split('?', 1)
+            self.query = {key:value for key, value in urllib.parse.parse_qsl(qry)}
+        connection = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = 'close' not in connection
+        else:
+            self.keep_alive = 'keep-alive' in connection
+        self.body_read = False
+        self.response_started = False
+        self.status_code = 0
+        self.access = AccessRecord(method)
+
+    def request_url(self) -> str:
+        """
+        Get the absolute URL used for this request
+        """
+        host = self.headers.get('Host')
+        if host is None:
+            addr = self.writer.get_extra_info('sockname')
+            host = f'{addr[0]}:{addr[1]}'
+        return ''.join(['http://', host, self.target])
+
+    async def iter_body(self, chunk_size: int = SEGMENT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """
+        Generator that yields the request body as it is received
+        """
+        if self.body_read:
+            return
+        self.body_read = True
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            while True:
+                line = await self.reader.readline()
+                remaining = int(line.split(b';')[0].strip() or b'0', 16)
+                if remaining == 0:
+                    while (await self.reader.readline()) not in {b'\r\n', b'\n', b''}:
+                        pass
+                    return
+                while remaining:
+                    data = await self.reader.read(min(remaining, chunk_size))
+                    if not data:
+                        raise ConnectionError('Client closed connection')
+                    remaining -= len(data)
+                    yield data
+                await self.reader.readline()
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            data = await self.reader.read(min(remaining, chunk_size))
+            if not data:
+                raise ConnectionError('Client closed connection')
+            remaining -= len(data)
+            yield data
+
+    async def read_body(self) -> bytes:
+        """
+        Read the complete request body
+        """
+        parts: List[bytes] = []
+        async for data in self.iter_body():
+            parts.append(data)
+        return b''.join(parts)
+
+
+class AsyncProxyServer:
+    """
+    An HTTP proxy that uses asyncio to handle many concurrent client
+    connections from one thread. It provides the same routes as the
+    threaded ProxyAddAuthentication handler.
+    """
+    excluded_headers = EXCLUDED_HTTP_HEADERS
+
+    routes = PROXY_ROUTES
+    STATS_PATH = '/stats'
+    METRICS_PATH = '/metrics'
+
+    KEEP_ALIVE_TIMEOUT = 60.0
+
+    def __init__(self, options, manifest_pipeline: Optional[ManifestPipeline] = None,
+                 media_pipeline: Optional[MediaPipeline] = None,
+                 admission: Optional[AdmissionControl] = None,
+                 access_log: Optional[AccessLog] = None) -> None:
+        self.options = options
+        if manifest_pipeline is None:
+            manifest_pipeline = ManifestPipeline(self.routes)
+        if media_pipeline is None:
+            media_pipeline = MediaPipeline(self.routes)
+        if admission is None:
+            admission = AdmissionControl(max_active=0)
+        self.manifest_pipeline = manifest_pipeline
+        self.media_pipeline = media_pipeline
+        self.admission = admission
+        self.access_log = access_log
+        self.client = AsyncOriginClient(
+            pool_size=getattr(options, 'pool_size', 10), retries=getattr(options, 'retries', 2),
+            connect_timeout=getattr(options, 'connect_timeout', 3.05),
+            read_timeout=getattr(options, 'read_timeout', 30.0))
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.stopping: Optional[asyncio.Event] = None
+
+    def serve_forever(self, sock: Optional[socket.socket] = None) -> None:
+        """
+        Handle HTTP requests until shutdown() is called
+        """
+        asyncio.run(self._serve(sock))
+
+    def shutdown(self) -> None:
+        """
+        Stop serving requests. Can be called from any thread.
+        """
+        if self.loop is not None and self.stopping is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def _serve(self, sock: Optional[socket.socket]) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        if sock is not None:
+            self.server = await asyncio.start_server(self.handle_connection, sock=sock)
+        else:
+            self.server = await asyncio.start_server(
+                self.handle_connection, self.options.bind, self.options.port,
+                reuse_address=True, backlog=1024)
+        async with self.server:
+            await self.stopping.wait()
+        self.client.close()
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        """
+        Handles all of the requests on one client connection
+        """
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                if line in {b'\r\n', b'\n'}:
+                    continue
+                request = await self.parse_request(line, reader, writer)
+                if request is None:
+                    break
+                await self.handle_request(request)
+                if not request.keep_alive:
+                    break
+                if not request.body_read:
+                    async for _ in request.iter_body():
+                        pass
+        except asyncio.CancelledError:
+            # the server is shutting down. The cancellation is not passed on,
+            # as asyncio logs a traceback if a connection handler is cancelled
+            logging.debug('Closing client connection during shutdown')
+        except (ConnectionError, asyncio.IncompleteReadError) as err:
+            logging.debug('Client connection closed: %s', err)
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Error handling request')
+        finally:
+            writer.close()
+
+    async def parse_request(self, line: bytes, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> Optional[AsyncRequest]:
+        """
+        Parse the request line and HTTP headers of a request
+        """
+        try:
+            method, target, version = str(line, 'latin-1').split()
+        except ValueError:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n')
+            return None
+        header_lines: List[str] = []
+        while True:
+            line = await reader.readline()
+            if line in {b'\r\n', b'\n', b''}:
+                break
+            header_lines.append(str(line, 'latin-1'))
+        headers = Parser(_class=HTTPMessage).parsestr(''.join(header_lines))
+        return AsyncRequest(method, target, version, headers, reader, writer)
+
+    async def handle_request(self, request: AsyncRequest) -> None:
+        """
+        Forwards request to origin after unwrapping the original URL from
+        the path, or responds directly
+        """
+        path = request.path
+        route = 'other'
+        started = time.perf_counter()
+        try:
+            if request.method == 'POST':
+                route = 'create'
+                await self.create_url(request, None)
+            elif request.method != 'GET':
+                await self.send_error(request, 405, f'Method not supported: {request.method}')
+            elif path.startswith(self.routes.create):
+                route = 'create'
+                await self.create_url(request, request.query)
+            elif path.startswith(self.routes.manifest):
+                route = 'manifest'
+                await self.serve_manifest(request, path[len(self.routes.manifest):])
+            elif path.startswith(self.routes.media):
+                route = 'media'
+                await self.serve_media(request, path[len(self.routes.media):])
+            elif path == self.STATS_PATH:
+                route = 'stats'
+                await self.serve_stats(request)
+            elif path == self.METRICS_PATH:
+                route = 'metrics'
+                await self.serve_metrics(request)
+            else:
+                await self.send_error(request, 404, f'File not found: {path}')
+        except Overloaded as err:
+            logging.info('%s', err)
+            await self.send_pipeline_response(request, overloaded_response(err))
+        except OriginError as err:
+            logging.warning('%s', err)
+            request.keep_alive = False
+            if request.response_started:
+                # the only way to report the error is to close the connection
+                return
+            await self.send_error(request, 502, str(err))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # the client has gone, so there is no way to respond
+            raise
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Error handling request for %s', request.path)
+            request.keep_alive = False
+            if not request.response_started:
+                await self.send_error(request, 500, 'Internal server error')
+        finally:
+            metrics.record_request(route, request.status_code, time.perf_counter() - started)
+            request.access.finished(route, request.status_code)
+            if self.access_log is not None:
+                self.access_log.log(request.access)
+
+    async def create_url(self, request: AsyncRequest, query: Optional[Dict]) -> None:
+        """
+        Encodes a manifest URL so that it points to the manifest
+        path of this proxy.
+        """
+        body: Optional[bytes] = None
+        if request.method == 'POST':
+            body = await request.read_body()
+        await self.send_pipeline_response(
+            request, create_url(self.routes, self.client_request(request, query),
+                                request.method, body))
+
+    @staticmethod
+    def client_request(request: AsyncRequest, query: Optional[Dict]) -> ClientRequest:
+        """
+        The parts of a request that are used by the request pipelines
+        """
+        return ClientRequest(request.request_url(), request.headers, query)
+
+    async def serve_manifest(self, request: AsyncRequest, path: str) -> None:
+        """
+        Fetches manifest from origin and wraps the BaseURL fields in the
+        manifest so that all requsts for media segments will be directed
+        to the media path of this proxy.
+        """
+        client_request = self.client_request(request, request.query)
+        request.access.url = decode_url(path)
+        result = self.manifest_pipeline.begin(client_request, path)
+        if isinstance(result, Response):
+            request.access.cache = CACHE_HIT
+        else:
+            with await self.admission.admit_async(result.url):
+                origin = await self.client.get(result.url, result.headers, result.query)
+                request.access.origin_response(result, origin.status_code, origin.ttfb)
+                try:
+                    body = b''
+                    if origin.status_code != 304:
+                        body = await origin.read()
+                finally:
+                    origin.close()
+            result = self.manifest_pipeline.complete(client_request, result, origin.status_code,
+                                                     origin.headers, body)
+        await self.send_pipeline_response(request, result)
+
+    async def serve_media(self, request: AsyncRequest, path: str) -> None:
+        """
+        Fetch DASH media segment from origin and remove the PIFF box
+        by translating them into "free" boxes.
+        """
+        pipeline = self.media_pipeline
+        client_request = self.client_request(request, request.query)
+        origin_url = pipeline.origin_url_from_path(path)
+        request.access.url = origin_url
+        if 'Range' in request.headers:
+            await self.serve_range(request, client_request, origin_url)
+            return
+        result = pipeline.begin(client_request, origin_url)
+        if isinstance(result, Response):
+            request.access.cache = CACHE_HIT
+            await self.send_pipeline_response(request, result)
+            return
+        with await self.admission.admit_async(result.url) as ticket:
+            origin = await self.hedged_get(result, ticket)
+            request.access.origin_response(result, origin.status_code, origin.ttfb)
+            try:
+                cached = pipeline.revalidated(client_request, result, origin.status_code,
+                                              origin.headers)
+                if cached is not None:
+                    await self.send_pipeline_response(request, cached)
+                    return
+                transform = pipeline.transform(client_request, result, origin.status_code,
+                                               origin.headers)
+                ticket.response_started(origin.headers)
+                chunks = self.transform_chunks(origin.iter_content(), transform)
+                if transform.not_modified:
+                    if transform.writer is not None:
+                        async for _ in chunks:
+                            pass
+                    await self.respond_stream(request, 304, [], transform.mimetype,
+                                              transform.headers)
+                else:
+                    await self.respond_stream(request, origin.status_code, chunks,
+                                              transform.mimetype, transform.headers,
+                                              content_length=transform.content_length)
+            finally:
+                origin.close()
+            transform.finish()
+            request.access.piff_boxes = transform.boxes_patched
+
+    async def hedged_get(self, origin: OriginRequest, ticket: Ticket) -> AsyncOriginResponse:
+        """
+        Make the origin request of a media segment. If the segment is
+        available from more than one origin, the request is hedged using
+        the alternate origins.
+        """
+        policy = self.media_pipeline.hedging
+        if policy is None:
+            return await self.client.get(origin.url, origin.headers, origin.query)
+        plan = policy.plan(origin.url)
+        if len(plan.urls) == 1:
+            return await self.timed_get(policy, origin.url, origin)
+        return await self.race(policy, origin, plan, ticket)
+
+    async def timed_get(self, policy: HedgePolicy, url: str,
+                        origin: OriginRequest) -> AsyncOriginResponse:
+        """
+        Make an origin request, recording its response time
+        """
+        started = time.perf_counter()
+        try:
+            response = await self.client.get(url, origin.headers, origin.query)
+        except OriginError:
+            policy.record(url, time.perf_counter() - started, False)
+            raise
+        policy.record(url, time.perf_counter() - started, is_good_response(response.status_code))
+        return response
+
+    # pylint: disable=too-many-locals,too-many-branches
+    async def race(self, policy: HedgePolicy, origin: OriginRequest, plan: HedgePlan,
+                   ticket: Ticket) -> AsyncOriginResponse:
+        """
+        Make the origin requests of a HedgePlan, returning the first
+        good response. If they all fail, the last error response is
+        returned, or the last error is raised. Each request to an
+        alternate origin needs its own admission ticket, and is skipped
+        if its origin is too busy to admit it without waiting.
+        """
+        loop = asyncio.get_running_loop()
+        pending: Dict[asyncio.Future, int] = {}
+        tickets: Dict[int, Ticket] = {}
+        started = attempts = 0
+        winner: Optional[AsyncOriginResponse] = None
+        failed: Optional[Tuple[int, AsyncOriginResponse]] = None
+        error: Optional[BaseException] = None
+        deadline = 0.0
+        try:
+            while True:
+                while started < len(plan.urls) and (not pending or loop.time() >= deadline):
+                    index = started
+                    started += 1
+                    url = plan.urls[index]
+                    if url != origin.url:
+                        # the ticket of the request only admits the player's origin
+                        hedge_ticket = self.admission.try_admit(url)
+                        if hedge_ticket is None:
+                            logging.debug('Skipped hedged request %s as its origin is busy',
+                                          url)
+                            continue
+                        tickets[index] = hedge_ticket
+                    if index:
+                        logging.debug('Hedged request %s', url)
+                    task = asyncio.ensure_future(self.timed_get(policy, url, origin))
+                    pending[task] = index
+                    attempts += 1
+                    if started < len(plan.urls):
+                        deadline = loop.time() + plan.delays[index]
+                    break
+                if not pending:
+                    break
+                timeout: Optional[float] = None
+                if started < len(plan.urls):
+                    timeout = max(0.0, deadline - loop.time())
+                done, _ = await asyncio.wait(list(pending), timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index = pending.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        self.release_hedge(tickets.pop(index, None))
+                    elif winner is None and is_good_response(task.result().status_code):
+                        winner = task.result()
+                        policy.finished(attempts, index)
+                        self.keep_hedge(ticket, tickets.pop(index, None))
+                    else:
+                        if failed is not None:
+                            failed[1].close()
+                            self.release_hedge(tickets.pop(failed[0], None))
+                        failed = (index, task.result())
+                if winner is not None:
+                    if failed is not None:
+                        failed[1].close()
+                        self.release_hedge(tickets.pop(failed[0], None))
+                    return winner
+                # no need to wait before trying the next origin
+                deadline = 0.0
+            policy.finished(attempts, -1)
+            if failed is not None:
+                self.keep_hedge(ticket, tickets.pop(failed[0], None))
+                return failed[1]
+            raise error
+        finally:
+            for task, index in pending.items():
+                task.add_done_callback(functools.partial(
+                    self.discard_origin_response, tickets.pop(index, None)))
+
+    @staticmethod
+    def keep_hedge(ticket: Ticket, hedge_ticket: Optional[Ticket]) -> None:
+        """
+        Keep the ticket of the hedged request whose response is used
+        until the ticket of the client's request is released
+        """
+        if hedge_ticket is not None:
+            ticket.attach(hedge_ticket)
+
+    @staticmethod
+    def release_hedge(hedge_ticket: Optional[Ticket]) -> None:
+        """
+        Release the ticket of a hedged request whose response is not used
+        """
+        if hedge_ticket is not None:
+            hedge_ticket.release()
+
+    @staticmethod
+    def discard_origin_response(hedge_ticket: Optional[Ticket], task: asyncio.Future) -> None:
+        """
+        Close the response of a hedged origin request that was not used
+        """
+        if hedge_ticket is not None:
+            hedge_ticket.release()
+        if task.cancelled() or task.exception() is not None:
+            return
+        task.result().close()
+
+    async def serve_range(self, request: AsyncRequest, client_request: ClientRequest,
+                          origin_url: str) -> None:
+        """
+        Fetch part of a media file from origin. The range requested from
+        origin is widened to start at a box boundary, so that the PIFF
+        boxes that overlap the requested range can be patched.
+        """
+        pipeline = self.media_pipeline
+        rng = pipeline.begin_range(client_request, origin_url)
+        request.access.cache = CACHE_BYPASS
+        with await self.admission.admit_async(origin_url) as ticket:
+            if rng.needs_index:
+                await self.fetch_index(request, rng)
+            origin_request = pipeline.range_origin(client_request, rng)
+            origin = await self.client.get(origin_request.url, origin_request.headers,
+                                           origin_request.query)
+            request.access.origin_response(origin_request, origin.status_code, origin.ttfb)
+            try:
+                mimetype = origin.headers.get('Content-Type', 'application/octet-stream')
+                response = pipeline.range_response(rng, origin.status_code, origin.headers)
+                ticket.response_started(origin.headers)
+                chunks: Union[List[Buffer], AsyncIterator[Buffer]] = []
+                if response.send_body:
+                    chunks = self.slice_chunks(origin.iter_content(), response.slicer)
+                await self.respond_stream(request, response.status_code, chunks, mimetype,
+                                          response.headers, content_length=response.content_length)
+            finally:
+                origin.close()
+            request.access.piff_boxes = pipeline.range_finished(response)
+
+    async def fetch_index(self, request: AsyncRequest, rng: RangeRequest) -> None:
+        """
+        Create the index of a media file, using Range requests for the box
+        headers at the start of the file
+        """
+        index = MediaIndex()
+        headers = probe_headers(request.headers)
+        probes = 0
+        while index.next_offset is not None and probes < MAX_INDEX_PROBES:
+            headers['Range'] = index.probe_range()
+            origin = await self.client.get(rng.url, headers, rng.query)
+            probes += 1
+            try:
+                body = await origin.read()
+            finally:
+                origin.close()
+            if not index.add_response(origin.status_code, origin.headers, body):
+                break
+        self.media_pipeline.index_fetched(rng, index, probes)
+
+    @staticmethod
+    async def slice_chunks(chunks: AsyncIterator[bytes],
+                           slicer: Optional[RangeSlicer]) -> AsyncIterator[Buffer]:
+        """
+        Generator that patches and trims each chunk of a Range response
+        """
+        async for chunk in chunks:
+            if slicer is None:
+                yield chunk
+                continue
+            for part in slicer.feed_parts(chunk):
+                yield part
+        if slicer is not None:
+            for part in slicer.flush():
+                yield part
+
+    @staticmethod
+    async def transform_chunks(chunks: AsyncIterator[bytes],
+                               transform: MediaTransform) -> AsyncIterator[Buffer]:
+        """
+        Generator that patches each chunk of a media segment and records
+        it in the segment cache
+        """
+        async for chunk in chunks:
+            for part in transform.feed(chunk):
+                yield part
+        for part in transform.flush():
+            yield part
+
+    @staticmethod
+    async def async_chunks(chunks: Iterable[Buffer]) -> AsyncIterator[Buffer]:
+        """
+        Generator that yields each chunk of a blocking iterator, such as
+        the body of a batch response, so that other requests can be
+        handled while each chunk is being sent
+        """
+        for chunk in chunks:
+            yield chunk
+
+    async def send_pipeline_response(self, request: AsyncRequest, response: Response) -> None:
+        """
+        Send a response created by one of the request pipelines
+        """
+        await self.respond_stream(request, response.status_code, response.parts,
+                                  response.mimetype, response.headers,
+                                  content_length=response.content_length,
+                                  content_encoding=response.content_encoding)
+
+    async def serve_stats(self, request: AsyncRequest) -> None:
+        """
+        Reports the statistics of the origin connection pool and the
+        segment and manifest caches
+        """
+        await self.respond(request, body=json.dumps(self.stats()),
+                           mimetype="application/json", status_code=200)
+
+    async def serve_metrics(self, request: AsyncRequest) -> None:
+        """
+        Reports the request metrics and the statistics from serve_stats()
+        using the Prometheus text format
+        """
+        await self.respond(request, body=metrics.REGISTRY.render(self.stats()),
+                           mimetype=metrics.CONTENT_TYPE, status_code=200)
+
+    def stats(self) -> Dict:
+        """
+        The statistics of the origin connection pool and the segment and
+        manifest caches
+        """
+        result = dict(pool=self.client.stats())
+        segment_cache = self.media_pipeline.cache
+        if segment_cache is not None:
+            result['segment_cache'] = segment_cache.stats()
+        if self.manifest_pipeline.cache is not None:
+            result['manifest_cache'] = self.manifest_pipeline.cache.stats()
+        if self.manifest_pipeline.rewriter is not None:
+            result['manifest_rewriter'] = self.manifest_pipeline.rewriter.stats()
+        if self.media_pipeline.prefetcher is not None:
+            result['prefetch'] = self.media_pipeline.prefetcher.stats()
+        if self.media_pipeline.hedging is not None:
+            result['hedging'] = self.media_pipeline.hedging.stats()
+        result['media_index'] = self.media_pipeline.media_indexes.stats()
+        result['admission'] = self.admission.stats()
+        if self.access_log is not None:
+            result['access_log'] = self.access_log.stats()
+        return result
+
+    async def send_error(self, request: AsyncRequest, status_code: int, message: str) -> None:
+        """
+        Respond with an HTTP error
+        """
+        body = f'<html><body><h1>{status_code} {HTTPStatus(status_code).phrase}</h1>' \
+            f'<p>{html.escape(message)}</p></body></html>'
+        await self.respond(request, status_code=status_code, body=body, mimetype='text/html')
+
+    async def respond(self, request: AsyncRequest, status_code: int, body: Union[bytes, str],
+                      mimetype: str, headers: Optional[Mapping] = None) -> None:
+        """
+        Respond with the given HTTP status code and payload
+        """
+        if isinstance(body, str):
+            body = bytes(body, 'utf-8')
+        await self.respond_stream(request, status_code, [body], mimetype, headers,
+                                  content_length=len(body))
+
+    async def respond_stream(self, request: AsyncRequest, status_code: int,
+                             chunks: Union[Iterable[Buffer], AsyncIterator[Buffer]],
+                             mimetype: str, headers: Optional[Mapping] = None,
+                             content_length: Optional[int] = None,
+                             content_encoding: Optional[str] = None) -> None:
+        """
+        Respond with the given HTTP status code, sending each chunk of the
+        payload to the client as soon as it is available. Waits for each
+        chunk to be written to the socket before reading the next one, so
+        that a slow client applies backpressure to the origin connection.
+        """
+        writer = request.writer
+        chunked = False
+        lines = [f'HTTP/1.1 {status_code} {HTTPStatus(status_code).phrase}',
+                 f'Content-Type: {mimetype}']
+        if content_length is not None:
+            lines.append(f'Content-Length: {content_length}')
+        elif status_code != 304 and request.version == 'HTTP/1.1':
+            lines.append('Transfer-Encoding: chunked')
+            chunked = True
+        elif status_code != 304:
+            request.keep_alive = False
+        if content_encoding is not None:
+            lines.append(f'Content-Encoding: {content_encoding}')
+        if headers is not None:
+            for key, value in headers.items():
+                if key.lower() not in self.excluded_headers:
+                    lines.append(f'{key}: {value}')
+        lines.append('Connection: ' + ('keep-alive' if request.keep_alive else 'close'))
+        lines += ['', '']
+        request.response_started = True
+        request.status_code = status_code
+        writer.write('\r\n'.join(lines).encode('latin-1'))
+
+        def write(chunk: bytes) -> None:
+            if chunked:
+                writer.write(f'{len(chunk):x}\r\n'.encode('ascii'))
+                writer.write(chunk)
+                writer.write(b'\r\n')
+            else:
+                writer.write(chunk)
+
+        writing = 0.0
+        written = 0
+        if isinstance(chunks, (list, tuple)):
+            if chunked:
+                for chunk in chunks:
+                    if chunk:
+                        write(chunk)
+            elif len(chunks) == 1:
+                # writelines() joins the parts, which would copy a single part
+                writer.write(chunks[0])
+            else:
+                writer.writelines(chunks)
+            written = sum([len(chunk) for chunk in chunks])
+        else:
+            if not hasattr(chunks, '__aiter__'):
+                chunks = self.async_chunks(chunks)
+            async for chunk in chunks:
+                if not chunk:
+                    # in chunked mode an empty chunk would end the response
+                    continue
+                started = time.perf_counter()
+                write(chunk)
+                await writer.drain()
+                writing += time.perf_counter() - started
+                written += len(chunk)
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        started = time.perf_counter()
+        await writer.drain()
+        writing += time.perf_counter() - started
+        if written:
+            metrics.record_stage('client_write', writing)
+            metrics.record_bytes('out', written)
+            request.access.bytes += written
@@ -7,32 +7,51 @@ from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
 import logging
 import os
-import re
+import signal
+import socket
 from socketserver import ThreadingMixIn
 import threading
 import time
-from typing import Dict, List, Optional, Union
-import urllib
-from xml.sax.saxutils import unescape
+from typing import Dict, Iterable, Optional, Union
+import urllib.parse
 
 import requests
 
 # pylint: disable=relative-beyond-top-level
-from shared_code.constants import PIFF_UUID, FREE_UUID
-from shared_code.request import fetch, decode_url, encode_url
+from pyproxy.asyncproxy import AsyncProxyServer
+from pyproxy.workers import WorkerSupervisor, is_worker, worker_socket
+from pyproxy.zerocopy import send_buffers, send_file
+from shared_code import metrics
+from shared_code.accesslog import (CACHE_BYPASS, CACHE_COALESCED, CACHE_HIT, AccessLog,
+    AccessRecord)
+from shared_code.admission import AdmissionControl, Overloaded
+from shared_code.cache import ManifestCache, SegmentCache, is_not_modified
+from shared_code.constants import EXCLUDED_HTTP_HEADERS, SEGMENT_CHUNK_SIZE
+from shared_code.diskcache import DiskCache, DiskCacheEntry
+from shared_code.hedging import HedgePolicy, hedged_fetch
+from shared_code.isobmff import Buffer
+from shared_code.manifest import IncrementalRewriter
+from shared_code.pipeline import (PROXY_ROUTES, ClientRequest, ManifestPipeline, MediaPipeline,
+    OriginRequest, Response, create_url, overloaded_response)
+from shared_code.prefetch import Prefetcher
+from shared_code.ranges import MediaIndexCache, fetch_index, probe_headers
+from shared_code.request import configure_pool, decode_url, fetch, origin_pool
+from shared_code.singleflight import (Flight, FlightAbandoned, FlightError,
+    FlightTimeout, SingleFlight)
 
 class ProxyAddAuthentication(BaseHTTPRequestHandler):
     """
     An HTTP handler that will either respond directly or forward the 
     request to an origin server.
     """
-    excluded_headers = ['content-encoding', 'transfer-encoding',
-        'content-length', 'content-type', 'date', 'connection',
-        'if-modified-since']
-    baseurl_re = re.compile(r'<BaseURL>(?P<url>[^<]+)</BaseURL>')
+    excluded_headers = EXCLUDED_HTTP_HEADERS
 
-    MANIFEST_PATH = '/mpd/'
-    MEDIA_PATH = '/media/'
+    routes = PROXY_ROUTES
+    STATS_PATH = '/stats'
+    METRICS_PATH = '/metrics'
+
+    response_status = 0
+    access: AccessRecord
 
     # pylint: disable=invalid-name
     def do_GET(self):
@@ -46,73 +65,92 @@ class ProxyAddAuthentication(BaseHTTPRequestHandler):
         if '?' in path:
             path, qry = path.split('?', 1)
             query = {key:value for key, value in urllib.parse.parse_qsl(qry)}
-        if path.startswith('/create'):
-            self.create_url(path, query)
-        elif path.startswith(self.MANIFEST_PATH):
-            self.serve_manifest(path[len(self.MANIFEST_PATH):], query)
-        elif path.startswith(self.MEDIA_PATH):
-            self.serve_media(path[len(self.MEDIA_PATH):], query)
-        else:
-            self.send_error(404, f'File not found: {path}')
+        route = 'other'
+        started = time.perf_counter()
+        self.response_status = 0
+        self.access = AccessRecord(self.command)
+        try:
+            if path.startswith(self.routes.create):
+                route = 'create'
+                self.create_url(query)
+            elif path.startswith(self.routes.manifest):
+                route = 'manifest'
+                self.serve_manifest(path[len(self.routes.manifest):], query)
+            elif path.startswith(self.routes.media):
+                route = 'media'
+                self.serve_media(path[len(self.routes.media):], query)
+            elif path == self.STATS_PATH:
+                route = 'stats'
+                self.serve_stats()
+            elif path == self.METRICS_PATH:
+                route = 'metrics'
+                self.serve_metrics()
+            else:
+                self.send_error(404, f'File not found: {path}')
+        except Overloaded as err:
+            logging.info('%s', err)
+            self.send_pipeline_response(overloaded_response(err))
+        finally:
+            metrics.record_request(route, self.response_status, time.perf_counter() - started)
+            self.log_access(route)
 
     # pylint: disable=invalid-name
     def do_POST(self):
         """
         handles POST requests.
         """
-        content_len = self.headers['content-length']
-        if content_len is not None:
-           content_len = int(content_len)
-        body = self.rfile.read(content_len)
-        return self.create_url(self.path, None, body)
+        started = time.perf_counter()
+        self.response_status = 0
+        self.access = AccessRecord(self.command)
+        try:
+            content_len = self.headers['content-length']
+            if content_len is not None:
+               content_len = int(content_len)
+            body = self.rfile.read(content_len)
+            return self.create_url(None, body)
+        finally:
+            metrics.record_request('create', self.response_status,
+                                   time.perf_counter() - started)
+            self.log_access('create')
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None:
+        """
+        Sends the response status line, recording the status code for the
+        request metrics
+        """
+        self.response_status = code
+        super().send_response(code, message)
 
-    def create_url(self, path: str, query: Dict, body: Optional[bytes] = None) -> None:
+    def log_request(self, code='-', size='-') -> None:
+        """
+        Writes the request line to stderr, unless the structured access
+        log is being used instead
+        """
+        if self.server.access_log is None:
+            super().log_request(code, size)
+
+    def log_access(self, route: str) -> None:
+        """
+        Add the record of this request to the access log
+        """
+        self.access.finished(route, self.response_status)
+        if self.server.access_log is not None:
+            self.server.access_log.log(self.access)
+
+    def client_request(self, query: Optional[Dict]) -> ClientRequest:
+        """
+        The parts of this request that are used by the request pipelines
+        """
+        return ClientRequest(self.request_url(), self.headers, query)
+
+    def create_url(self, query: Optional[Dict], body: Optional[bytes] = None) -> None:
         """
         Encodes a manifest URL so that it points to the
         ManifestProxy service. The "ManifestProxy" is able
         to extract the original URL and fetch it from the origin.
         """
-        if self.command == 'POST' or query is not None:
-            try:
-                mpd_url = self.extract_url_from_request(query, body)
-            except (ValueError, KeyError) as err:
-                logging.error("Failed to extract URL field: %s %s", type(err), err)
-                mpd_url = None
-            if not mpd_url:
-                self.send_error(400, 
-                    'Field "url" is required either in the query string or in the request body')
-                return
-            # remove query string and fragment from the requested URL, as that must not
-            # be wrapped
-            mpd_parts = urllib.parse.urlparse(mpd_url)
-            mpd_url = urllib.parse.urlunsplit((mpd_parts.scheme, mpd_parts.netloc,
-                    mpd_parts.path, '', ''))
-            req_url = self.request_url()
-            logging.debug("Request url = %s", req_url)
-            parts = urllib.parse.urlparse(req_url)
-            manifest_url = ['http://', parts.hostname]
-            if parts.port and parts.port != 80:
-                manifest_url.append(f':{parts.port}')
-            manifest_url.append(self.MANIFEST_PATH)
-            manifest_url.append(encode_url(mpd_url))
-            if mpd_parts.query:
-                manifest_url.append('?')
-                manifest_url.append(mpd_parts.query)
-            result = dict(url=''.join(manifest_url))
-            self.respond(body=json.dumps(result), mimetype="application/json",
-                status_code=200)
-            return
-        body = """<!doctype html><html lang="en">
-        <head><title>Manifest URL generator</title></head>
-        <body>
-        <form method="POST">
-        <label for="url">Manifest URL:</label>
-        <input type="text" name="url" placeholder="DASH manifest URL..." />
-        <button type="submit">Generate URL</button>
-        </form>
-        </body></html>
-        """
-        self.respond(status_code=200, body=body, mimetype='text/html')
+        self.send_pipeline_response(
+            create_url(self.routes, self.client_request(query), self.command, body))
 
     def serve_manifest(self, path: str, query: Optional[Dict]) -> None:
         """
@@ -120,64 +158,279 @@ class ProxyAddAuthentication(BaseHTTPRequestHandler):
         manifest so that all requsts for media segments will be directed
         to the SegmentProxy lambda.
         """
-        logging.debug('Processing manifest request %s', path)
-        manifest_url = decode_url(path)
-        logging.debug('Manifest origin URL: %s', manifest_url)
-        origin = fetch(manifest_url, self.headers, query)
-    
-        try:
-            mimetype = origin.headers['Content-Type']
-        except KeyError:
-            mimetype = 'text/dash+xml'
-        body: Optional[Union[bytes, str]] = None
-        if 'text' in mimetype or 'dash+xml' in mimetype:
-            body = origin.text
+        pipeline: ManifestPipeline = self.server.manifest_pipeline
+        request = self.client_request(query)
+        self.access.url = decode_url(path)
+        result = pipeline.begin(request, path)
+        if isinstance(result, Response):
+            self.access.cache = CACHE_HIT
         else:
-            body = origin.content
-        if origin.status_code == 200 and mimetype == 'application/dash+xml':
-            # replace the original BaseURL with a URL that points to the 
-            # SegmentProxy lambda
-            parts = urllib.parse.urlparse(self.request_url())
-            media_url = ['<BaseURL>', 'http://', parts.hostname]
-            if parts.port and parts.port != 80:
-                media_url.append(f':{parts.port}')
-            media_url.append(self.MEDIA_PATH)
-
-            # modify all BaseURL elements to point to the SegmentProxy lambda,
-            # with a URL that wraps the original origin URL
-            body = self.baseurl_re.sub(lambda match: self.url_replacer(media_url, match), body)
-        self.respond(status_code=origin.status_code, mimetype=mimetype, headers=origin.headers,
-                    body=body)
+            with self.server.admission.admit(result.url):
+                origin = fetch(result.url, result.headers, result.query)
+                self.access.origin_response(result, origin.status_code,
+                                            origin.elapsed.total_seconds())
+                result = pipeline.complete(request, result, origin.status_code,
+                                           origin.headers, origin.content)
+        self.send_pipeline_response(result)
 
     def serve_media(self, path: str, query: Optional[Dict]) -> None:
         """
         Fetch DASH media segment from origin and remove the PIFF box
         by translating them into "free" boxes.
         """
-        enc_base_url = path.split('/')[0]
-        path = path[1 + len(enc_base_url):]
-        logging.info('Processing media request %s  %s', enc_base_url, path)
-
-        # extract the original BaseURL from the URL that triggered this
-        # function and then append the segment path, to create a URL
-        # to fetch from origin.
-        base_url = decode_url(enc_base_url)
-        origin_url = urllib.parse.urljoin(base_url, path)
-        origin = fetch(origin_url, self.headers, query)
-        logging.debug("Origin response: %d", origin.status_code)
+        pipeline: MediaPipeline = self.server.media_pipeline
+        request = self.client_request(query)
+        origin_url = pipeline.origin_url_from_path(path)
+        self.access.url = origin_url
+        if 'Range' in self.headers:
+            # the cache only holds complete segments and only requests
+            # for complete segments can share an origin request
+            self.serve_range(request, origin_url)
+            return
+        flights: Optional[SingleFlight] = self.server.flights
+        result = pipeline.begin(request, origin_url, shared=flights is not None)
+        if isinstance(result, Response):
+            self.access.cache = CACHE_HIT
+            self.send_pipeline_response(result)
+            return
+        if flights is None:
+            self.fetch_media(request, result, None)
+            return
+        flight, leader = flights.join(result.key)
+        if not leader:
+            self.access.cache = CACHE_COALESCED
+            self.respond_from_flight(flight, request, origin_url)
+            return
         try:
-            mimetype = origin.headers['Content-Type']
-        except KeyError:
-            mimetype = 'application/octet-stream'
-        body: Optional[bytes] = origin.content
-        if origin.status_code == 200 and 'text' not in mimetype:
-            # replace PIFF_UUID with FREE_UUID
-            pos = body.find(PIFF_UUID)
-            logging.info("pos=%d", pos)
-            if pos > 0:
-                body = body[:pos] + FREE_UUID + body[pos+len(PIFF_UUID):]
-        self.respond(body=body, status_code=origin.status_code,
-            mimetype=mimetype, headers=origin.headers)
+            self.fetch_media(request, result, flight)
+        except BaseException as err:
+            flight.finish(err)
+            raise
+        finally:
+            flights.leave(flight)
+
+    def serve_range(self, request: ClientRequest, origin_url: str) -> None:
+        """
+        Fetch part of a media file from origin. The range requested from
+        origin is widened to start at a box boundary, so that the PIFF
+        boxes that overlap the requested range can be patched.
+        """
+        pipeline: MediaPipeline = self.server.media_pipeline
+        rng = pipeline.begin_range(request, origin_url)
+        self.access.cache = CACHE_BYPASS
+        with self.server.admission.admit(origin_url) as ticket:
+            if rng.needs_index:
+                index, probes = fetch_index(origin_url, probe_headers(self.headers),
+                                            request.query)
+                pipeline.index_fetched(rng, index, probes)
+            origin_request = pipeline.range_origin(request, rng)
+            origin = fetch(origin_request.url, origin_request.headers, origin_request.query,
+                           stream=True)
+            self.access.origin_response(origin_request, origin.status_code,
+                                        origin.elapsed.total_seconds())
+            try:
+                mimetype = origin.headers.get('Content-Type', 'application/octet-stream')
+                response = pipeline.range_response(rng, origin.status_code, origin.headers)
+                ticket.response_started(origin.headers)
+                chunks: Iterable[Buffer] = []
+                if response.send_body:
+                    chunks = metrics.timed_chunks(
+                        origin.iter_content(chunk_size=SEGMENT_CHUNK_SIZE))
+                    if response.slicer is not None:
+                        chunks = response.slicer.patch(chunks)
+                self.respond_stream(chunks=chunks, status_code=response.status_code,
+                    mimetype=mimetype, headers=response.headers,
+                    content_length=response.content_length)
+            finally:
+                origin.close()
+            self.access.piff_boxes = pipeline.range_finished(response)
+
+    def fetch_media(self, request: ClientRequest, origin_request: OriginRequest,
+                    flight: Optional[Flight]) -> None:
+        """
+        Fetch a media segment from origin, patch it and send it to the client.
+        If a flight is provided, the patched segment is shared with every
+        request that is waiting for the same segment.
+        """
+        pipeline: MediaPipeline = self.server.media_pipeline
+        with self.server.admission.admit(origin_request.url) as ticket:
+            origin = hedged_fetch(pipeline.hedging, origin_request, ticket)
+            self.access.origin_response(origin_request, origin.status_code,
+                                        origin.elapsed.total_seconds())
+            cached = pipeline.revalidated(request, origin_request, origin.status_code,
+                                          origin.headers)
+            if cached is not None:
+                origin.close()
+                entry = origin_request.entry
+                if flight is not None:
+                    flight.start(entry.status_code, entry.mimetype, entry.response_headers(),
+                                 entry.size)
+                    for _ in flight.publish([entry.body]):
+                        pass
+                self.send_pipeline_response(cached)
+                return
+            transform = pipeline.transform(request, origin_request, origin.status_code,
+                                           origin.headers, shared=flight is not None)
+            ticket.response_started(origin.headers)
+            chunks: Iterable[Buffer] = transform.patch(metrics.timed_chunks(
+                origin.iter_content(chunk_size=SEGMENT_CHUNK_SIZE)))
+            if flight is not None:
+                flight.start(origin.status_code, transform.mimetype, origin.headers,
+                             transform.content_length)
+                chunks = flight.publish(chunks)
+            try:
+                if transform.not_modified:
+                    # the segment is still downloaded for the cache and any
+                    # waiting requests
+                    if transform.writer is not None or flight is not None:
+                        for _ in chunks:
+                            pass
+                    self.respond_stream(chunks=[], status_code=304,
+                        mimetype=transform.mimetype, headers=transform.headers)
+                else:
+                    try:
+                        self.respond_stream(chunks=chunks, status_code=origin.status_code,
+                            mimetype=transform.mimetype, headers=transform.headers,
+                            content_length=transform.content_length)
+                    except OSError:
+                        # an origin error has already been passed to the flight
+                        # by publish(), so this is a failure to write to the client
+                        if flight is None or flight.done or not flight.leader_gone():
+                            raise
+                        logging.debug('Client has gone, finishing %s for waiting requests',
+                                      origin_request.url)
+                        for _ in chunks:
+                            pass
+                        transform.finish()
+                        raise
+            finally:
+                origin.close()
+            transform.finish()
+            self.access.piff_boxes = transform.boxes_patched
+
+    def respond_from_flight(self, flight: Flight, request: ClientRequest,
+                            origin_url: str) -> None:
+        """
+        Respond using the origin request made by another request for
+        the same media segment
+        """
+        try:
+            flight.wait_started()
+        except FlightAbandoned:
+            pipeline: MediaPipeline = self.server.media_pipeline
+            result = pipeline.begin(request, origin_url)
+            if isinstance(result, Response):
+                self.access.cache = CACHE_HIT
+                self.send_pipeline_response(result)
+            else:
+                self.access.cache = None
+                self.fetch_media(request, result, None)
+            return
+        except FlightTimeout as err:
+            logging.warning('%s', err)
+            self.send_error(504, str(err))
+            return
+        except FlightError as err:
+            if isinstance(err.__cause__, Overloaded):
+                self.send_pipeline_response(overloaded_response(err.__cause__))
+                return
+            logging.warning('%s', err)
+            self.send_error(502, str(err))
+            return
+        if (flight.status_code == 200 and
+                is_not_modified(self.headers, flight.headers.get('ETag'),
+                                flight.headers.get('Last-Modified'))):
+            self.respond_stream(chunks=[], status_code=304, mimetype=flight.mimetype,
+                headers=flight.headers)
+            return
+        try:
+            self.respond_stream(chunks=flight.iter_chunks(), status_code=flight.status_code,
+                mimetype=flight.mimetype, headers=flight.headers,
+                content_length=flight.content_length)
+        except FlightError as err:
+            # the response headers have already been sent, so the only
+            # way to report the error is to close the connection
+            logging.warning('%s', err)
+            self.close_connection = True
+
+    def send_pipeline_response(self, response: Response) -> None:
+        """
+        Send a response created by one of the request pipelines. The
+        body of an entry from the disk cache is sent using sendfile().
+        """
+        if isinstance(response.entry, DiskCacheEntry):
+            self.respond_stream(chunks=[], status_code=response.status_code,
+                mimetype=response.mimetype, headers=response.headers,
+                content_length=response.content_length)
+            self.send_disk_entry(response.entry)
+            return
+        self.respond_stream(chunks=response.parts, status_code=response.status_code,
+            mimetype=response.mimetype, headers=response.headers,
+            content_length=response.content_length,
+            content_encoding=response.content_encoding)
+
+    def send_disk_entry(self, entry: DiskCacheEntry) -> None:
+        """
+        Send the body of an entry from the disk cache using sendfile(),
+        so that it is copied directly from the page cache to the socket.
+        If the file has been replaced since the entry was read, the
+        memory mapped copy of the original file is sent instead.
+        """
+        started = time.perf_counter()
+        sent: Optional[int] = None
+        try:
+            with open(entry.path, 'rb') as src:
+                stat = os.fstat(src.fileno())
+                if (stat.st_dev, stat.st_ino) == entry.inode:
+                    sent = send_file(self.connection, src, entry.offset, entry.size)
+        except FileNotFoundError:
+            pass
+        if sent is None:
+            sent = send_buffers(self.connection, [entry.body])
+        metrics.record_stage('client_write', time.perf_counter() - started)
+        metrics.record_bytes('out', sent)
+        self.access.bytes += sent
+
+    def serve_stats(self) -> None:
+        """
+        Reports the statistics of the origin connection pool, the segment
+        and manifest caches and request coalescing
+        """
+        self.respond(body=json.dumps(self.stats()), mimetype="application/json",
+            status_code=200)
+
+    def serve_metrics(self) -> None:
+        """
+        Reports the request metrics and the statistics from serve_stats()
+        using the Prometheus text format
+        """
+        self.respond(body=metrics.REGISTRY.render(self.stats()),
+            mimetype=metrics.CONTENT_TYPE, status_code=200)
+
+    def stats(self) -> Dict:
+        """
+        The statistics of the origin connection pool, the segment and
+        manifest caches and request coalescing
+        """
+        result = dict(pool=origin_pool().stats())
+        if self.server.segment_cache is not None:
+            result['segment_cache'] = self.server.segment_cache.stats()
+        if self.server.manifest_cache is not None:
+            result['manifest_cache'] = self.server.manifest_cache.stats()
+        if self.server.manifest_rewriter is not None:
+            result['manifest_rewriter'] = self.server.manifest_rewriter.stats()
+        if self.server.flights is not None:
+            result['coalescing'] = self.server.flights.stats()
+        if self.server.prefetcher is not None:
+            result['prefetch'] = self.server.prefetcher.stats()
+        if self.server.media_pipeline.hedging is not None:
+            result['hedging'] = self.server.media_pipeline.hedging.stats()
+        result['media_index'] = self.server.media_indexes.stats()
+        result['admission'] = self.server.admission.stats()
+        result['connections'] = self.server.connection_stats()
+        if self.server.access_log is not None:
+            result['access_log'] = self.server.access_log.stats()
+        return result
 
     def respond(self, status_code: int, body: Union[bytes, str], mimetype: str,
                 headers: Optional[Dict] = None) -> None:
@@ -186,7 +439,7 @@ class ProxyAddAuthentication(BaseHTTPRequestHandler):
         """
         if isinstance(body, str):
             body = bytes(body, 'utf-8')
-        self.send_response(200)
+        self.send_response(status_code)
         self.send_header('Content-Type', mimetype)
         self.send_header('Content-Length', len(body))
         if headers is not None:
@@ -195,6 +448,46 @@ class ProxyAddAuthentication(BaseHTTPRequestHandler):
                     self.send_header(key, value)
         self.end_headers()
         self.wfile.write(body)
+        metrics.record_bytes('out', len(body))
+        self.access.bytes += len(body)
+
+    def respond_stream(self, status_code: int, chunks: Iterable[Buffer], mimetype: str,
+                       headers: Optional[Dict] = None,
+                       content_length: Optional[int] = None,
+                       content_encoding: Optional[str] = None) -> None:
+        """
+        Respond with the given HTTP status code, sending each chunk of the
+        payload to the client as soon as it is available
+        """
+        self.send_response(status_code)
+        self.send_header('Content-Type', mimetype)
+        if content_length is not None:
+            self.send_header('Content-Length', content_length)
+        if content_encoding is not None:
+            self.send_header('Content-Encoding', content_encoding)
+        if headers is not None:
+            for key, value in headers.items():
+                if key.lower() not in self.excluded_headers:
+                    self.send_header(key, value)
+        self.end_headers()
+        writing = 0.0
+        written = 0
+        if isinstance(chunks, (list, tuple)):
+            # the complete body is already available, so write all of
+            # the parts using as few system calls as possible
+            started = time.perf_counter()
+            written = send_buffers(self.connection, chunks)
+            writing = time.perf_counter() - started
+        else:
+            for chunk in chunks:
+                started = time.perf_counter()
+                self.wfile.write(chunk)
+                writing += time.perf_counter() - started
+                written += len(chunk)
+        if written:
+            metrics.record_stage('client_write', writing)
+            metrics.record_bytes('out', written)
+            self.access.bytes += written
 
     def request_url(self) -> str:
         """
@@ -209,42 +502,80 @@ class ProxyAddAuthentication(BaseHTTPRequestHandler):
             return ''.join(['http://', host, '/', self.path])
         return ''.join(['http://', host, ':', str(self.server.server_port), '/', self.path])
 
-    def extract_url_from_request(self, query: Optional[Dict], body: Optional[bytes]) -> str:
-        """
-        Check the request for a "url" field.
-        It searches for a CGI parameter, an application/x-www-form-urlencoded
-        form or an application/json payload.
-        """
-        if query is not None:
-            url = query.get('url')
-            if url:
-                return url
-        content_type = self.headers.get('Content-Type', '')
-        logging.debug('content type: %s', content_type)
-        if 'json' in content_type:
-            req_body = json.loads(body)
-            return req_body.get('url')
-        if 'x-www-form-urlencoded' in content_type:
-            form = urllib.parse.parse_qs(body)
-            if b'url' in form:
-                return str(form[b'url'][0], 'utf-8')
-            return form["url"]
-        raise ValueError("Unknown payload type")
-
-    def url_replacer(self, media_url: List[str], match: re.match) -> str:
-        """
-        Used in the regexp replacer function to wrap BaseURL
-        elements to point to the SegmentProxy lambda.
-    
-        For example <BaseURL>http://example.site/foo</BaseURL> becomes
-        <BaseURL>http://my.lambda/api/media/http%3A%2F%2Fexample.site%2Ffoo/</BaseURL>
-        """
-        origin_url = unescape(match.group('url'))
-        origin_url = encode_url(origin_url)
-        return ''.join(media_url + [origin_url, r'/</BaseURL>'])
-
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
+    """
+    Handle requests in a separate thread. Once max_connections client
+    connections are open, new connections are sent a 503 response and
+    closed, rather than starting another thread.
+    """
+    max_connections = 0
+    access_log: Optional[AccessLog] = None
+
+    OVERLOADED_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n'
+                           b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.connections_lock = threading.Lock()
+        self.connections = 0
+        self.rejected_connections = 0
+
+    def process_request(self, request, client_address) -> None:
+        with self.connections_lock:
+            if self.max_connections and self.connections >= self.max_connections:
+                self.rejected_connections += 1
+                rejected = True
+            else:
+                self.connections += 1
+                rejected = False
+        if rejected:
+            self.reject_connection(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self.connection_finished()
+            raise
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.connection_finished()
+
+    def connection_finished(self) -> None:
+        """
+        Called when the thread handling a connection has finished
+        """
+        with self.connections_lock:
+            self.connections -= 1
+
+    def reject_connection(self, request: socket.socket) -> None:
+        """
+        Respond to a connection with "503 Service Unavailable", without
+        handling its request
+        """
+        try:
+            request.settimeout(0.1)
+            # read the request, so that closing the socket does not reset
+            # the connection before the client has read the response
+            request.recv(65536)
+        except OSError:
+            pass
+        try:
+            request.sendall(self.OVERLOADED_RESPONSE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def connection_stats(self) -> Dict:
+        """
+        The number of open client connections, and the number that have
+        been rejected
+        """
+        with self.connections_lock:
+            return {'active': self.connections, 'max': self.max_connections,
+                    'rejected': self.rejected_connections}
 
 
 class ProxyDaemon:
@@ -252,13 +583,76 @@ class ProxyDaemon:
     An HTTP proxy that can make upstream origin requests and modify responses
     before returning them to the requesting client.
     """
-    def __init__(self, options, env):
+    def __init__(self, options, env, sock: Optional[socket.socket] = None):
         if env is None:
             env = os.environ
         self.env = env
         self.options = options
+        self.sock = sock
         self.proxy_thread = None
         self.httpd = None
+        # options added since the first release are optional, so that the
+        # options of an older caller can still be used
+        disk_cache = getattr(options, 'disk_cache', None)
+        cache_size = getattr(options, 'cache_size', 128)
+        manifest_cache_size = getattr(options, 'manifest_cache_size', 16)
+        coalesce_timeout = getattr(options, 'coalesce_timeout', 10.0)
+        prefetch = getattr(options, 'prefetch', 0)
+        prefetch_bandwidth = getattr(options, 'prefetch_bandwidth', 100.0)
+        hedge_percentile = getattr(options, 'hedge_percentile', 0)
+        access_log = getattr(options, 'access_log', None)
+        self.segment_cache: Optional[SegmentCache] = None
+        if disk_cache:
+            # a cache that is shared by all of the worker processes
+            self.segment_cache = DiskCache(
+                disk_cache, getattr(options, 'disk_cache_size', 1024) * 1024 * 1024)
+        elif cache_size > 0:
+            self.segment_cache = SegmentCache(cache_size * 1024 * 1024)
+        self.manifest_cache: Optional[ManifestCache] = None
+        self.manifest_rewriter: Optional[IncrementalRewriter] = None
+        if manifest_cache_size > 0:
+            self.manifest_cache = ManifestCache(manifest_cache_size * 1024 * 1024)
+            self.manifest_rewriter = IncrementalRewriter(manifest_cache_size * 1024 * 1024)
+        self.flights: Optional[SingleFlight] = None
+        if coalesce_timeout > 0:
+            self.flights = SingleFlight(coalesce_timeout,
+                                        getattr(options, 'coalesce_size', 16) * 1024 * 1024)
+        self.media_indexes = MediaIndexCache()
+        self.prefetcher: Optional[Prefetcher] = None
+        if prefetch > 0 and self.segment_cache is not None:
+            bandwidth: Optional[float] = None
+            if prefetch_bandwidth > 0:
+                bandwidth = prefetch_bandwidth * 1000000 / 8
+            # the asyncio server does not coalesce requests
+            flights = self.flights if self.server_type() == 'threaded' else None
+            self.prefetcher = Prefetcher(self.segment_cache, prefetch,
+                                         workers=getattr(options, 'prefetch_workers', 2),
+                                         max_bytes_per_sec=bandwidth, flights=flights)
+        self.hedging: Optional[HedgePolicy] = None
+        if hedge_percentile > 0:
+            self.hedging = HedgePolicy(hedge_percentile,
+                                       min_delay=getattr(options, 'hedge_min_delay', 0.05),
+                                       max_delay=getattr(options, 'hedge_max_delay', 2.0))
+        self.admission = AdmissionControl(
+            max_active=getattr(options, 'origin_concurrency', 64),
+            max_queue=getattr(options, 'origin_queue', 256),
+            queue_timeout=getattr(options, 'origin_queue_timeout', 5.0),
+            max_bytes=getattr(options, 'inflight_mb', 512) * 1024 * 1024)
+        self.access_log: Optional[AccessLog] = None
+        if access_log:
+            self.access_log = AccessLog(access_log,
+                                        max_queue=getattr(options, 'access_log_queue', 10000))
+        self.manifest_pipeline = ManifestPipeline(PROXY_ROUTES, self.manifest_cache,
+                                                  self.manifest_rewriter, self.prefetcher,
+                                                  self.hedging)
+        self.media_pipeline = MediaPipeline(PROXY_ROUTES, self.segment_cache, self.prefetcher,
+                                            self.media_indexes, self.hedging)
+
+    def server_type(self) -> str:
+        """
+        The type of HTTP server, either "threaded" or "asyncio"
+        """
+        return getattr(self.options, 'server', 'threaded')
 
     def start(self):
         """
@@ -274,12 +668,40 @@ class ProxyDaemon:
         This function is called from the thread that is started
         to handle HTTP requests
         """
+        if self.server_type() == 'asyncio':
+            self.httpd = AsyncProxyServer(self.options, self.manifest_pipeline,
+                                          self.media_pipeline, self.admission,
+                                          self.access_log)
+            self.httpd.serve_forever(self.sock)
+            return
         server_address = (self.options.bind, self.options.port)
 
-        self.httpd = ThreadedHTTPServer(server_address, ProxyAddAuthentication)
+        self.httpd = ThreadedHTTPServer(server_address, ProxyAddAuthentication,
+                                        bind_and_activate=self.sock is None)
+        if self.sock is not None:
+            # use the listening socket that is shared with the other workers
+            self.httpd.socket.close()
+            self.httpd.socket = self.sock
+            host, port = self.sock.getsockname()[:2]
+            self.httpd.server_address = (host, port)
+            self.httpd.server_name = socket.getfqdn(host)
+            self.httpd.server_port = port
         # pylint: disable=attribute-defined-outside-init
         self.httpd.options = self.options
+        self.httpd.segment_cache = self.segment_cache
+        self.httpd.manifest_cache = self.manifest_cache
+        self.httpd.manifest_rewriter = self.manifest_rewriter
+        self.httpd.flights = self.flights
+        self.httpd.prefetcher = self.prefetcher
+        self.httpd.media_indexes = self.media_indexes
+        self.httpd.manifest_pipeline = self.manifest_pipeline
+        self.httpd.media_pipeline = self.media_pipeline
+        self.httpd.admission = self.admission
+        self.httpd.max_connections = getattr(self.options, 'max_connections', 1000)
+        self.httpd.access_log = self.access_log
         self.httpd.serve_forever()
+        # wait for the requests that are in progress to complete
+        self.httpd.server_close()
 
     def stop(self):
         """
@@ -289,11 +711,23 @@ class ProxyDaemon:
             self.httpd.shutdown()
             self.proxy_thread.join()
             self.proxy_thread = None
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.access_log is not None:
+            self.access_log.close()
 
 
-def main():
+def _stop_signal_handler(signum, frame):
     """
-    functon that is called when proxy.py is called from the command line
+    Treat SIGTERM in the same way as Ctrl+C, so that the proxy is
+    stopped gracefully
+    """
+    # pylint: disable=unused-argument
+    raise KeyboardInterrupt()
+
+def create_parser() -> argparse.ArgumentParser:
+    """
+    The command line arguments of the proxy
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("-b", "--bind", dest="bind", default="127.0.0.1",
@@ -305,17 +739,103 @@ def main():
                         action="store", type=int,
                         help="Run HTTP proxy on port [%(default)s]")
     parser.add_argument("--pid-file", dest="pid_file", help="save PID of process to this file")
-    options = parser.parse_args()
-    if options.pid_file:
+    parser.add_argument("--server", dest="server", default="threaded",
+                        choices=["threaded", "asyncio"],
+                        help="Use a thread per connection or an asyncio event loop [%(default)s]")
+    parser.add_argument("--pool-size", dest="pool_size", default=10, type=int,
+                        help="Maximum connections to keep open to each origin [%(default)s]")
+    parser.add_argument("--retries", dest="retries", default=2, type=int,
+                        help="Number of times to retry a failed origin connection [%(default)s]")
+    parser.add_argument("--connect-timeout", dest="connect_timeout", default=3.05, type=float,
+                        help="Timeout (in seconds) to connect to origin [%(default)s]")
+    parser.add_argument("--read-timeout", dest="read_timeout", default=30.0, type=float,
+                        help="Timeout (in seconds) to wait for data from origin [%(default)s]")
+    parser.add_argument("--cache-size", dest="cache_size", default=128, type=int,
+                        help="Size (in MB) of the patched segment cache, 0 to disable [%(default)s]")
+    parser.add_argument("--disk-cache", dest="disk_cache", default=None,
+                        help="Directory of a segment cache that is shared by all " +
+                        "worker processes, instead of an in-memory cache in each process")
+    parser.add_argument("--disk-cache-size", dest="disk_cache_size", default=1024, type=int,
+                        help="Size (in MB) of the disk segment cache [%(default)s]")
+    parser.add_argument("--manifest-cache-size", dest="manifest_cache_size", default=16,
+                        type=int, help="Size (in MB) of the rewritten manifest cache, " +
+                        "0 to disable [%(default)s]")
+    parser.add_argument("--coalesce-timeout", dest="coalesce_timeout", default=10.0, type=float,
+                        help="Time (in seconds) a request will wait for an identical origin " +
+                        "request, 0 to disable request coalescing [%(default)s]")
+    parser.add_argument("--coalesce-size", dest="coalesce_size", default=16, type=int,
+                        help="Size (in MB) of a media segment that is kept for requests " +
+                        "that arrive while it is received from origin [%(default)s]")
+    parser.add_argument("--prefetch", dest="prefetch", default=0, type=int,
+                        help="Number of segments to prefetch after each segment that is " +
+                        "requested, 0 to disable [%(default)s]")
+    parser.add_argument("--prefetch-workers", dest="prefetch_workers", default=2, type=int,
+                        help="Number of threads used for prefetching [%(default)s]")
+    parser.add_argument("--prefetch-bandwidth", dest="prefetch_bandwidth", default=100.0,
+                        type=float, help="Maximum combined download rate (in Mbit/s) of " +
+                        "the prefetch threads, 0 for no limit [%(default)s]")
+    parser.add_argument("--hedge-percentile", dest="hedge_percentile", default=0.0,
+                        type=float, help="Percentile of an origin's response times after " +
+                        "which a media segment is also requested using an alternate " +
+                        "BaseURL, such as 95, or 0 to disable hedged requests [%(default)s]")
+    parser.add_argument("--hedge-min-delay", dest="hedge_min_delay", default=0.05, type=float,
+                        help="Minimum time (in seconds) before a hedged request [%(default)s]")
+    parser.add_argument("--hedge-max-delay", dest="hedge_max_delay", default=2.0, type=float,
+                        help="Maximum time (in seconds) before a hedged request [%(default)s]")
+    parser.add_argument("--origin-concurrency", dest="origin_concurrency", default=64, type=int,
+                        help="Maximum concurrent requests to each origin host, " +
+                        "0 for no limit [%(default)s]")
+    parser.add_argument("--origin-queue", dest="origin_queue", default=256, type=int,
+                        help="Maximum requests waiting for an origin request, beyond " +
+                        "which requests are rejected with 503, 0 for no limit [%(default)s]")
+    parser.add_argument("--origin-queue-timeout", dest="origin_queue_timeout", default=5.0,
+                        type=float, help="Time (in seconds) a request can wait for an " +
+                        "origin request before it is rejected with 503 [%(default)s]")
+    parser.add_argument("--inflight-mb", dest="inflight_mb", default=512, type=int,
+                        help="Size (in MB) of the origin responses in flight, beyond which " +
+                        "new origin requests wait, 0 for no limit [%(default)s]")
+    parser.add_argument("--max-connections", dest="max_connections", default=1000, type=int,
+                        help="Maximum client connections of the threaded server, " +
+                        "0 for no limit [%(default)s]")
+    parser.add_argument("--access-log", dest="access_log", default=None,
+                        help="Append a JSON line describing each request to this file")
+    parser.add_argument("--access-log-queue", dest="access_log_queue", default=10000,
+                        type=int, help="Maximum access log records waiting to be written, " +
+                        "beyond which records are dropped [%(default)s]")
+    parser.add_argument("--workers", dest="workers", default=1, type=int,
+                        help="Number of worker processes [%(default)s]")
+    parser.add_argument("--reuse-port", dest="reuse_port", action="store_true",
+                        help="Each worker binds its own socket using SO_REUSEPORT, " +
+                        "rather than sharing one listening socket")
+    return parser
+
+def main():
+    """
+    functon that is called when proxy.py is called from the command line
+    """
+    options = create_parser().parse_args()
+    env = os.environ.copy()
+    worker = is_worker(env)
+    if options.pid_file and not worker:
         with open(options.pid_file, 'wt') as pidfile:
             pidfile.write(str(os.getpid()) + "\n")
-    env = os.environ.copy()
     log_level = logging.INFO
     if options.verbosity:
         log_level = logging.DEBUG
-    logging.basicConfig(format='%(name)s-%(thread)05d: %(levelname)-8s %(message)s',
+    logging.basicConfig(format='%(name)s-%(process)d-%(thread)05d: %(levelname)-8s %(message)s',
                         level=log_level)
-    prxy = ProxyDaemon(options, env)
+    if options.workers > 1 and not worker:
+        try:
+            WorkerSupervisor(options, env=env).run()
+        finally:
+            if options.pid_file:
+                os.remove(options.pid_file)
+        return
+    configure_pool(pool_size=options.pool_size, retries=options.retries,
+                   connect_timeout=options.connect_timeout,
+                   read_timeout=options.read_timeout)
+    signal.signal(signal.SIGTERM, _stop_signal_handler)
+    prxy = ProxyDaemon(options, env, sock=worker_socket(options, env))
     prxy.start()
     logging.info('Proxy running on http://%s:%d/', options.bind, options.port)
     try:
@@ -326,7 +846,7 @@ def main():
     finally:
         logging.info('Stopping proxy')
         prxy.stop()
-    if options.pid_file:
+    if options.pid_file and not worker:
         os.remove(options.pid_file)
 
 if __name__ == "__main__":
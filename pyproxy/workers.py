@@ -0,0 +1,183 @@
+"""
+Support for running several pyproxy worker processes that share one
+listening port, so that the proxy can use more than one CPU core.
+"""
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+# Environment variable used to pass the shared listening socket to a worker
+WORKER_FD_ENV = 'DASHPIFF_WORKER_FD'
+
+# Environment variable that tells a worker to bind its own SO_REUSEPORT socket
+WORKER_REUSE_PORT_ENV = 'DASHPIFF_REUSE_PORT'
+
+def create_listen_socket(bind: str, port: int, reuse_port: bool = False,
+                         backlog: int = 1024) -> socket.socket:
+    """
+    Create a listening TCP socket. If reuse_port is True, the SO_REUSEPORT
+    option is used so that several processes can each bind their own
+    socket to the same port and the kernel balances connections across them.
+    """
+    family = socket.AF_INET6 if ':' in bind else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError('SO_REUSEPORT is not supported on this platform')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((bind, port))
+    sock.listen(backlog)
+    return sock
+
+def worker_socket(options, env: Dict[str, str]) -> Optional[socket.socket]:
+    """
+    Get the listening socket for this process, if it has been started
+    as a worker by WorkerSupervisor
+    """
+    if WORKER_FD_ENV in env:
+        return socket.socket(fileno=int(env[WORKER_FD_ENV]))
+    if env.get(WORKER_REUSE_PORT_ENV):
+        return create_listen_socket(options.bind, options.port, reuse_port=True)
+    return None
+
+def is_worker(env: Dict[str, str]) -> bool:
+    """
+    Has this process been started by WorkerSupervisor?
+    """
+    return WORKER_FD_ENV in env or bool(env.get(WORKER_REUSE_PORT_ENV))
+
+
+class WorkerSupervisor:
+    """
+    Starts the worker processes and restarts any worker that exits.
+
+    SIGHUP performs a graceful reload: a new set of workers is started
+    and then each old worker is asked to stop (using SIGTERM), which
+    allows it to finish the requests that it is handling. SIGTERM or
+    SIGINT stops all of the workers.
+    """
+    MIN_UPTIME = 2.0
+    RESTART_DELAY = 1.0
+    STOP_TIMEOUT = 30.0
+
+    def __init__(self, options, argv: Optional[List[str]] = None,
+                 env: Optional[Dict[str, str]] = None) -> None:
+        self.options = options
+        if argv is None:
+            argv = sys.argv[1:]
+        self.argv = argv
+        if env is None:
+            env = os.environ.copy()
+        self.env = env
+        self.sock: Optional[socket.socket] = None
+        self.workers: Dict[int, subprocess.Popen] = {}
+        self.started: Dict[int, float] = {}
+        self.running = False
+        self.reload_requested = False
+        self.restarts = 0
+
+    def run(self) -> None:
+        """
+        Run the workers until SIGTERM or SIGINT is received
+        """
+        self.running = True
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        if not self.options.reuse_port:
+            self.sock = create_listen_socket(self.options.bind, self.options.port)
+        try:
+            for _ in range(self.options.workers):
+                self.spawn()
+            logging.info('Started %d workers on http://%s:%d/', self.options.workers,
+                         self.options.bind, self.options.port)
+            while self.running:
+                time.sleep(0.5)
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                self.reap()
+        finally:
+            self.stop_workers(list(self.workers.values()))
+            self.workers = {}
+            if self.sock is not None:
+                self.sock.close()
+
+    def spawn(self) -> subprocess.Popen:
+        """
+        Start one worker process
+        """
+        env = dict(self.env)
+        pass_fds = []
+        if self.sock is not None:
+            env[WORKER_FD_ENV] = str(self.sock.fileno())
+            pass_fds.append(self.sock.fileno())
+        else:
+            env[WORKER_REUSE_PORT_ENV] = '1'
+        proc = subprocess.Popen([sys.executable, '-m', 'pyproxy.proxy'] + self.argv,
+                                env=env, pass_fds=pass_fds)
+        self.workers[proc.pid] = proc
+        self.started[proc.pid] = time.monotonic()
+        logging.debug('Started worker %d', proc.pid)
+        return proc
+
+    def reap(self) -> None:
+        """
+        Restart any worker that has exited
+        """
+        for pid, proc in list(self.workers.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            del self.workers[pid]
+            uptime = time.monotonic() - self.started.pop(pid, 0)
+            if not self.running:
+                continue
+            logging.warning('Worker %d exited with code %d, restarting', pid, code)
+            if uptime < self.MIN_UPTIME:
+                # avoid a tight loop if the worker fails during start-up
+                time.sleep(self.RESTART_DELAY)
+            self.restarts += 1
+            self.spawn()
+
+    def reload(self) -> None:
+        """
+        Replace every worker with a new worker process
+        """
+        logging.info('Reloading workers')
+        old = list(self.workers.values())
+        self.workers = {}
+        for _ in range(self.options.workers):
+            self.spawn()
+        self.stop_workers(old)
+
+    def stop_workers(self, workers: List[subprocess.Popen]) -> None:
+        """
+        Ask the workers to stop, and kill any that do not stop in time
+        """
+        for proc in workers:
+            if proc.poll() is None:
+                proc.terminate()
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for proc in workers:
+            try:
+                proc.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.warning('Worker %d did not stop, killing it', proc.pid)
+                proc.kill()
+                proc.wait()
+            self.started.pop(proc.pid, None)
+
+    def _on_reload(self, signum, frame) -> None:
+        # pylint: disable=unused-argument
+        self.reload_requested = True
+
+    def _on_stop(self, signum, frame) -> None:
+        # pylint: disable=unused-argument
+        self.running = False
@@ -0,0 +1,64 @@
+"""
+Helpers to send responses to a client socket without copying the
+response body, using gather writes (sendmsg) and sendfile.
+"""
+from collections import deque
+import os
+import socket
+from typing import BinaryIO, Deque, Iterable, Optional
+
+# pylint: disable=relative-beyond-top-level
+from shared_code.isobmff import Buffer
+
+def _iov_max() -> int:
+    """
+    The maximum number of buffers that can be passed to one sendmsg() call
+    """
+    try:
+        return max(16, os.sysconf('SC_IOV_MAX'))
+    except (AttributeError, ValueError, OSError):
+        return 1024
+
+IOV_MAX = _iov_max()
+
+def send_buffers(sock: socket.socket, buffers: Iterable[Buffer]) -> int:
+    """
+    Write a sequence of buffers to a socket, using sendmsg() so that
+    many buffers are written by one system call (like writev()) without
+    joining them together. Returns the number of bytes sent.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        total = 0
+        for buf in buffers:
+            sock.sendall(buf)
+            total += len(buf)
+        return total
+    pending: Deque[memoryview] = deque()
+    for buf in buffers:
+        if len(buf):
+            pending.append(memoryview(buf).cast('B'))
+    total = 0
+    while pending:
+        batch = [pending[idx] for idx in range(min(len(pending), IOV_MAX))]
+        sent = sock.sendmsg(batch)
+        total += sent
+        # remove the buffers that have been completely sent, and the
+        # start of a buffer that has been partially sent
+        while sent:
+            head = pending[0]
+            if sent >= len(head):
+                sent -= len(head)
+                pending.popleft()
+            else:
+                pending[0] = head[sent:]
+                sent = 0
+    return total
+
+def send_file(sock: socket.socket, fileobj: BinaryIO, offset: int = 0,
+              count: Optional[int] = None) -> int:
+    """
+    Send part of a file to a socket. Uses os.sendfile() where it is
+    available, so that the data is copied by the kernel without passing
+    through this process. Returns the number of bytes sent.
+    """
+    return sock.sendfile(fileobj, offset, count)
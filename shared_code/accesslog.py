@@ -0,0 +1,173 @@
+"""
+A structured access log, that has one JSON object per line for each
+request. The request handlers add a record to a bounded queue, and a
+background thread writes the queued records to the log file in batches,
+so that logging a request never waits for the file to be written. If
+the queue is full the record is dropped, rather than slowing down the
+request.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from .pipeline import OriginRequest
+
+# The cache outcomes of a request
+CACHE_HIT = 'hit'                   # the response came from the cache
+CACHE_MISS = 'miss'                 # the response came from origin
+CACHE_REVALIDATED = 'revalidated'   # origin confirmed that the cached response is current
+CACHE_COALESCED = 'coalesced'       # shared the origin request of another request
+CACHE_BYPASS = 'bypass'             # a Range request, which does not use the cache
+
+
+class AccessRecord:
+    """
+    The details of one request that are written to the access log. The
+    transport fills in the fields while it handles the request.
+    """
+    __slots__ = ('time', 'started', 'method', 'route', 'url', 'status', 'bytes',
+                 'origin_ttfb', 'latency', 'cache', 'piff_boxes')
+
+    def __init__(self, method: str) -> None:
+        self.time = time.time()
+        self.started = time.perf_counter()
+        self.method = method
+        self.route = 'other'
+        self.url: Optional[str] = None  # the decoded origin URL
+        self.status = 0
+        self.bytes = 0
+        self.origin_ttfb: Optional[float] = None
+        self.latency = 0.0
+        self.cache: Optional[str] = None
+        self.piff_boxes = 0
+
+    def origin_response(self, origin: "OriginRequest", status_code: int, ttfb: float) -> None:
+        """
+        Record the time taken to receive the headers of the origin response
+        """
+        self.origin_ttfb = ttfb
+        if origin.entry is not None and status_code == 304:
+            self.cache = CACHE_REVALIDATED
+        elif self.cache is None:
+            self.cache = CACHE_MISS
+
+    def finished(self, route: str, status_code: int) -> None:
+        """
+        Called once the response has been sent
+        """
+        self.latency = time.perf_counter() - self.started
+        self.route = route
+        self.status = status_code
+
+    def to_json(self) -> str:
+        """
+        The line of the access log for this request
+        """
+        ttfb: Optional[float] = None
+        if self.origin_ttfb is not None:
+            ttfb = round(self.origin_ttfb, 6)
+        return json.dumps({
+            'time': round(self.time, 3), 'method': self.method, 'route': self.route,
+            'url': self.url, 'status': self.status, 'bytes': self.bytes,
+            'origin_ttfb': ttfb, 'latency': round(self.latency, 6), 'cache': self.cache,
+            'piff_boxes': self.piff_boxes}) + '\n'
+
+
+class AccessLog:
+    """
+    Writes access records to a file using a background thread
+    """
+
+    def __init__(self, path: str, max_queue: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 1.0) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Each batch is written using one unbuffered write() to a file
+        # opened with O_APPEND, so that the batches written by the worker
+        # processes do not interleave with each other
+        self.out = open(path, 'ab', buffering=0) # pylint: disable=consider-using-with
+        self.queue: "queue.Queue[Optional[AccessRecord]]" = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.counters = dict(written=0, dropped=0, batches=0, errors=0)
+        self.thread = threading.Thread(target=self.run, name='access-log', daemon=True)
+        self.thread.start()
+
+    def log(self, record: AccessRecord) -> None:
+        """
+        Add a record to the queue of records to write, without blocking
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.counters['dropped'] += 1
+
+    def run(self) -> None:
+        """
+        Write the queued records, until close() is called. This is called
+        by the background thread.
+        """
+        while True:
+            batch = self.next_batch()
+            records = [record for record in batch if record is not None]
+            if records:
+                self.write(records)
+            if len(records) < len(batch):
+                return
+
+    def next_batch(self) -> List[Optional[AccessRecord]]:
+        """
+        Wait for the next record, then for up to flush_interval seconds
+        for more records to write with it. The batch ends with None if
+        close() has been called.
+        """
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, records: List[AccessRecord]) -> None:
+        """
+        Append a batch of records to the log file
+        """
+        data = ''.join([record.to_json() for record in records]).encode('utf-8')
+        try:
+            self.out.write(data)
+        except OSError as err:
+            logging.warning('Failed to write access log %s: %s', self.path, err)
+            with self.lock:
+                self.counters['errors'] += 1
+            return
+        with self.lock:
+            self.counters['written'] += len(records)
+            self.counters['batches'] += 1
+
+    def close(self) -> None:
+        """
+        Write the records that are in the queue and close the log file
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.out.close()
+
+    def stats(self) -> Dict:
+        """
+        The number of records written, queued and dropped
+        """
+        with self.lock:
+            result = dict(self.counters)
+        result['queued'] = self.queue.qsize()
+        return result
@@ -0,0 +1,358 @@
+"""
+Admission control of origin requests. The number of concurrent requests
+to each origin host is limited, and the requests over the limit wait in
+a bounded queue. New requests also wait while the combined size of the
+origin responses that are in flight is over a budget. A request that
+cannot be queued, or that waits for too long, is rejected so that the
+proxy can quickly respond with 503 Service Unavailable, rather than
+overloading origin and running out of memory.
+"""
+from collections import deque
+import os
+import threading
+from typing import Callable, Deque, Dict, Mapping, Optional, Union
+import urllib.parse
+
+class Overloaded(Exception):
+    """
+    An origin request was rejected by admission control
+    """
+
+    def __init__(self, host: str, reason: str, retry_after: int) -> None:
+        super().__init__(f'Too many requests to {host} ({reason})')
+        self.host = host
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    Permission to make one origin request. It must be released once the
+    origin response has been sent to the client, either by calling
+    release() or by using the ticket as a context manager.
+    """
+    __slots__ = ['control', 'host', 'size', 'released', 'linked']
+
+    def __init__(self, control: "AdmissionControl", host: str, size: int) -> None:
+        self.control = control
+        self.host = host
+        self.size = size
+        self.released = False
+        self.linked: Optional[Ticket] = None
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+    def response_started(self, headers: Mapping[str, str]) -> None:
+        """
+        Count the body of the origin response against the in-flight budget,
+        instead of the expected size that was used to admit the request
+        """
+        try:
+            size = int(headers['Content-Length'])
+        except (KeyError, ValueError):
+            return
+        self.control.resize(self, size)
+
+    def attach(self, other: "Ticket") -> None:
+        """
+        Keep another ticket until this ticket is released, such as the
+        ticket of the hedged request whose response is sent to the client.
+        The response body is only counted against the in-flight budget by
+        this ticket.
+        """
+        self.control.resize(other, 0, learn=False)
+        if self.linked is not None:
+            self.linked.release()
+        self.linked = other
+
+    def release(self) -> None:
+        """
+        Allow the next waiting request to be made
+        """
+        self.control.release(self)
+        if self.linked is not None:
+            self.linked.release()
+
+
+class Waiter:
+    """
+    A request that is waiting to be admitted. "wake" is called, with the
+    lock held, once the request has been given a ticket.
+    """
+    __slots__ = ['host', 'wake', 'ticket']
+
+    def __init__(self, host: str, wake: Callable[[], None]) -> None:
+        self.host = host
+        self.wake = wake
+        self.ticket: Optional[Ticket] = None
+
+
+class HostState:
+    """
+    The active and waiting requests of one origin host
+    """
+    __slots__ = ['active', 'waiters']
+
+    def __init__(self) -> None:
+        self.active = 0
+        self.waiters: Deque[Waiter] = deque()
+
+
+class AdmissionControl:
+    """
+    Limits the concurrent origin requests to each origin host and the
+    size of the origin responses that are in flight. A limit of 0 means
+    that there is no limit.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, max_active: int = 64, max_queue: int = 256,
+                 queue_timeout: float = 5.0, max_bytes: int = 0,
+                 retry_after: int = 1) -> None:
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_bytes = max_bytes
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.hosts: Dict[str, HostState] = {}
+        self.inflight_bytes = 0
+        # the average size of the origin responses, which is reserved from
+        # the in-flight budget until the size of a response is known
+        self.expected_size = 0.0
+        self.queued = 0
+        self.counters = dict(admitted=0, waited=0, rejected_queue_full=0, rejected_timeout=0,
+                             rejected_hedges=0, peak_queued=0)
+
+    @classmethod
+    def from_environment(cls, env: Optional[Dict] = None) -> "AdmissionControl":
+        """
+        Create the admission control using the DASHPIFF_ORIGIN_CONCURRENCY,
+        DASHPIFF_ORIGIN_QUEUE, DASHPIFF_ORIGIN_QUEUE_TIMEOUT and
+        DASHPIFF_INFLIGHT_MB environment variables
+        """
+        if env is None:
+            env = os.environ
+        return cls(max_active=int(env.get('DASHPIFF_ORIGIN_CONCURRENCY', 64)),
+                   max_queue=int(env.get('DASHPIFF_ORIGIN_QUEUE', 256)),
+                   queue_timeout=float(env.get('DASHPIFF_ORIGIN_QUEUE_TIMEOUT', 5.0)),
+                   max_bytes=int(env.get('DASHPIFF_INFLIGHT_MB', 512)) * 1024 * 1024)
+
+    @staticmethod
+    def host_of(url: str) -> str:
+        """
+        The scheme, host and port of an origin URL
+        """
+        scheme, netloc = urllib.parse.urlsplit(url)[:2]
+        return f'{scheme}://{netloc}'
+
+    def admit(self, url: str) -> Ticket:
+        """
+        Wait until a request to the origin of the given URL can be made.
+        Raises Overloaded if the request is rejected.
+        """
+        event = threading.Event()
+        result = self.begin(self.host_of(url), event.set)
+        if isinstance(result, Ticket):
+            return result
+        event.wait(self.queue_timeout)
+        return self.wait_finished(result)
+
+    async def admit_async(self, url: str) -> Ticket:
+        """
+        Asynchronous version of admit()
+        """
+        # asyncio is only imported by the asyncio server, as importing it
+        # slows down the cold start of the Azure functions
+        # pylint: disable=import-outside-toplevel
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        result = self.begin(self.host_of(url), wake)
+        if isinstance(result, Ticket):
+            return result
+        try:
+            await asyncio.wait([future], timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            # the client has gone, so the place in the queue is not needed
+            ticket = self.dequeue(result)
+            if ticket is not None:
+                ticket.release()
+            raise
+        return self.wait_finished(result)
+
+    def try_admit(self, url: str) -> Optional[Ticket]:
+        """
+        Admit a request only if it can be made without waiting, such as a
+        hedged request, which is not worth making if the origin host is
+        already busy. Returns None if the request is not admitted.
+        """
+        host = self.host_of(url)
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = HostState()
+                self.hosts[host] = state
+            if not state.waiters and self.has_capacity(state):
+                return self.grant(host, state)
+            self.counters['rejected_hedges'] += 1
+            self.remove_idle(host, state)
+        return None
+
+    def begin(self, host: str, wake: Callable[[], None]) -> Union[Ticket, Waiter]:
+        """
+        Admit a request if there is capacity and no other request is
+        waiting, otherwise add it to the queue
+        """
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = HostState()
+                self.hosts[host] = state
+            if not state.waiters and self.has_capacity(state):
+                return self.grant(host, state)
+            if self.max_queue and self.queued >= self.max_queue:
+                self.counters['rejected_queue_full'] += 1
+                self.remove_idle(host, state)
+                raise Overloaded(host, 'queue full', self.retry_after)
+            waiter = Waiter(host, wake)
+            state.waiters.append(waiter)
+            self.queued += 1
+            self.counters['waited'] += 1
+            self.counters['peak_queued'] = max(self.counters['peak_queued'], self.queued)
+            return waiter
+
+    def wait_finished(self, waiter: Waiter) -> Ticket:
+        """
+        Called when a waiting request has been woken or has timed out
+        """
+        ticket = self.dequeue(waiter)
+        if ticket is not None:
+            return ticket
+        with self.lock:
+            self.counters['rejected_timeout'] += 1
+        raise Overloaded(waiter.host, 'timed out in queue', self.retry_after)
+
+    def dequeue(self, waiter: Waiter) -> Optional[Ticket]:
+        """
+        Stop waiting, returning the ticket if the request was admitted
+        """
+        with self.lock:
+            if waiter.ticket is not None:
+                return waiter.ticket
+            state = self.hosts.get(waiter.host)
+            if state is not None and waiter in state.waiters:
+                state.waiters.remove(waiter)
+                self.queued -= 1
+                self.remove_idle(waiter.host, state)
+        return None
+
+    def release(self, ticket: Ticket) -> None:
+        """
+        Release the capacity used by a request, and admit the waiting
+        requests that can now be made
+        """
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self.inflight_bytes -= ticket.size
+            state = self.hosts[ticket.host]
+            state.active -= 1
+            self.admit_waiters()
+            self.remove_idle(ticket.host, state)
+
+    def resize(self, ticket: Ticket, size: int, learn: bool = True) -> None:
+        """
+        Replace the expected size of a response with its actual size. The
+        average response size is only updated if "learn" is True.
+        """
+        with self.lock:
+            if ticket.released:
+                return
+            self.inflight_bytes += size - ticket.size
+            ticket.size = size
+            if learn and self.expected_size:
+                self.expected_size += (size - self.expected_size) / 8.0
+            elif learn:
+                self.expected_size = float(size)
+            self.admit_waiters()
+
+    def admit_waiters(self) -> None:
+        """
+        Admit the waiting requests that can now be made. The lock must be
+        held by the caller.
+        """
+        # the in-flight budget is shared by every origin host
+        for host, state in list(self.hosts.items()):
+            while state.waiters and self.has_capacity(state):
+                waiter = state.waiters.popleft()
+                self.queued -= 1
+                waiter.ticket = self.grant(host, state)
+                waiter.wake()
+
+    def has_capacity(self, state: HostState) -> bool:
+        """
+        Check if another request can be made. The lock must be held by
+        the caller.
+        """
+        if self.max_active and state.active >= self.max_active:
+            return False
+        return not self.max_bytes or self.inflight_bytes < self.max_bytes
+
+    def grant(self, host: str, state: HostState) -> Ticket:
+        """
+        Create the ticket of an admitted request. The lock must be held
+        by the caller.
+        """
+        state.active += 1
+        self.counters['admitted'] += 1
+        size = int(self.expected_size)
+        self.inflight_bytes += size
+        return Ticket(self, host, size)
+
+    def remove_idle(self, host: str, state: HostState) -> None:
+        """
+        Forget a host that has no active or waiting requests. The lock
+        must be held by the caller.
+        """
+        if not state.active and not state.waiters:
+            self.hosts.pop(host, None)
+
+    def stats(self) -> Dict:
+        """
+        The number of active and queued requests to each origin host, and
+        the number of requests that have been rejected
+        """
+        with self.lock:
+            hosts = {host: {'active': state.active, 'queued': len(state.waiters)}
+                     for host, state in self.hosts.items()}
+            result = dict(self.counters)
+            result.update(active=sum([state.active for state in self.hosts.values()]),
+                          queued=self.queued, inflight_bytes=self.inflight_bytes,
+                          max_bytes=self.max_bytes, hosts=hosts)
+        return result
+
+
+_admission_lock = threading.Lock()
+_admission: Optional[AdmissionControl] = None
+
+def admission_control() -> AdmissionControl:
+    """
+    Get the admission control that is shared by the Azure functions of
+    this worker process, creating it from the environment settings
+    """
+    global _admission # pylint: disable=global-statement
+    with _admission_lock:
+        if _admission is None:
+            _admission = AdmissionControl.from_environment()
+        return _admission
@@ -0,0 +1,89 @@
+"""
+Wrapping a batch of manifest URLs using one request to the create
+route. The request body is either a JSON array, or newline delimited
+JSON (NDJSON) with one manifest URL on each line. Each item is a URL,
+or an object with a "url" field. The response has one result for each
+item, in the same order and using the same format as the request. A
+result is either {"url": <wrapped URL>} or {"error": <reason>}, so
+that an invalid item does not fail the whole batch.
+
+The response body is created as it is sent, in chunks of
+BATCH_CHUNK_ITEMS results.
+"""
+import json
+from typing import Iterator, List, Optional, Union
+import urllib.parse
+
+from .manifest import prefix_manifest_url
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# The number of results in each chunk of the response body
+BATCH_CHUNK_ITEMS = 1000
+
+BatchItem = Union[bytes, str, dict]
+
+def is_ndjson(content_type: str) -> bool:
+    """
+    Is the content type one of the names used for newline delimited JSON
+    """
+    return any([name in content_type for name in ('ndjson', 'jsonl', 'json-lines')])
+
+def batch_items(content_type: str, body: Optional[bytes]) -> Optional[List[BatchItem]]:
+    """
+    The items of a batch request, or None if the request is for one URL.
+    Raises ValueError if the body of a JSON batch is invalid.
+    """
+    if not body:
+        return None
+    if is_ndjson(content_type):
+        # each line is parsed by wrap_item(), so that an invalid line
+        # only fails that item
+        return [line for line in body.split(b'\n') if line.strip()]
+    if 'json' not in content_type or not body.lstrip().startswith(b'['):
+        return None
+    items = json.loads(body)
+    if not isinstance(items, list):
+        raise ValueError('Expected a JSON array')
+    return items
+
+def wrap_item(item: BatchItem, prefix: str) -> dict:
+    """
+    The result of wrapping one item of a batch
+    """
+    if isinstance(item, bytes):
+        try:
+            text = str(item, 'utf-8').strip()
+            item = json.loads(text) if text[0] in '"{' else text
+        except ValueError as err:
+            return {'error': f'Invalid line: {err}'}
+    if isinstance(item, dict):
+        item = item.get('url')
+    if not isinstance(item, str):
+        return {'error': 'Field "url" is required'}
+    try:
+        parts = urllib.parse.urlparse(item)
+    except ValueError as err:
+        return {'error': f'Invalid URL: {err}'}
+    if parts.scheme not in {'http', 'https'} or not parts.netloc:
+        return {'error': 'Not an http or https URL'}
+    return {'url': prefix_manifest_url(parts, prefix)}
+
+def wrap_batch(items: List[BatchItem], prefix: str, ndjson: bool) -> Iterator[bytes]:
+    """
+    Generator that creates the response body of a batch request
+    """
+    separator = '\n' if ndjson else ',\n'
+    if not ndjson:
+        yield b'[\n'
+    for start in range(0, len(items), BATCH_CHUNK_ITEMS):
+        results = [json.dumps(wrap_item(item, prefix))
+                   for item in items[start:start + BATCH_CHUNK_ITEMS]]
+        chunk = separator.join(results)
+        if ndjson:
+            chunk += '\n'
+        elif start + BATCH_CHUNK_ITEMS < len(items):
+            chunk += separator
+        yield bytes(chunk, 'utf-8')
+    if not ndjson:
+        yield b'\n]\n'
@@ -0,0 +1,462 @@
+"""
+In-memory caches of patched media segments and rewritten manifests,
+that follow the HTTP freshness rules of the origin responses
+"""
+from collections import OrderedDict
+import email.utils
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, Mapping, Optional
+import urllib.parse
+
+from .compression import compress
+from .isobmff import Buffer
+
+if TYPE_CHECKING:
+    from requests.structures import CaseInsensitiveDict
+
+def cache_key(url: str, params: Optional[Dict]) -> str:
+    """
+    Create a cache key from the decoded origin URL and the query
+    parameters that will be passed to origin
+    """
+    if not params:
+        return url
+    query = '&'.join([f'{key}={value}' for key, value in sorted(params.items())])
+    return f'{url}?{query}'
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """
+    Parse a Cache-Control header into a dictionary of directives
+    """
+    directives: Dict[str, Optional[str]] = {}
+    if not value:
+        return directives
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            name, arg = item.split('=', 1)
+            directives[name.strip().lower()] = arg.strip().strip('"')
+        else:
+            directives[item.lower()] = None
+    return directives
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    """
+    Convert an HTTP date into a UNIX timestamp
+    """
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def freshness_lifetime(headers: Mapping[str, str], now: float,
+                       ttl_hint: Optional[float] = None) -> Optional[float]:
+    """
+    Calculate how many seconds a response can be cached for, using the
+    Cache-Control, Expires, Date and Age headers of the origin response.
+    If ttl_hint is provided, it is used when origin does not provide a
+    lifetime and as an upper limit when it does.
+    Returns None if the response must not be stored.
+    """
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    lifetime: Optional[float] = None
+    if 'no-cache' in directives:
+        lifetime = 0
+    else:
+        for name in ['s-maxage', 'max-age']:
+            try:
+                lifetime = float(directives[name])
+                break
+            except (KeyError, TypeError, ValueError):
+                pass
+    if lifetime is None:
+        expires = parse_http_date(headers.get('Expires'))
+        if expires is None:
+            if 'Expires' in headers:
+                # an invalid Expires header means "already expired"
+                lifetime = 0
+            elif ttl_hint is None:
+                return None
+            else:
+                return max(0.0, ttl_hint)
+        else:
+            date = parse_http_date(headers.get('Date'))
+            lifetime = expires - (now if date is None else date)
+    try:
+        lifetime -= float(headers.get('Age', 0))
+    except ValueError:
+        pass
+    if ttl_hint is not None:
+        lifetime = min(lifetime, ttl_hint)
+    return max(0.0, lifetime)
+
+def etag_matches(etag: Optional[str], if_none_match: str) -> bool:
+    """
+    Weak comparison of an ETag with the value of an If-None-Match header
+    """
+    if if_none_match.strip() == '*':
+        return etag is not None
+    if etag is None:
+        return False
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+class CacheEntry:
+    """
+    One cached origin response
+    """
+    __slots__ = ['key', 'status_code', 'mimetype', 'headers', 'body',
+                 'stored', 'expires', 'ttl_hint', 'variants']
+
+    def __init__(self, key: str, status_code: int, mimetype: str,
+                 headers: Mapping[str, str], body: bytes, lifetime: float,
+                 ttl_hint: Optional[float] = None) -> None:
+        # importing requests is slow, so it is left until the first
+        # response is cached
+        # pylint: disable=import-outside-toplevel
+        from requests.structures import CaseInsensitiveDict
+
+        self.key = key
+        self.status_code = status_code
+        self.mimetype = mimetype
+        self.headers = CaseInsensitiveDict(headers)
+        self.body = body
+        self.stored = time.time()
+        self.expires = self.stored + lifetime
+        self.ttl_hint = ttl_hint
+        # the body compressed using each content encoding
+        self.variants: Dict[str, bytes] = {}
+
+    @property
+    def size(self) -> int:
+        """
+        Number of bytes used by this entry
+        """
+        return len(self.body) + sum([len(body) for body in self.variants.values()])
+
+    @property
+    def etag(self) -> Optional[str]:
+        """
+        The ETag validator of the origin response
+        """
+        return self.headers.get('ETag')
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        """
+        The Last-Modified validator of the origin response
+        """
+        return self.headers.get('Last-Modified')
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        """
+        Can this entry be used without revalidating with origin?
+        """
+        if now is None:
+            now = time.time()
+        return now < self.expires
+
+    def validators(self) -> Dict[str, str]:
+        """
+        The HTTP headers needed to make a conditional request to origin
+        """
+        headers: Dict[str, str] = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def refresh(self, headers: Mapping[str, str]) -> bool:
+        """
+        Update the entry after a 304 Not Modified response from origin.
+        Returns False if the entry can no longer be cached.
+        """
+        for name in ['Cache-Control', 'Expires', 'Date', 'ETag', 'Last-Modified']:
+            if name in headers:
+                self.headers[name] = headers[name]
+        self.headers.pop('Age', None)
+        self.stored = time.time()
+        lifetime = freshness_lifetime(self.headers, self.stored, self.ttl_hint)
+        self.expires = self.stored + (lifetime or 0)
+        return lifetime is not None
+
+    def response_headers(self) -> "CaseInsensitiveDict":
+        """
+        The HTTP headers to use when responding from the cache
+        """
+        headers = self.headers.copy()
+        try:
+            age = float(headers.get('Age', 0))
+        except ValueError:
+            age = 0
+        headers['Age'] = str(int(age + time.time() - self.stored))
+        return headers
+
+    def not_modified(self, request_headers: Mapping[str, str]) -> bool:
+        """
+        Check if the client already has this version of the response
+        """
+        return is_not_modified(request_headers, self.etag, self.last_modified)
+
+def is_not_modified(request_headers: Mapping[str, str], etag: Optional[str],
+                    last_modified: Optional[str]) -> bool:
+    """
+    Check the If-None-Match and If-Modified-Since headers of a client
+    request against the validators of a response
+    """
+    if_none_match = request_headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag_matches(etag, if_none_match)
+    since = parse_http_date(request_headers.get('If-Modified-Since'))
+    modified = parse_http_date(last_modified)
+    if since is None or modified is None:
+        return False
+    return modified <= since
+
+
+class SegmentCache:
+    """
+    A thread-safe least-recently-used cache with a limit on the total
+    number of bytes used by the cached responses
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: Optional[int] = None) -> None:
+        self.max_bytes = max_bytes
+        if max_entry_bytes is None:
+            max_entry_bytes = max_bytes // 8
+        self.max_entry_bytes = max_entry_bytes
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """
+        Find an entry in the cache. The returned entry might be stale.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def peek(self, key: str) -> Optional[CacheEntry]:
+        """
+        Find an entry in the cache, without changing its position in the
+        LRU order or the hit statistics
+        """
+        with self.lock:
+            return self.entries.get(key)
+
+    @staticmethod
+    def cacheable(status_code: int, headers: Mapping[str, str],
+                  ttl_hint: Optional[float] = None) -> bool:
+        """
+        Check if the HTTP headers of an origin response allow it to be cached
+        """
+        if status_code != 200:
+            return False
+        lifetime = freshness_lifetime(headers, time.time(), ttl_hint)
+        if lifetime is None:
+            return False
+        # an entry that is always stale is only useful if it can be revalidated
+        return lifetime > 0 or 'ETag' in headers or 'Last-Modified' in headers
+
+    def put(self, key: str, status_code: int, mimetype: str, headers: Mapping[str, str],
+            body: bytes, ttl_hint: Optional[float] = None) -> Optional[CacheEntry]:
+        """
+        Store a response, if its HTTP headers allow it to be cached
+        """
+        if (len(body) > self.max_entry_bytes or
+                not self.cacheable(status_code, headers, ttl_hint)):
+            return None
+        lifetime = freshness_lifetime(headers, time.time(), ttl_hint)
+        entry = CacheEntry(key, status_code, mimetype, headers, body, lifetime, ttl_hint)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old.size
+            self.entries[key] = entry
+            self.total_bytes += entry.size
+            while self.total_bytes > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+                self.evictions += 1
+        return entry
+
+    def remove(self, key: str) -> None:
+        """
+        Remove an entry from the cache
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry.size
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Cache usage statistics
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class ManifestCache(SegmentCache):
+    """
+    A cache of rewritten manifests. The rewritten manifest contains URLs
+    that point to the proxy, so the same origin manifest has a separate
+    entry for each host name that is used to access the proxy.
+    """
+
+    @classmethod
+    def from_environment(cls, env: Optional[Dict] = None) -> "ManifestCache":
+        """
+        Create a manifest cache using the DASHPIFF_MANIFEST_CACHE_MB
+        environment variable, such as an application setting of an
+        Azure function. A size of 0 disables the cache.
+        """
+        if env is None:
+            env = os.environ
+        return cls(int(env.get('DASHPIFF_MANIFEST_CACHE_MB', 16)) * 1024 * 1024)
+
+    def __init__(self, max_bytes: int, max_entry_bytes: Optional[int] = None) -> None:
+        super().__init__(max_bytes, max_entry_bytes)
+        self.compressed = 0
+        self.compressed_hits = 0
+
+    def encoded_body(self, entry: CacheEntry, encoding: str) -> bytes:
+        """
+        The body of an entry compressed using the given content encoding.
+        The compressed body is kept with the entry, so that each version
+        of a manifest is only compressed once for each encoding.
+        """
+        body = entry.variants.get(encoding)
+        if body is not None:
+            with self.lock:
+                self.compressed_hits += 1
+            return body
+        body = compress(entry.body, encoding)
+        with self.lock:
+            self.compressed += 1
+            if encoding in entry.variants:
+                return entry.variants[encoding]
+            entry.variants[encoding] = body
+            if self.entries.get(entry.key) is entry:
+                self.total_bytes += len(body)
+                while self.total_bytes > self.max_bytes and self.entries:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.total_bytes -= evicted.size
+                    self.evictions += 1
+        return body
+
+    def stats(self) -> Dict[str, int]:
+        result = super().stats()
+        with self.lock:
+            result['compressed'] = self.compressed
+            result['compressed_hits'] = self.compressed_hits
+        return result
+
+    @staticmethod
+    def manifest_key(url: str, params: Optional[Dict], request_url: str) -> str:
+        """
+        Create a cache key from the decoded origin URL, the query parameters
+        that will be passed to origin and the URL used to access the proxy
+        """
+        netloc = urllib.parse.urlparse(request_url).netloc
+        return f'{netloc} {cache_key(url, params)}'
+
+
+class CacheWriter:
+    """
+    Collects the chunks of a response as they are sent to the client,
+    giving up once the response becomes too large to be cached. If the
+    length of the response is known, each chunk is copied into one
+    buffer as it passes through, so that the chunks from origin are not
+    kept and the body does not need to be joined together at the end.
+    """
+
+    def __init__(self, max_bytes: int, content_length: Optional[int] = None) -> None:
+        self.max_bytes = max_bytes
+        self.parts: Optional[List[Buffer]] = []
+        self.buffer: Optional[bytearray] = None
+        if content_length is not None:
+            if content_length > max_bytes:
+                self.parts = None
+            else:
+                self.buffer = bytearray(content_length)
+        self.size = 0
+        self.complete = False
+
+    def record(self, chunk: Buffer) -> None:
+        """
+        Record the next chunk of the response
+        """
+        if self.parts is None:
+            return
+        start = self.size
+        self.size += len(chunk)
+        if self.buffer is not None and self.size <= len(self.buffer):
+            self.buffer[start:self.size] = chunk
+        elif self.buffer is None and self.size <= self.max_bytes:
+            # the chunks are never modified once they have been sent to
+            # the client, so there is no need to copy them
+            self.parts.append(chunk)
+        else:
+            self.parts = None
+            self.buffer = None
+
+    def finish(self) -> None:
+        """
+        Mark the response as complete
+        """
+        self.complete = True
+
+    def tee(self, chunks: Iterable[Buffer]) -> Iterable[Buffer]:
+        """
+        Generator that records each chunk as it is passed through
+        """
+        for chunk in chunks:
+            self.record(chunk)
+            yield chunk
+        self.finish()
+
+    def body(self) -> Optional[Buffer]:
+        """
+        The complete body, or None if it was too large to record
+        """
+        if self.parts is None or not self.complete:
+            return None
+        if self.buffer is not None:
+            # a response that is shorter than its Content-Length is not cached
+            return self.buffer if self.size == len(self.buffer) else None
+        return b''.join(self.parts)
@@ -0,0 +1,115 @@
+"""
+Compression of the rewritten manifests sent to clients, using a content
+encoding that the client accepts. Brotli is only used if the optional
+brotli package is installed.
+"""
+import gzip
+import time
+from typing import Dict, List, Mapping, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from . import metrics
+
+# Responses smaller than this are sent uncompressed
+MIN_COMPRESS_BYTES = 1024
+
+GZIP_LEVEL = 6
+
+# Brotli's highest qualities are far too slow for large live manifests
+BROTLI_QUALITY = 5
+
+# In order of preference
+SUPPORTED_ENCODINGS: List[str] = (['br'] if brotli is not None else []) + ['gzip']
+
+# The Accept-Encoding header of origin manifest requests, which must only
+# list the encodings that the requests library is able to decode
+ORIGIN_ACCEPT_ENCODING = ', '.join(['gzip', 'deflate'] + (['br'] if brotli is not None else []))
+
+# The Accept-Encoding header of origin media requests. Media segments are
+# already compressed, so are always sent uncompressed.
+MEDIA_ACCEPT_ENCODING = 'identity'
+
+COMPRESSIBLE_MIMETYPES = frozenset({'application/dash+xml', 'application/xml',
+                                    'application/json', 'text/xml'})
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Choose the content encoding to use for a client with the given
+    Accept-Encoding header. Returns None if the response should not be
+    compressed.
+    """
+    if not accept_encoding:
+        return None
+    qualities: Dict[str, float] = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            qualities[name] = quality
+    best: Optional[str] = None
+    best_quality = 0.0
+    for encoding in SUPPORTED_ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+def compressible(status_code: int, mimetype: str, size: int) -> bool:
+    """
+    Check if a response is worth compressing
+    """
+    return (status_code == 200 and size >= MIN_COMPRESS_BYTES and
+            (mimetype.split(';')[0].strip().lower() in COMPRESSIBLE_MIMETYPES or
+             mimetype.startswith('text/')))
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Compress a response body using the given content encoding
+    """
+    started = time.perf_counter()
+    if encoding == 'br':
+        result = brotli.compress(body, quality=BROTLI_QUALITY)
+    else:
+        result = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    metrics.record_stage('compress', time.perf_counter() - started)
+    return result
+
+def encoded_headers(headers: Mapping[str, str], encoding: Optional[str]) -> Dict[str, str]:
+    """
+    The HTTP headers of a response that might be compressed, which adds
+    Accept-Encoding to the Vary header. The ETag of a compressed response
+    is made weak, as the bytes differ from the origin response.
+    """
+    result = dict(headers)
+    vary = [name for name, value in result.items() if name.lower() == 'vary']
+    values = [item.strip() for name in vary for item in result.pop(name).split(',')]
+    if not any(value.lower() in {'accept-encoding', '*'} for value in values):
+        values.append('Accept-Encoding')
+    result['Vary'] = ', '.join([value for value in values if value])
+    if encoding is not None:
+        for name in list(result.keys()):
+            if name.lower() == 'etag' and not result[name].startswith('W/'):
+                result[name] = 'W/' + result[name]
+    return result
+
+def accept_encoding_headers(headers: Mapping[str, str], accept_encoding: str) -> Dict[str, str]:
+    """
+    Replace the Accept-Encoding header of a client request, before it is
+    used for an origin request
+    """
+    result = {name: value for name, value in headers.items()
+              if name.lower() != 'accept-encoding'}
+    result['Accept-Encoding'] = accept_encoding
+    return result
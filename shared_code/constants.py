@@ -3,8 +3,20 @@ Global constants
 """
 import binascii
 
-# HTTP headers to not copy from origin response
-EXCLUDED_HTTP_HEADERS = set({'content-length', 'connection'})
+# HTTP headers to not copy from origin response. The body of the origin
+# response has already been decompressed by the origin HTTP client, and
+# the framing and Content-Type headers are set by the proxy.
+EXCLUDED_HTTP_HEADERS = frozenset({'connection', 'content-encoding', 'content-length',
+    'content-type', 'date', 'if-modified-since', 'keep-alive', 'transfer-encoding'})
+
+# HTTP headers from the client request that only apply to the connection
+# between the client and the proxy, and are not copied to the origin request
+HOP_BY_HOP_HEADERS = frozenset({'connection', 'keep-alive', 'proxy-authenticate',
+    'proxy-authorization', 'proxy-connection', 'te', 'trailer', 'transfer-encoding',
+    'upgrade'})
+
+# HTTP headers that make a request conditional upon the cached version
+CONDITIONAL_HEADERS = frozenset({'if-none-match', 'if-modified-since'})
 
 # UUID of the sample encryption data used by the PIFF standard
 PIFF_UUID = binascii.a2b_hex("a2394f525a9b4f14a2446c427c648df4")
@@ -12,3 +24,9 @@ PIFF_UUID = binascii.a2b_hex("a2394f525a9b4f14a2446c427c648df4")
 # The "free" box type in UUID form. See section 11.1 of ISO 14496-12
 FREE_UUID = binascii.a2b_hex("6672656500110010800000AA00389B71")
 
+
+# ISO BMFF boxes that need to be descended into to find the PIFF boxes
+CONTAINER_BOXES = frozenset({b'moof', b'traf'})
+
+# Number of bytes to read from origin at a time when streaming media segments
+SEGMENT_CHUNK_SIZE = 64 * 1024
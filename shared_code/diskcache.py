@@ -0,0 +1,306 @@
+"""
+A cache of patched media segments that is stored on disk, so that it
+can be shared by all of the proxy processes on a host. Entries are read
+using mmap, so a segment that is in the page cache is served without
+being copied into each process.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+from .cache import CacheEntry, SegmentCache, freshness_lifetime
+
+# Each file starts with MAGIC and the length of the JSON metadata,
+# followed by the metadata and then the body of the response
+MAGIC = b'DPC1'
+FILE_HEADER = struct.Struct('>4sI')
+
+
+class DiskCacheEntry(CacheEntry):
+    """
+    A cached response whose body is a memoryview of a memory mapped file
+    """
+    __slots__ = ['cache', 'path', 'offset', 'inode']
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, cache: "DiskCache", path: str, meta: Dict, body: memoryview,
+                 offset: int, inode: Tuple[int, int]) -> None:
+        super().__init__(meta['key'], meta['status'], meta['mimetype'], meta['headers'],
+                         body, 0, meta.get('ttl_hint'))
+        self.stored = meta['stored']
+        self.expires = meta['expires']
+        self.cache = cache
+        self.path = path
+        self.offset = offset
+        self.inode = inode
+
+    def refresh(self, headers: Mapping[str, str]) -> bool:
+        """
+        Update the entry after a 304 Not Modified response from origin,
+        and save the new expiry time to disk
+        """
+        if not super().refresh(headers):
+            return False
+        self.cache.store(self.key, self.status_code, self.mimetype, self.headers,
+                         self.body, self.stored, self.expires, self.ttl_hint)
+        return True
+
+
+class DiskCache(SegmentCache):
+    """
+    A drop-in replacement for SegmentCache that stores each response in
+    its own file, named using a hash of the origin URL. Files are
+    written to a temporary file and then renamed, so other processes
+    never see a partly written entry.
+
+    Every process keeps its own index of the files, which is created by
+    scanning the directory. The modification time of a file is used as
+    its last access time, so that the least recently used files can be
+    removed by any process when the directory exceeds max_bytes.
+    """
+    TEMP_DIR = 'tmp'
+    SCAN_INTERVAL = 60.0
+    TOUCH_INTERVAL = 30.0
+    LOW_WATER_MARK = 0.9
+
+    def __init__(self, directory: str, max_bytes: int,
+                 max_entry_bytes: Optional[int] = None) -> None:
+        super().__init__(max_bytes, max_entry_bytes)
+        self.directory = directory
+        self.temp_dir = os.path.join(directory, self.TEMP_DIR)
+        self.index: Dict[str, Tuple[int, float]] = {}
+        self.last_scan = 0.0
+        self.writes = 0
+        self.scan()
+
+    def entry_path(self, key: str) -> str:
+        """
+        The name of the file used to store the given key
+        """
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def scan(self) -> None:
+        """
+        Rebuild the index from the files in the cache directory. Only the
+        directory entries are read, not the contents of the files.
+        """
+        index: Dict[str, Tuple[int, float]] = {}
+        total = 0
+        now = time.time()
+        # the directory might have been removed while the proxy is running
+        os.makedirs(self.temp_dir, exist_ok=True)
+        with os.scandir(self.directory) as top:
+            for subdir in top:
+                if not subdir.is_dir():
+                    continue
+                stale_temp = subdir.name == self.TEMP_DIR
+                with os.scandir(subdir.path) as files:
+                    for item in files:
+                        try:
+                            stat = item.stat()
+                            if stale_temp:
+                                # left behind by a process that was killed during a write
+                                if now - stat.st_mtime > 3600:
+                                    os.unlink(item.path)
+                                continue
+                        except FileNotFoundError:
+                            continue
+                        index[item.path] = (stat.st_size, stat.st_mtime)
+                        total += stat.st_size
+        with self.lock:
+            self.index = index
+            self.total_bytes = total
+            self.last_scan = time.monotonic()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """
+        Find an entry in the cache. The returned entry might be stale.
+        """
+        entry = self.read(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry
+
+    def peek(self, key: str) -> Optional[CacheEntry]:
+        """
+        Find an entry in the cache, without changing the hit statistics
+        """
+        return self.read(key)
+
+    def read(self, key: str) -> Optional[DiskCacheEntry]:
+        """
+        Memory map the file of an entry
+        """
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as src:
+                stat = os.fstat(src.fileno())
+                mapped = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+            entry = self.parse(mapped, path, key, (stat.st_dev, stat.st_ino))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, struct.error) as err:
+            logging.warning('Invalid disk cache entry %s: %s', path, err)
+            return None
+        if entry is not None and time.time() - stat.st_mtime > self.TOUCH_INTERVAL:
+            # the modification time is used to find the least recently used entries
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            with self.lock:
+                self.index[path] = (stat.st_size, time.time())
+        return entry
+
+    def parse(self, mapped: mmap.mmap, path: str, key: str,
+              inode: Tuple[int, int]) -> Optional[DiskCacheEntry]:
+        """
+        Create an entry from a memory mapped file
+        """
+        magic, meta_len = FILE_HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC:
+            raise ValueError('Unknown file format')
+        offset = FILE_HEADER.size + meta_len
+        meta = json.loads(mapped[FILE_HEADER.size:offset])
+        if meta['key'] != key:
+            return None
+        return DiskCacheEntry(self, path, meta, memoryview(mapped)[offset:], offset, inode)
+
+    def put(self, key: str, status_code: int, mimetype: str, headers: Mapping[str, str],
+            body: bytes, ttl_hint: Optional[float] = None) -> Optional[CacheEntry]:
+        """
+        Store a response, if its HTTP headers allow it to be cached
+        """
+        if (len(body) > self.max_entry_bytes or
+                not self.cacheable(status_code, headers, ttl_hint)):
+            return None
+        now = time.time()
+        lifetime = freshness_lifetime(headers, now, ttl_hint)
+        entry = CacheEntry(key, status_code, mimetype, headers, body, lifetime, ttl_hint)
+        if not self.already_stored(key, entry.etag, len(body)):
+            self.store(key, status_code, mimetype, entry.headers, body, entry.stored,
+                       entry.expires, ttl_hint)
+        return entry
+
+    def already_stored(self, key: str, etag: Optional[str], size: int) -> bool:
+        """
+        Check if another process has already stored this version of the response
+        """
+        if etag is None:
+            return False
+        entry = self.read(key)
+        return (entry is not None and entry.etag == etag and entry.size == size and
+                entry.is_fresh())
+
+    # pylint: disable=too-many-arguments
+    def store(self, key: str, status_code: int, mimetype: str, headers: Mapping[str, str],
+              body: bytes, stored: float, expires: float, ttl_hint: Optional[float]) -> None:
+        """
+        Atomically write an entry to disk
+        """
+        path = self.entry_path(key)
+        meta = json.dumps({
+            'key': key,
+            'status': status_code,
+            'mimetype': mimetype,
+            'headers': dict(headers.items()),
+            'stored': stored,
+            'expires': expires,
+            'ttl_hint': ttl_hint,
+        }).encode('utf-8')
+        temp_name: Optional[str] = None
+        try:
+            os.makedirs(self.temp_dir, exist_ok=True)
+            fd, temp_name = tempfile.mkstemp(dir=self.temp_dir)
+            with os.fdopen(fd, 'wb') as dest:
+                dest.write(FILE_HEADER.pack(MAGIC, len(meta)))
+                dest.write(meta)
+                dest.write(body)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_name, path)
+        except OSError as err:
+            logging.warning('Failed to write disk cache entry %s: %s', path, err)
+            if temp_name is not None:
+                try:
+                    os.unlink(temp_name)
+                except OSError:
+                    pass
+            return
+        size = FILE_HEADER.size + len(meta) + len(body)
+        with self.lock:
+            old = self.index.get(path)
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.index[path] = (size, time.time())
+            self.total_bytes += size
+            self.writes += 1
+            rescan = (self.total_bytes > self.max_bytes or
+                      time.monotonic() - self.last_scan > self.SCAN_INTERVAL)
+        if rescan:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Re-scan the directory, to include files written by other processes,
+        and remove the least recently used files until the size of the
+        cache is below the low water mark
+        """
+        self.scan()
+        with self.lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            target = int(self.max_bytes * self.LOW_WATER_MARK)
+            oldest = sorted(self.index.items(), key=lambda item: item[1][1])
+            victims = []
+            for path, (size, _) in oldest:
+                if self.total_bytes <= target:
+                    break
+                victims.append(path)
+                del self.index[path]
+                self.total_bytes -= size
+                self.evictions += 1
+        for path in victims:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def remove(self, key: str) -> None:
+        """
+        Remove an entry from the cache
+        """
+        path = self.entry_path(key)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            old = self.index.pop(path, None)
+            if old is not None:
+                self.total_bytes -= old[0]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Cache usage statistics. The number of entries and bytes include
+        the entries written by other processes, as of the last scan.
+        """
+        with self.lock:
+            return {
+                'entries': len(self.index),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'writes': self.writes,
+            }
@@ -0,0 +1,64 @@
+"""
+Conversion between the HTTP requests and responses of the Azure
+functions and those used by the request pipelines
+"""
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+import azure.functions as func
+
+from .pipeline import ClientRequest, Response
+from .request import origin_pool
+
+_warm_up_lock = threading.Lock()
+_warm_up_thread: Optional[threading.Thread] = None
+
+def client_request(req: func.HttpRequest) -> ClientRequest:
+    """
+    The parts of an Azure function's HTTP request that are used by the
+    request pipelines
+    """
+    return ClientRequest(req.url, req.headers, req.params)
+
+def http_response(response: Response) -> func.HttpResponse:
+    """
+    Convert a response created by a request pipeline into the response
+    of an Azure function
+    """
+    headers: Dict[str, str] = dict(response.headers)
+    if response.content_encoding is not None:
+        headers['Content-Encoding'] = response.content_encoding
+    return func.HttpResponse(body=response.body, status_code=response.status_code,
+                             mimetype=response.mimetype, headers=headers)
+
+def warm_up(env: Optional[Dict] = None) -> None:
+    """
+    Prepare this worker process for its first origin request, using a
+    background thread so that loading the function is not delayed. The
+    thread creates the origin connection pool (which imports requests)
+    and opens a connection to each URL in the comma separated
+    DASHPIFF_WARM_URLS setting. All of the functions in a function app
+    share one worker process, so only the first call has any effect.
+    """
+    global _warm_up_thread # pylint: disable=global-statement
+    if env is None:
+        env = os.environ
+    urls = [url.strip() for url in env.get('DASHPIFF_WARM_URLS', '').split(',')
+            if url.strip()]
+    with _warm_up_lock:
+        if _warm_up_thread is not None:
+            return
+        _warm_up_thread = threading.Thread(target=_warm_origin_pool, args=(urls,),
+                                           name='warm-up', daemon=True)
+        _warm_up_thread.start()
+
+def _warm_origin_pool(urls: List[str]) -> None:
+    """
+    Create the origin connection pool and connect to each of the URLs
+    """
+    pool = origin_pool()
+    for url in urls:
+        if pool.warm(url):
+            logging.debug('Opened connection to %s', url)
@@ -0,0 +1,468 @@
+"""
+Hedged origin requests for media segments. Many manifests list the same
+media on more than one CDN, using several sibling BaseURL elements, but
+each player only uses one of them. The response time and error rate of
+each origin host are learned from the media segment requests. If an
+origin has not responded by a deadline taken from a percentile of its
+recent response times, the segment is also requested using an alternate
+BaseURL and the first good response is used. An origin that is failing
+most of its requests is only used if the alternates are slow.
+"""
+from collections import OrderedDict, deque
+import logging
+import os
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Deque, Dict, List, NamedTuple, Optional, Tuple
+import urllib.parse
+import zlib
+
+from .manifest import alternate_base_urls
+from .request import fetch
+
+if TYPE_CHECKING:
+    import requests
+    from .admission import Ticket
+    from .pipeline import OriginRequest
+
+# The time, response time (in seconds) and success of one origin request
+Sample = Tuple[float, float, bool]
+
+# The index in the HedgePlan, and the response or error of one origin request
+Attempt = Tuple[int, Optional["requests.Response"], Optional[Exception]]
+
+
+class HedgePlan(NamedTuple):
+    """
+    The origin URLs to use for one request, in the order they are to be
+    tried. delays[i] is the time to wait for a response using urls[i]
+    before also making the request using urls[i + 1].
+    """
+    urls: List[str]
+    delays: List[float]
+
+
+class HedgePolicy:
+    """
+    Learns the alternate BaseURLs of each BaseURL from the manifests, and
+    the response time and error rate of each origin host from the media
+    segment requests, to decide when a hedged request is made. The
+    manifests are searched for alternate BaseURLs by a background thread,
+    so that a manifest request is not delayed.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, percentile: float = 95.0, min_delay: float = 0.05,
+                 max_delay: float = 2.0, max_samples: int = 100, min_samples: int = 10,
+                 window: float = 60.0, max_error_rate: float = 0.5,
+                 max_base_urls: int = 1024, max_hosts: int = 256,
+                 max_manifests: int = 64) -> None:
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.max_base_urls = max_base_urls
+        self.max_hosts = max_hosts
+        self.max_manifests = max_manifests
+        self.lock = threading.Lock()
+        self.alternates: "OrderedDict[str, Tuple[str, ...]]" = OrderedDict()
+        self.hosts: "OrderedDict[str, Deque[Sample]]" = OrderedDict()
+        self.counters = dict(requests=0, hedged=0, hedge_wins=0, failovers=0, errors=0,
+                             manifests_scanned=0, manifests_unchanged=0)
+        # the manifests waiting to be scanned, where only the latest
+        # version of each manifest is kept
+        self.scan_ready = threading.Condition(threading.Lock())
+        self.pending: "OrderedDict[str, bytes]" = OrderedDict()
+        self.scanner: Optional[threading.Thread] = None
+        # the CRC of the last version of each manifest that was scanned
+        self.scanned: "OrderedDict[str, int]" = OrderedDict()
+
+    @classmethod
+    def from_environment(cls, env: Optional[Dict] = None) -> Optional["HedgePolicy"]:
+        """
+        Create a policy using the DASHPIFF_HEDGE_PERCENTILE,
+        DASHPIFF_HEDGE_MIN_DELAY and DASHPIFF_HEDGE_MAX_DELAY environment
+        variables. Hedged requests are disabled unless a percentile
+        greater than 0 is given.
+        """
+        if env is None:
+            env = os.environ
+        percentile = float(env.get('DASHPIFF_HEDGE_PERCENTILE', 0))
+        if percentile <= 0:
+            return None
+        return cls(percentile, min_delay=float(env.get('DASHPIFF_HEDGE_MIN_DELAY', 0.05)),
+                   max_delay=float(env.get('DASHPIFF_HEDGE_MAX_DELAY', 2.0)))
+
+    def manifest_updated(self, manifest_url: str, body: bytes) -> None:
+        """
+        Called each time a manifest has been received from origin. The
+        manifest is scanned by the background thread.
+        """
+        with self.scan_ready:
+            self.pending[manifest_url] = body
+            self.pending.move_to_end(manifest_url)
+            while len(self.pending) > self.max_manifests:
+                self.pending.popitem(last=False)
+            if self.scanner is None:
+                self.scanner = threading.Thread(target=self.run_scanner, name='hedge-scan',
+                                                daemon=True)
+                self.scanner.start()
+            self.scan_ready.notify()
+
+    def run_scanner(self) -> None:
+        """
+        Scan each manifest that is waiting. This is called by the
+        background thread.
+        """
+        while True:
+            with self.scan_ready:
+                while not self.pending:
+                    self.scan_ready.wait()
+                manifest_url, body = self.pending.popitem(last=False)
+            self.scan_manifest(manifest_url, body)
+
+    def scan_manifest(self, manifest_url: str, body: bytes) -> None:
+        """
+        Find the alternate BaseURLs in a manifest. A live manifest is
+        often unchanged since it was last scanned, or only has new
+        segments, so its groups of BaseURLs are already known.
+        """
+        crc = zlib.crc32(body)
+        with self.lock:
+            if self.scanned.get(manifest_url) == crc:
+                self.counters['manifests_unchanged'] += 1
+                return
+            self.scanned[manifest_url] = crc
+            self.scanned.move_to_end(manifest_url)
+            while len(self.scanned) > self.max_manifests:
+                self.scanned.popitem(last=False)
+            self.counters['manifests_scanned'] += 1
+        groups = alternate_base_urls(manifest_url, body)
+        if not groups:
+            return
+        with self.lock:
+            for group in groups:
+                # the segment URLs are relative to the "directory" of the BaseURL
+                bases = [urllib.parse.urljoin(url, './') for url in group]
+                for base in bases:
+                    self.alternates[base] = tuple([alt for alt in bases if alt != base])
+                    self.alternates.move_to_end(base)
+            while len(self.alternates) > self.max_base_urls:
+                self.alternates.popitem(last=False)
+
+    def plan(self, url: str) -> HedgePlan:
+        """
+        Decide which origin URLs to use for a media segment. The URL from
+        the player's request is used first, unless its origin is failing
+        and an alternate is not.
+        """
+        with self.lock:
+            self.counters['requests'] += 1
+            alternates = self.find_alternates(url)
+            if not alternates:
+                return HedgePlan([url], [])
+            now = time.time()
+            health = {alt: self.health(host_of(alt), now) for alt in [url] + alternates}
+            urls = [url] + sorted(alternates, key=lambda alt: health[alt])
+            if (health[url][0] >= self.max_error_rate and
+                    health[urls[1]][0] < self.max_error_rate):
+                urls = urls[1:] + [url]
+                self.counters['failovers'] += 1
+            return HedgePlan(urls, [health[alt][1] for alt in urls[:-1]])
+
+    def find_alternates(self, url: str) -> List[str]:
+        """
+        The alternate URLs of a media segment, using each of the sibling
+        BaseURLs of the BaseURL at the start of the URL. The lock must
+        be held by the caller.
+        """
+        if not self.alternates:
+            return []
+        pos = len(url)
+        while True:
+            pos = url.rfind('/', 0, pos)
+            if pos < 0:
+                return []
+            alternates = self.alternates.get(url[:pos + 1])
+            if alternates is not None:
+                return [alt + url[pos + 1:] for alt in alternates]
+
+    def health(self, host: str, now: float) -> Tuple[float, float]:
+        """
+        The recent error rate of an origin host and the time to wait for
+        it to respond before making a hedged request. The lock must be
+        held by the caller.
+        """
+        samples = [sample for sample in self.hosts.get(host, ())
+                   if now - sample[0] < self.window]
+        if len(samples) < self.min_samples:
+            return 0.0, self.max_delay
+        errors = sum([1 for sample in samples if not sample[2]])
+        times = sorted([sample[1] for sample in samples if sample[2]])
+        if len(times) < self.min_samples:
+            return errors / len(samples), self.max_delay
+        idx = min(len(times) - 1, int(len(times) * self.percentile / 100.0))
+        delay = min(self.max_delay, max(self.min_delay, times[idx]))
+        return errors / len(samples), delay
+
+    def record(self, url: str, elapsed: float, success: bool) -> None:
+        """
+        Record the time taken for an origin to respond, or to fail
+        """
+        host = host_of(url)
+        with self.lock:
+            samples = self.hosts.get(host)
+            if samples is None:
+                samples = deque(maxlen=self.max_samples)
+                self.hosts[host] = samples
+                while len(self.hosts) > self.max_hosts:
+                    self.hosts.popitem(last=False)
+            else:
+                self.hosts.move_to_end(host)
+            samples.append((time.time(), elapsed, success))
+            if not success:
+                self.counters['errors'] += 1
+
+    def finished(self, attempts: int, winner: int) -> None:
+        """
+        Record the outcome of a request that had alternate origins.
+        "winner" is the index of the URL in the plan that was used, or
+        -1 if none of the origin requests succeeded.
+        """
+        with self.lock:
+            self.counters['hedged'] += attempts - 1
+            if winner > 0:
+                self.counters['hedge_wins'] += 1
+
+    def stats(self) -> Dict:
+        """
+        Hedged request statistics, and the error rate and hedging delay
+        of each origin host
+        """
+        now = time.time()
+        with self.lock:
+            hosts: Dict[str, Dict[str, float]] = {}
+            for host, samples in self.hosts.items():
+                error_rate, delay = self.health(host, now)
+                hosts[host] = {'samples': len(samples), 'error_rate': error_rate,
+                               'delay': delay}
+            result = dict(self.counters)
+            result['base_urls'] = len(self.alternates)
+            result['hosts'] = hosts
+        return result
+
+
+def is_good_response(status_code: int) -> bool:
+    """
+    Can an origin response be used to respond to the client. A client
+    error (e.g. a segment that has not yet reached one of the CDNs) is
+    only used if none of the origins provide a good response.
+    """
+    return 200 <= status_code < 300 or status_code == 304
+
+def host_of(url: str) -> str:
+    """
+    The scheme, host and port of a URL
+    """
+    scheme, netloc = urllib.parse.urlsplit(url)[:2]
+    return f'{scheme}://{netloc}'
+
+def timed_fetch(policy: HedgePolicy, url: str,
+                origin: "OriginRequest") -> "requests.Response":
+    """
+    Make a streamed origin request, recording its response time
+    """
+    started = time.perf_counter()
+    try:
+        response = fetch(url, origin.headers, origin.query, stream=True)
+    except Exception:
+        policy.record(url, time.perf_counter() - started, False)
+        raise
+    policy.record(url, time.perf_counter() - started, is_good_response(response.status_code))
+    return response
+
+def hedged_fetch(policy: Optional[HedgePolicy], origin: "OriginRequest",
+                 ticket: Optional["Ticket"] = None) -> "requests.Response":
+    """
+    Make the streamed origin request of a media segment. If the segment
+    is available from more than one origin, the request is hedged using
+    the alternate origins. "ticket" is the admission ticket of the
+    request, which is used to admit the requests to alternate origins.
+    """
+    if policy is None:
+        return fetch(origin.url, origin.headers, origin.query, stream=True)
+    plan = policy.plan(origin.url)
+    if len(plan.urls) == 1:
+        return timed_fetch(policy, origin.url, origin)
+    return HedgedFetch(policy, origin, plan, ticket).run()
+
+
+class HedgedFetch:
+    """
+    Races the origin requests of a HedgePlan, each using its own thread.
+    The first good response is used, and the other responses are closed
+    as they arrive. If an admission ticket is given, each request to an
+    alternate origin needs its own ticket, and is skipped if its origin
+    is too busy to admit it without waiting.
+    """
+
+    def __init__(self, policy: HedgePolicy, origin: "OriginRequest", plan: HedgePlan,
+                 ticket: Optional["Ticket"] = None) -> None:
+        self.policy = policy
+        self.origin = origin
+        self.plan = plan
+        self.ticket = ticket
+        self.lock = threading.Lock()
+        self.done = False
+        self.results: "queue.Queue[Attempt]" = queue.Queue()
+        self.tickets: Dict[int, "Ticket"] = {}
+        self.started = 0
+        self.attempts = 0
+
+    def run(self) -> "requests.Response":
+        """
+        Make the origin requests, returning the first good response. If
+        they all fail, the last error response is returned, or the last
+        exception is raised.
+        """
+        urls = self.plan.urls
+        failed: Optional[Attempt] = None
+        error: Optional[Exception] = None
+        pending = 0
+        deadline = 0.0
+        while True:
+            if self.started < len(urls) and (pending == 0 or time.monotonic() >= deadline):
+                if self.start():
+                    pending += 1
+                if self.started < len(urls):
+                    deadline = time.monotonic() + self.plan.delays[self.started - 1]
+            if not pending:
+                break
+            timeout: Optional[float] = None
+            if self.started < len(urls):
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                index, response, err = self.results.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            pending -= 1
+            if response is not None and is_good_response(response.status_code):
+                self.finish(index)
+                self.policy.finished(self.attempts, index)
+                return response
+            if response is not None:
+                if failed is not None:
+                    self.discard(failed)
+                failed = (index, response, None)
+            else:
+                error = err
+            # no need to wait before trying the next origin
+            deadline = 0.0
+        self.finish(-1 if failed is None else failed[0])
+        self.policy.finished(self.attempts, -1)
+        if failed is not None:
+            return failed[1]
+        raise error
+
+    def start(self) -> bool:
+        """
+        Start the origin request using the next URL of the plan that can
+        be admitted. Returns False if none of the remaining URLs can be
+        used.
+        """
+        urls = self.plan.urls
+        while self.started < len(urls):
+            index = self.started
+            self.started += 1
+            if self.ticket is not None and urls[index] != self.origin.url:
+                # the ticket of the request only admits the player's origin
+                ticket = self.ticket.control.try_admit(urls[index])
+                if ticket is None:
+                    logging.debug('Skipped hedged request %s as its origin is busy',
+                                  urls[index])
+                    continue
+                with self.lock:
+                    self.tickets[index] = ticket
+            if index:
+                logging.debug('Hedged request %s', urls[index])
+            thread = threading.Thread(target=self.attempt, args=(index,),
+                                      name=f'hedge-{index}', daemon=True)
+            self.attempts += 1
+            thread.start()
+            return True
+        return False
+
+    def attempt(self, index: int) -> None:
+        """
+        Make one of the origin requests. This is called by its own thread.
+        """
+        try:
+            response = timed_fetch(self.policy, self.plan.urls[index], self.origin)
+        except Exception as err: # pylint: disable=broad-except
+            self.release(index)
+            self.results.put((index, None, err))
+            return
+        with self.lock:
+            if not self.done:
+                self.results.put((index, response, None))
+                return
+        self.discard((index, response, None))
+
+    def discard(self, result: Attempt) -> None:
+        """
+        Close a response that is not used, and release its ticket
+        """
+        index, response = result[:2]
+        if response is not None:
+            response.close()
+        self.release(index)
+
+    def release(self, index: int) -> None:
+        """
+        Release the admission ticket of one of the origin requests
+        """
+        with self.lock:
+            ticket = self.tickets.pop(index, None)
+        if ticket is not None:
+            ticket.release()
+
+    def finish(self, winner: int) -> None:
+        """
+        Close the responses that were received but not used. The ticket
+        of the response that is used is kept until the ticket of the
+        request is released.
+        """
+        with self.lock:
+            self.done = True
+            ticket = self.tickets.pop(winner, None)
+        if ticket is not None and self.ticket is not None:
+            self.ticket.attach(ticket)
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if result[0] != winner:
+                self.discard(result)
+
+
+_policy_lock = threading.Lock()
+_hedge_policy: Optional[HedgePolicy] = None
+_configured = False
+
+def hedge_policy() -> Optional[HedgePolicy]:
+    """
+    Get the hedging policy that is shared by the Azure functions of this
+    worker process, creating it from the environment settings. Returns
+    None if hedged requests are disabled.
+    """
+    global _hedge_policy, _configured # pylint: disable=global-statement
+    with _policy_lock:
+        if not _configured:
+            _hedge_policy = HedgePolicy.from_environment()
+            _configured = True
+        return _hedge_policy
@@ -0,0 +1,234 @@
+"""
+Utility functions to walk the ISO BMFF (ISO 14496-12) box structure of
+a media segment and remove the PIFF sample encryption boxes
+"""
+import logging
+import struct
+import time
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from .constants import CONTAINER_BOXES, PIFF_UUID, FREE_UUID
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+class BoxHeader(NamedTuple):
+    """
+    The header of one ISO BMFF box
+    """
+    size: int        # total size of the box, 0 == extends to end of file
+    box_type: bytes
+    header_size: int # size of the header, including any extended type
+    usertype: Optional[bytes]
+
+def parse_box_header(data: Buffer, offset: int) -> Optional[BoxHeader]:
+    """
+    Parse the box header that starts at "offset" in the given buffer.
+    Returns None if the buffer does not contain the complete header.
+    Raises ValueError if the header is not valid.
+    """
+    avail = len(data) - offset
+    if avail < 8:
+        return None
+    size, box_type = struct.unpack_from('>I4s', data, offset)
+    header_size = 8
+    if size == 1:
+        if avail < 16:
+            return None
+        size = struct.unpack_from('>Q', data, offset + 8)[0]
+        header_size = 16
+    usertype: Optional[bytes] = None
+    if box_type == b'uuid':
+        if avail < header_size + 16:
+            return None
+        usertype = bytes(data[offset + header_size:offset + header_size + 16])
+        header_size += 16
+    if size != 0 and size < header_size:
+        raise ValueError(f'Invalid size {size} for box {box_type!r} at offset {offset}')
+    return BoxHeader(size, bytes(box_type), header_size, usertype)
+
+def iter_boxes(data: Buffer, start: int = 0,
+               end: Optional[int] = None) -> Iterator[Tuple[int, BoxHeader]]:
+    """
+    Yields the offset and header of every box in the buffer, descending
+    into the boxes listed in CONTAINER_BOXES. The payload of all other
+    boxes (such as mdat) is skipped without being inspected.
+    Raises ValueError if an invalid box header is found.
+    """
+    if end is None:
+        end = len(data)
+    offset = start
+    while offset < end:
+        header = parse_box_header(data, offset)
+        if header is None:
+            logging.warning('Media segment truncated at offset %d', offset)
+            return
+        yield offset, header
+        if header.box_type in CONTAINER_BOXES:
+            offset += header.header_size
+        elif header.size == 0:
+            return
+        else:
+            offset += header.size
+
+def find_piff_boxes(data: Buffer) -> List[int]:
+    """
+    Find the offset of the usertype field of every PIFF sample encryption
+    box in the segment. The segment is indexed using a memoryview, so
+    no part of the segment is copied.
+    """
+    view = memoryview(data)
+    offsets: List[int] = []
+    try:
+        for offset, header in iter_boxes(view):
+            if header.usertype == PIFF_UUID:
+                offsets.append(offset + header.header_size - len(PIFF_UUID))
+    except ValueError as err:
+        logging.warning('Failed to parse media segment: %s', err)
+    return offsets
+
+def parse_sidx(data: Buffer, offset: int, header: BoxHeader) -> List[int]:
+    """
+    Parse a segment index (sidx) box, that starts at "offset" in the
+    given buffer, which must contain the complete box. Returns the file
+    offset of the start of each subsegment it references, followed by
+    the offset of the end of the last subsegment.
+    Raises ValueError if the box is not valid.
+    """
+    pos = offset + header.header_size
+    end = offset + header.size
+    try:
+        version = data[pos]
+        pos += 12  # version, flags, reference_ID and timescale
+        if version == 0:
+            first_offset = struct.unpack_from('>I', data, pos + 4)[0]
+            pos += 8
+        else:
+            first_offset = struct.unpack_from('>Q', data, pos + 8)[0]
+            pos += 16
+        count = struct.unpack_from('>H', data, pos + 2)[0]
+        pos += 4
+        if pos + 12 * count > end:
+            raise ValueError(f'sidx at offset {offset} is truncated')
+        anchor = end + first_offset
+        offsets = [anchor]
+        for _ in range(count):
+            size = struct.unpack_from('>I', data, pos)[0] & 0x7FFFFFFF
+            anchor += size
+            offsets.append(anchor)
+            pos += 12
+    except (IndexError, struct.error) as err:
+        raise ValueError(f'Invalid sidx at offset {offset}: {err}') from err
+    return offsets
+
+def patch_piff_boxes(data: Union[bytearray, memoryview]) -> int:
+    """
+    Convert every PIFF sample encryption box in the given writable
+    buffer into a "free" box.
+    Returns the number of boxes that were patched.
+    """
+    view = memoryview(data)
+    offsets = find_piff_boxes(view)
+    for pos in offsets:
+        view[pos:pos + len(FREE_UUID)] = FREE_UUID
+    return len(offsets)
+
+
+class PiffStreamPatcher:
+    """
+    Walks the box headers of a media segment as it arrives from origin
+    and converts every PIFF sample encryption box into a "free" box.
+
+    Only the few bytes of a box header that has been split across two
+    chunks are held back, all other data is passed on as soon as it has
+    been received, so memory use does not depend upon the segment size.
+    """
+
+    def __init__(self, offset: int = 0) -> None:
+        # the stream does not have to start at the beginning of the file
+        # (e.g. for a Range request), but it must start with a box header
+        self.position: int = offset  # stream offset of the first byte of self.pending
+        self.next_box: Optional[int] = offset  # stream offset of the next box header
+        self.pending = bytearray()
+        self.boxes_patched: int = 0
+        self.elapsed: float = 0.0  # time (in seconds) spent scanning and patching
+
+    def feed(self, chunk: Buffer) -> Buffer:
+        """
+        Process the next chunk of the segment and return the data that
+        can be sent to the client.
+        """
+        parts = self.feed_parts(chunk)
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def feed_parts(self, chunk: Buffer) -> List[Buffer]:
+        """
+        Process the next chunk of the segment and return the data that
+        can be sent to the client, as a list of memoryview slices of the
+        chunk with FREE_UUID spliced in place of each PIFF_UUID. The
+        chunk itself is never copied or modified.
+        """
+        started = time.perf_counter()
+        data: Buffer = chunk
+        if self.pending:
+            data = self.pending + chunk
+            self.pending = bytearray()
+        view = memoryview(data)
+        parts: List[Buffer] = []
+        done = 0  # offset of the first byte of data that is not in parts
+        start = self.position
+        end = start + len(view)
+        while self.next_box is not None and self.next_box < end:
+            offset = self.next_box - start
+            try:
+                header = parse_box_header(view, offset)
+            except ValueError as err:
+                logging.warning('Failed to parse media segment: %s', err)
+                self.next_box = None
+                break
+            if header is None:
+                self.pending = bytearray(view[offset:])
+                self.position = self.next_box
+                if offset > done:
+                    parts.append(view[done:offset])
+                self.elapsed += time.perf_counter() - started
+                return parts
+            if header.usertype == PIFF_UUID:
+                pos = offset + header.header_size - len(FREE_UUID)
+                if pos > done:
+                    parts.append(view[done:pos])
+                parts.append(FREE_UUID)
+                done = pos + len(FREE_UUID)
+                self.boxes_patched += 1
+            if header.box_type in CONTAINER_BOXES:
+                self.next_box += header.header_size
+            elif header.size == 0:
+                self.next_box = None
+            else:
+                self.next_box += header.size
+        self.position = end
+        if done < len(view):
+            parts.append(view[done:])
+        self.elapsed += time.perf_counter() - started
+        return parts
+
+    def flush(self) -> bytes:
+        """
+        Returns any data that is still being held back because the
+        segment ended part way through a box header.
+        """
+        data = bytes(self.pending)
+        self.position += len(data)
+        self.pending = bytearray()
+        return data
+
+    def patch(self, chunks: Iterable[Buffer]) -> Iterator[Buffer]:
+        """
+        Generator that patches each chunk of the segment
+        """
+        for chunk in chunks:
+            yield from self.feed_parts(chunk)
+        data = self.flush()
+        if data:
+            yield data
@@ -0,0 +1,381 @@
+"""
+Utility functions to wrap manifest URLs and to modify the BaseURL
+elements of a DASH manifest, so that requests are directed to the proxy
+"""
+import bisect
+from collections import OrderedDict
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Mapping, Optional, Tuple
+import urllib.parse
+
+from .isobmff import Buffer
+from .request import encode_url
+
+# Matches a BaseURL element, including any namespace prefix, attributes
+# (e.g. serviceLocation) and whitespace around the URL
+BASEURL_RE = re.compile(
+    rb'(?P<open><(?P<prefix>[\w.-]+:|)BaseURL\b[^<>]*(?<!/)>)(?P<url>[^<]*)'
+    rb'(?P<close></(?P=prefix)BaseURL\s*>)')
+
+MIN_UPDATE_PERIOD_RE = re.compile(
+    rb'<(?:[\w.-]+:)?MPD\b[^>]*?\sminimumUpdatePeriod\s*=\s*["\'](?P<period>[^"\']+)["\']')
+
+DURATION_RE = re.compile(
+    r'^P(?:(?P<years>\d+(?:\.\d+)?)Y)?(?:(?P<months>\d+(?:\.\d+)?)M)?'
+    r'(?:(?P<days>\d+(?:\.\d+)?)D)?'
+    r'(?:T(?:(?P<hours>\d+(?:\.\d+)?)H)?(?:(?P<minutes>\d+(?:\.\d+)?)M)?'
+    r'(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?$')
+
+# number of seconds in each component of an ISO 8601 duration
+DURATION_UNITS = {
+    'years': 365 * 86400,
+    'months': 30 * 86400,
+    'days': 86400,
+    'hours': 3600,
+    'minutes': 60,
+    'seconds': 1,
+}
+
+CREATE_FORM_HTML = """<!doctype html><html lang="en">
+<head><title>Manifest URL generator</title></head>
+<body>
+<form method="POST">
+<label for="url">Manifest URL:</label>
+<input type="text" name="url" placeholder="DASH manifest URL..." />
+<button type="submit">Generate URL</button>
+</form>
+</body></html>
+"""
+
+def proxy_prefix(request_url: str) -> List[str]:
+    """
+    The scheme, host and port parts of a URL that points to this proxy
+    """
+    parts = urllib.parse.urlparse(request_url)
+    prefix = ['http://', parts.hostname]
+    if parts.port and parts.port != 80:
+        prefix.append(f':{parts.port}')
+    return prefix
+
+def wrap_manifest_url(mpd_url: str, request_url: str, manifest_path: str) -> str:
+    """
+    Encodes a manifest URL so that it points to the manifest proxy.
+    The query string of the manifest URL is not wrapped, so that it
+    is passed to origin.
+    """
+    return prefix_manifest_url(urllib.parse.urlparse(mpd_url),
+                               ''.join(proxy_prefix(request_url) + [manifest_path]))
+
+def prefix_manifest_url(mpd_parts: urllib.parse.ParseResult, prefix: str) -> str:
+    """
+    Encodes a parsed manifest URL and appends it to "prefix", which is
+    the URL of the manifest route of the proxy. This allows the prefix
+    to be created once when wrapping many URLs.
+    """
+    mpd_url = urllib.parse.urlunsplit((mpd_parts.scheme, mpd_parts.netloc,
+            mpd_parts.path, '', ''))
+    manifest_url = [prefix, encode_url(mpd_url)]
+    if mpd_parts.query:
+        manifest_url.append('?')
+        manifest_url.append(mpd_parts.query)
+    return ''.join(manifest_url)
+
+def extract_url_field(query: Optional[Mapping[str, str]], content_type: str,
+                      body: Optional[bytes]) -> Optional[str]:
+    """
+    Check the request for a "url" field.
+    It searches for a CGI parameter, an application/x-www-form-urlencoded
+    form or an application/json payload.
+    """
+    if query is not None:
+        url = query.get('url')
+        if url:
+            return url
+    if 'json' in content_type:
+        req_body = json.loads(body)
+        return req_body.get('url')
+    if 'x-www-form-urlencoded' in content_type:
+        form = urllib.parse.parse_qs(body)
+        if b'url' in form:
+            return str(form[b'url'][0], 'utf-8')
+        return form["url"]
+    raise ValueError("Unknown payload type")
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Convert an ISO 8601 duration (e.g. "PT2.5S") into seconds
+    """
+    match = DURATION_RE.match(value.strip())
+    if match is None or value.strip() in {'P', 'PT'}:
+        return None
+    return sum([float(match.group(name)) * scale for name, scale in DURATION_UNITS.items()
+                if match.group(name) is not None])
+
+def minimum_update_period(body: bytes) -> Optional[float]:
+    """
+    Find the minimumUpdatePeriod of a live manifest, in seconds.
+    Returns None if the manifest does not have a minimumUpdatePeriod.
+    """
+    match = MIN_UPDATE_PERIOD_RE.search(body)
+    if match is None:
+        return None
+    return parse_duration(str(match.group('period'), 'ascii', 'replace'))
+
+def rewrite_base_urls(body: bytes, request_url: str, media_path: str) -> List[Buffer]:
+    """
+    Modify all BaseURL elements to point to the media segment proxy,
+    with a URL that wraps the original origin URL.
+
+    For example <BaseURL>http://example.site/foo</BaseURL> becomes
+    <BaseURL>http://my.lambda/api/media/http%3A%2F%2Fexample.site%2Ffoo/</BaseURL>
+
+    The manifest is processed as bytes in one pass, without decoding it.
+    The result is a list of parts that can be written to the client one
+    after the other, where the unmodified parts are views of the body.
+    """
+    return _rewrite_from(body, 0, media_url_prefix(request_url, media_path), {})
+
+def alternate_base_urls(manifest_url: str, body: bytes) -> List[List[str]]:
+    """
+    Find the groups of sibling BaseURL elements in a manifest, such as
+    a manifest that lists the same media on more than one CDN. Sibling
+    BaseURLs are adjacent in the manifest, separated only by whitespace.
+    Each URL is resolved using the manifest URL.
+    """
+    groups: List[List[str]] = []
+    group: List[str] = []
+    end = -1
+    for match in BASEURL_RE.finditer(body):
+        url = match.group('url').strip()
+        if not url:
+            continue
+        if end < 0 or body[end:match.start()].strip():
+            if len(group) > 1:
+                groups.append(group)
+            group = []
+        url = urllib.parse.urljoin(manifest_url, unescape(str(url, 'utf-8', 'replace')))
+        if url not in group:
+            group.append(url)
+        end = match.end()
+    if len(group) > 1:
+        groups.append(group)
+    return groups
+
+def unescape(value: str) -> str:
+    """
+    Replace the XML entities that can appear in the text of a BaseURL.
+    Equivalent to xml.sax.saxutils.unescape(), which is not used because
+    importing it also imports urllib.request, which slows down the cold
+    start of the Azure functions.
+    """
+    if '&' not in value:
+        return value
+    return value.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+def media_url_prefix(request_url: str, media_path: str) -> bytes:
+    """
+    The start of the URL of each rewritten BaseURL element
+    """
+    return bytes(''.join(proxy_prefix(request_url) + [media_path]), 'utf-8')
+
+# (start, end, delta) of a rewritten BaseURL element in the origin manifest,
+# where delta is the difference in length between the rewritten manifest
+# and the origin manifest at the end of the element
+Span = Tuple[int, int, int]
+
+def _rewrite_from(body: bytes, start: int, media_url: bytes, wrapped: Dict[bytes, bytes],
+                  spans: Optional[List[Span]] = None, delta: int = 0) -> List[Buffer]:
+    """
+    Rewrite the BaseURL elements that start at or after "start"
+    """
+    view = memoryview(body)
+    parts: List[Buffer] = []
+    pos = start
+    for match in BASEURL_RE.finditer(body, start):
+        origin_url = match.group('url')
+        # the same relative BaseURL is often repeated in every period of
+        # the manifest, so each distinct value is only wrapped once
+        proxy_url = wrapped.get(origin_url)
+        if proxy_url is None:
+            url = origin_url.strip()
+            if url:
+                url = encode_url(unescape(str(url, 'utf-8', 'replace')))
+                proxy_url = b''.join([media_url, bytes(url, 'utf-8'), b'/'])
+            else:
+                proxy_url = origin_url
+            wrapped[origin_url] = proxy_url
+        parts.append(view[pos:match.end('open')])
+        parts.append(proxy_url)
+        pos = match.start('close')
+        if spans is not None:
+            delta += len(proxy_url) - len(origin_url)
+            spans.append((match.start(), match.end(), delta))
+    parts.append(view[pos:])
+    return parts
+
+def common_prefix_length(old: bytes, new: bytes, block: int = 64 * 1024) -> int:
+    """
+    The number of bytes at the start of both old and new that are identical
+    """
+    limit = min(len(old), len(new))
+    pos = 0
+    # comparing slices is done using memcmp(), which is much faster
+    # than comparing one byte at a time in Python
+    while pos + block <= limit and old[pos:pos + block] == new[pos:pos + block]:
+        pos += block
+    while block > 1:
+        block //= 2
+        if pos + block <= limit and old[pos:pos + block] == new[pos:pos + block]:
+            pos += block
+    return pos
+
+
+class ManifestState:
+    """
+    The most recent version of a live manifest and its rewritten form
+    """
+    __slots__ = ['source', 'output', 'spans', 'wrapped', 'used']
+
+    def __init__(self, source: bytes, output: bytes, spans: List[Span],
+                 wrapped: Dict[bytes, bytes]) -> None:
+        self.source = source
+        self.output = output
+        self.spans = spans
+        self.wrapped = wrapped
+        self.used = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        """
+        Approximate number of bytes used by this state
+        """
+        return len(self.source) + len(self.output) + 64 * len(self.spans)
+
+
+class IncrementalRewriter:
+    """
+    Rewrites live manifests, re-using the result of the previous rewrite
+    of the same manifest. New Periods and SegmentTimeline entries are
+    added towards the end of a live manifest, so only the part after the
+    unchanged prefix of the manifest needs to be rewritten.
+
+    The state of each manifest uses an LRU with a limit on the total
+    number of bytes, and the state of a manifest that has not been
+    requested for max_age seconds is discarded.
+    """
+    MAX_WRAPPED_URLS = 4096
+
+    def __init__(self, max_bytes: int, max_age: float = 300.0) -> None:
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.states: "OrderedDict[str, ManifestState]" = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.full_rewrites = 0
+        self.incremental_rewrites = 0
+        self.reused_bytes = 0
+        self.rewritten_bytes = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_environment(cls, env: Optional[Dict] = None) -> "IncrementalRewriter":
+        """
+        Create a rewriter that uses the same DASHPIFF_MANIFEST_CACHE_MB
+        size limit as the manifest cache
+        """
+        if env is None:
+            env = os.environ
+        return cls(int(env.get('DASHPIFF_MANIFEST_CACHE_MB', 16)) * 1024 * 1024)
+
+    def rewrite(self, key: str, body: bytes, request_url: str, media_path: str) -> bytes:
+        """
+        Modify all BaseURL elements to point to the media segment proxy.
+        The key must include the host name used to access the proxy, as
+        it is part of the rewritten URLs.
+        """
+        with self.lock:
+            state = self.states.get(key)
+        if state is not None and state.source == body:
+            state.used = time.monotonic()
+            return state.output
+        media_url = media_url_prefix(request_url, media_path)
+        spans: List[Span] = []
+        if state is None:
+            wrapped: Dict[bytes, bytes] = {}
+            output = b''.join(_rewrite_from(body, 0, media_url, wrapped, spans))
+            cut = 0
+        else:
+            cut = self.cut_point(state.source, body)
+            index = bisect.bisect_left(state.spans, (cut,))
+            spans = state.spans[:index]
+            delta = spans[-1][2] if spans else 0
+            wrapped = state.wrapped
+            if len(wrapped) > self.MAX_WRAPPED_URLS:
+                wrapped = {}
+            parts = [state.output[:cut + delta]]
+            parts += _rewrite_from(body, cut, media_url, wrapped, spans, delta)
+            output = b''.join(parts)
+        self.store(key, ManifestState(body, output, spans, wrapped), cut)
+        return output
+
+    @staticmethod
+    def cut_point(old: bytes, new: bytes) -> int:
+        """
+        Find the position in the new manifest from which it needs to be
+        rewritten. Everything before this position is unchanged and does
+        not overlap with a BaseURL element that has changed.
+        """
+        length = common_prefix_length(old, new)
+        cut = new.rfind(b'<', 0, length)
+        if cut > 0 and b'/' in {old[cut + 1:cut + 2], new[cut + 1:cut + 2]}:
+            # the change might be inside an element that starts before
+            # this closing tag, such as <BaseURL>...</BaseURL>
+            cut = new.rfind(b'<', 0, cut)
+        return max(cut, 0)
+
+    def store(self, key: str, state: ManifestState, reused: int) -> None:
+        """
+        Save the state of a manifest, and discard the state of any manifest
+        that is no longer being requested
+        """
+        with self.lock:
+            if reused:
+                self.incremental_rewrites += 1
+            else:
+                self.full_rewrites += 1
+            self.reused_bytes += reused
+            self.rewritten_bytes += len(state.source) - reused
+            old = self.states.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old.size
+            if state.size <= self.max_bytes:
+                self.states[key] = state
+                self.total_bytes += state.size
+            while self.states:
+                oldest = next(iter(self.states.values()))
+                if (self.total_bytes <= self.max_bytes and
+                        state.used - oldest.used < self.max_age):
+                    break
+                _, evicted = self.states.popitem(last=False)
+                self.total_bytes -= evicted.size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Rewrite statistics
+        """
+        with self.lock:
+            return {
+                'entries': len(self.states),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'full_rewrites': self.full_rewrites,
+                'incremental_rewrites': self.incremental_rewrites,
+                'reused_bytes': self.reused_bytes,
+                'rewritten_bytes': self.rewritten_bytes,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,291 @@
+"""
+Lightweight request metrics, exported using the Prometheus text format.
+Each measurement is a few arithmetic operations under a lock, so the
+metrics are always enabled.
+"""
+from bisect import bisect_left
+import threading
+import time
+from typing import (AsyncIterator, Dict, Iterable, Iterator, List, Mapping, Optional,
+    Sequence, Tuple, TypeVar)
+
+from .isobmff import Buffer
+
+LabelValues = Tuple[str, ...]
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def format_labels(names: Sequence[str], values: LabelValues, extra: str = '') -> str:
+    """
+    Create the label set of a sample, e.g. '{stage="origin_ttfb"}'
+    """
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+def escape_label(value: str) -> str:
+    """
+    Escape a label value using the rules of the Prometheus text format
+    """
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def format_value(value: float) -> str:
+    """
+    Format a sample value, without a decimal point for whole numbers
+    """
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    """
+    Base class for a metric that has zero or more labels
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        """
+        The lines of the text format that describe this metric
+        """
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    """
+    A value that only ever increases, such as a number of requests
+    """
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        """
+        Increment the counter with the given label values
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        """
+        The current value of the counter with the given label values
+        """
+        with self.lock:
+            return self.values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, labels)} '
+                             f'{format_value(value)}')
+        return lines
+
+
+class Histogram(Metric):
+    """
+    Counts the observed values, such as latencies, that fall into each
+    of a fixed set of buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # for each set of label values: a count per bucket (the last
+        # bucket is +Inf) and the sum of the observed values
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        """
+        Record one value, using the given label values
+        """
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(labels)
+            if counts is None:
+                counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+                self.sums[labels] = 0.0
+            counts[idx] += 1
+            self.sums[labels] += value
+
+    def count(self, *labels: str) -> int:
+        """
+        The number of values observed with the given label values
+        """
+        with self.lock:
+            return sum(self.counts.get(labels, []))
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self.lock:
+            for labels, counts in sorted(self.counts.items()):
+                total = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    total += count
+                    le_label = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                    lines.append(f'{self.name}_bucket'
+                                 f'{format_labels(self.labels, labels, le_label)} {total}')
+                label_text = format_labels(self.labels, labels)
+                lines.append(f'{self.name}_sum{label_text} {format_value(self.sums[labels])}')
+                lines.append(f'{self.name}_count{label_text} {total}')
+        return lines
+
+
+MetricType = TypeVar('MetricType', bound=Metric)
+
+class MetricsRegistry:
+    """
+    The collection of metrics that are reported by the /metrics route
+    """
+
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: MetricType) -> MetricType:
+        """
+        Add a metric to the registry
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, stats: Optional[Mapping] = None) -> str:
+        """
+        Create the text format output of all of the metrics. The optional
+        stats (e.g. the output of the /stats route) are added as gauges.
+        """
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines += metric.render()
+        if stats is not None:
+            lines += stats_gauges('dashpiff', stats)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def stats_gauges(prefix: str, stats: Mapping, labels: str = '') -> List[str]:
+    """
+    Convert the numeric values of a statistics dictionary, such as the
+    output of SegmentCache.stats(), into gauges. The entries of a "hosts"
+    dictionary are reported using a "host" label.
+    """
+    lines: List[str] = []
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, (int, float)):
+            lines.append(f'{name}{{{labels}}} {format_value(value)}' if labels else
+                         f'{name} {format_value(value)}')
+        elif key == 'hosts' and isinstance(value, Mapping):
+            for host, host_stats in value.items():
+                lines += stats_gauges(f'{prefix}_host', host_stats, f'host="{escape_label(host)}"')
+        elif isinstance(value, Mapping):
+            lines += stats_gauges(name, value, labels)
+    return lines
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'dashpiff_request_seconds', 'Time taken to handle each request', ['route']))
+
+REQUESTS = REGISTRY.register(Counter(
+    'dashpiff_requests_total', 'Number of requests, by route and response status',
+    ['route', 'status']))
+
+# The stages are origin_connect (asyncio server only), origin_ttfb,
+# origin_download, piff_patch, manifest_rewrite, compress and client_write
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'dashpiff_stage_seconds', 'Time spent in each stage of handling a request', ['stage']))
+
+TRANSFER_BYTES = REGISTRY.register(Counter(
+    'dashpiff_bytes_total', 'Bytes received from origin (in) and sent to clients (out)',
+    ['direction']))
+
+PIFF_BOXES = REGISTRY.register(Counter(
+    'dashpiff_piff_boxes_patched_total', 'Number of PIFF boxes converted into free boxes'))
+
+
+def record_request(route: str, status_code: int, seconds: float) -> None:
+    """
+    Record the time taken to handle a request and its response status
+    """
+    REQUEST_SECONDS.observe(seconds, route)
+    REQUESTS.inc(route, str(status_code))
+
+def record_stage(stage: str, seconds: float) -> None:
+    """
+    Record the time spent in one stage of handling a request
+    """
+    STAGE_SECONDS.observe(seconds, stage)
+
+def record_bytes(direction: str, count: int) -> None:
+    """
+    Record bytes received from origin ("in") or sent to a client ("out")
+    """
+    if count:
+        TRANSFER_BYTES.inc(direction, amount=count)
+
+def record_patch(boxes_patched: int, seconds: float) -> None:
+    """
+    Record the work done by a PiffStreamPatcher
+    """
+    STAGE_SECONDS.observe(seconds, 'piff_patch')
+    if boxes_patched:
+        PIFF_BOXES.inc(amount=boxes_patched)
+
+def timed_chunks(chunks: Iterable[Buffer]) -> Iterator[Buffer]:
+    """
+    Generator that measures the time spent waiting for each chunk of an
+    origin response, which is recorded as the origin_download stage
+    once the response has been read
+    """
+    waiting = 0.0
+    received = 0
+    try:
+        started = time.perf_counter()
+        for chunk in chunks:
+            waiting += time.perf_counter() - started
+            received += len(chunk)
+            yield chunk
+            started = time.perf_counter()
+        waiting += time.perf_counter() - started
+    finally:
+        record_stage('origin_download', waiting)
+        record_bytes('in', received)
+
+async def async_timed_chunks(chunks: AsyncIterator[Buffer]) -> AsyncIterator[Buffer]:
+    """
+    Asynchronous version of timed_chunks()
+    """
+    waiting = 0.0
+    received = 0
+    try:
+        started = time.perf_counter()
+        async for chunk in chunks:
+            waiting += time.perf_counter() - started
+            received += len(chunk)
+            yield chunk
+            started = time.perf_counter()
+        waiting += time.perf_counter() - started
+    finally:
+        record_stage('origin_download', waiting)
+        record_bytes('in', received)
@@ -0,0 +1,315 @@
+"""
+Parses the SegmentTemplate of each Representation in a DASH manifest,
+so that the URLs of the segments that follow a requested segment can
+be predicted
+"""
+from bisect import bisect_right
+import datetime
+import logging
+import math
+import re
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+import urllib.parse
+from xml.etree import ElementTree
+
+from .manifest import parse_duration
+
+# An identifier in a SegmentTemplate, such as $Number%05d$, or an escaped "$"
+TEMPLATE_ID_RE = re.compile(r'\$(?:(?P<name>RepresentationID|Bandwidth|Number|Time)'
+                            r'(?:%0(?P<width>\d+)d)?)?\$')
+
+# The maximum number of segments taken from a SegmentTimeline
+MAX_TIMELINE_SEGMENTS = 100000
+
+# A SegmentTemplate after the RepresentationID and Bandwidth have been
+# substituted: either literal text or the name and width of an identifier
+TemplatePart = Union[str, Tuple[str, int]]
+
+def local_name(elem: ElementTree.Element) -> str:
+    """
+    The name of an element, without its XML namespace
+    """
+    return elem.tag.rpartition('}')[2]
+
+def children(elem: ElementTree.Element, name: str) -> Iterator[ElementTree.Element]:
+    """
+    The child elements with the given name, in any XML namespace
+    """
+    for child in elem:
+        if isinstance(child.tag, str) and local_name(child) == name:
+            yield child
+
+def first_child(elem: ElementTree.Element, name: str) -> Optional[ElementTree.Element]:
+    """
+    The first child element with the given name, in any XML namespace
+    """
+    for child in children(elem, name):
+        return child
+    return None
+
+def join_base_url(base: str, elem: ElementTree.Element) -> str:
+    """
+    Apply the first BaseURL of an element to the parent's base URL
+    """
+    base_url = first_child(elem, 'BaseURL')
+    if base_url is None or not (base_url.text or '').strip():
+        return base
+    return urllib.parse.urljoin(base, base_url.text.strip())
+
+def parse_datetime(value: Optional[str]) -> Optional[float]:
+    """
+    Convert an xs:dateTime (e.g. availabilityStartTime) into a UNIX timestamp
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        when = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return when.timestamp()
+
+def parse_template(template: str, rep_id: str, bandwidth: str) -> List[TemplatePart]:
+    """
+    Split a SegmentTemplate media attribute into literal text and the
+    $Number$ and $Time$ identifiers
+    """
+    parts: List[TemplatePart] = []
+    literal: List[str] = []
+    pos = 0
+    for match in TEMPLATE_ID_RE.finditer(template):
+        literal.append(template[pos:match.start()])
+        pos = match.end()
+        name = match.group('name')
+        if name is None:
+            literal.append('$')
+        elif name == 'RepresentationID':
+            literal.append(rep_id)
+        elif name == 'Bandwidth':
+            literal.append(f'{int(bandwidth):0{int(match.group("width") or 0)}d}')
+        else:
+            parts.append(''.join(literal))
+            literal = []
+            parts.append((name, int(match.group('width') or 0)))
+    literal.append(template[pos:])
+    parts.append(''.join(literal))
+    return [part for part in parts if part != '']
+
+def expand_timeline(timeline: ElementTree.Element,
+                    period_end: Optional[int]) -> List[Tuple[int, int]]:
+    """
+    The start time and duration of every segment in a SegmentTimeline
+    """
+    segments: List[Tuple[int, int]] = []
+    entries = list(children(timeline, 'S'))
+    start = 0
+    for idx, entry in enumerate(entries):
+        start = int(entry.get('t', start))
+        duration = int(entry.get('d', 0))
+        if duration <= 0:
+            break
+        repeat = int(entry.get('r', 0))
+        if repeat < 0:
+            # repeat until the start of the next entry or the end of the period
+            end: Optional[int] = period_end
+            if idx + 1 < len(entries) and entries[idx + 1].get('t') is not None:
+                end = int(entries[idx + 1].get('t'))
+            repeat = 0 if end is None else max(0, math.ceil((end - start) / duration) - 1)
+        for _ in range(repeat + 1):
+            segments.append((start, duration))
+            start += duration
+        if len(segments) > MAX_TIMELINE_SEGMENTS:
+            del segments[:-MAX_TIMELINE_SEGMENTS]
+    return segments
+
+
+class SegmentIndex:
+    """
+    The segments of one Representation. The URL of a segment request is
+    matched using its path, so that any of the alternative BaseURLs
+    (e.g. on different CDNs) can be used.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, url: str, parts: List[TemplatePart], start_number: int,
+                 timescale: int, duration: Optional[int],
+                 timeline: Optional[List[Tuple[int, int]]],
+                 available_from: Optional[float], last_index: Optional[int]) -> None:
+        self.url = url
+        self.parts = parts
+        self.start_number = start_number
+        self.timescale = timescale
+        self.duration = duration
+        self.times = None if timeline is None else [start for start, _ in timeline]
+        self.available_from = available_from
+        self.last_index = last_index
+        path_parts = urllib.parse.urlsplit(self.format_url(None, None, marker=True)).path
+        self.prefix = path_parts.split('\0', 1)[0]
+        pattern = ''.join([re.escape(part) if isinstance(part, str) else
+                           f'(?P<{part[0]}>\\d+)' for part in self.path_parts(path_parts)])
+        self.path_re = re.compile(pattern + '$')
+        self.pattern = pattern
+
+    def path_parts(self, path: str) -> List[TemplatePart]:
+        """
+        Split a path created by format_url(marker=True) back into parts
+        """
+        result: List[TemplatePart] = []
+        identifiers = [part for part in self.parts if not isinstance(part, str)]
+        for idx, literal in enumerate(path.split('\0')):
+            if literal:
+                result.append(literal)
+            if idx < len(identifiers):
+                result.append(identifiers[idx])
+        return result
+
+    def format_url(self, number: Optional[int], start: Optional[int],
+                   marker: bool = False) -> str:
+        """
+        The URL of a segment, or with marker=True the URL with a NUL
+        character in place of each identifier
+        """
+        text: List[str] = []
+        for part in self.parts:
+            if isinstance(part, str):
+                text.append(part)
+            elif marker:
+                text.append('\0')
+            else:
+                value = number if part[0] == 'Number' else start
+                text.append(f'{value:0{part[1]}d}')
+        return urllib.parse.urljoin(self.url, ''.join(text))
+
+    def match(self, path: str) -> Optional[int]:
+        """
+        Find the index of the segment with the given URL path
+        """
+        match = self.path_re.match(path)
+        if match is None:
+            return None
+        groups = match.groupdict()
+        if 'Number' in groups:
+            return int(groups['Number']) - self.start_number
+        if self.times is None:
+            return None
+        start = int(groups['Time'])
+        idx = bisect_right(self.times, start) - 1
+        if idx < 0:
+            return None
+        return idx
+
+    def available_index(self, now: float) -> Optional[int]:
+        """
+        The index of the last segment that is available from origin,
+        or None if it is not known
+        """
+        if self.times is not None:
+            return len(self.times) - 1
+        if self.available_from is not None and self.duration:
+            elapsed = now - self.available_from
+            return math.floor(elapsed * self.timescale / self.duration) - 1
+        return self.last_index
+
+    def following(self, path: str, count: int, now: float) -> List[str]:
+        """
+        The URLs of up to "count" available segments after the segment
+        with the given URL path
+        """
+        index = self.match(path)
+        if index is None:
+            return []
+        last = self.available_index(now)
+        urls: List[str] = []
+        for idx in range(index + 1, index + 1 + count):
+            if idx < 0 or (last is not None and idx > last):
+                break
+            start = None
+            if self.times is not None:
+                start = self.times[idx]
+            urls.append(self.format_url(self.start_number + idx, start))
+        return urls
+
+
+def merged_template(levels: List[Optional[ElementTree.Element]]) -> Tuple[
+        Dict[str, str], Optional[ElementTree.Element]]:
+    """
+    Combine the attributes of the SegmentTemplate elements of a Period,
+    AdaptationSet and Representation, and find the SegmentTimeline
+    """
+    attrs: Dict[str, str] = {}
+    timeline: Optional[ElementTree.Element] = None
+    for template in levels:
+        if template is None:
+            continue
+        attrs.update(template.attrib)
+        found = first_child(template, 'SegmentTimeline')
+        if found is not None:
+            timeline = found
+    return attrs, timeline
+
+# pylint: disable=too-many-locals
+def segment_indexes(manifest_url: str, body: bytes) -> List[SegmentIndex]:
+    """
+    Parse a manifest and create the SegmentIndex of every Representation
+    that uses a SegmentTemplate with $Number$ or $Time$
+    """
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError as err:
+        logging.warning('Failed to parse manifest %s: %s', manifest_url, err)
+        return []
+    dynamic = root.get('type') == 'dynamic'
+    availability_start = parse_datetime(root.get('availabilityStartTime'))
+    presentation_duration = parse_duration(root.get('mediaPresentationDuration') or '')
+    mpd_base = join_base_url(manifest_url, root)
+    indexes: List[SegmentIndex] = []
+    for period in children(root, 'Period'):
+        period_start = parse_duration(period.get('start') or '') or 0.0
+        period_duration = parse_duration(period.get('duration') or '')
+        if period_duration is None and presentation_duration is not None:
+            period_duration = presentation_duration - period_start
+        period_base = join_base_url(mpd_base, period)
+        for adaptation in children(period, 'AdaptationSet'):
+            adaptation_base = join_base_url(period_base, adaptation)
+            for rep in children(adaptation, 'Representation'):
+                attrs, timeline = merged_template([
+                    first_child(period, 'SegmentTemplate'),
+                    first_child(adaptation, 'SegmentTemplate'),
+                    first_child(rep, 'SegmentTemplate')])
+                media = attrs.get('media')
+                if not media:
+                    continue
+                try:
+                    parts = parse_template(media, rep.get('id', ''), rep.get('bandwidth', '0'))
+                    timescale = int(attrs.get('timescale', 1))
+                    start_number = int(attrs.get('startNumber', 1))
+                    duration = int(attrs['duration']) if 'duration' in attrs else None
+                except ValueError as err:
+                    logging.debug('Invalid SegmentTemplate in %s: %s', manifest_url, err)
+                    continue
+                names = {part[0] for part in parts if not isinstance(part, str)}
+                if not names or ('Time' in names and timeline is None):
+                    continue
+                period_end: Optional[int] = None
+                if period_duration is not None:
+                    period_end = int(attrs.get('presentationTimeOffset', 0)) + int(
+                        period_duration * timescale)
+                segments = None
+                if timeline is not None:
+                    segments = expand_timeline(timeline, period_end)
+                elif duration is None:
+                    continue
+                available_from: Optional[float] = None
+                last_index: Optional[int] = None
+                if dynamic and availability_start is not None:
+                    available_from = availability_start + period_start
+                elif period_duration is not None and duration:
+                    last_index = math.ceil(period_duration * timescale / duration) - 1
+                indexes.append(SegmentIndex(
+                    join_base_url(adaptation_base, rep), parts, start_number, timescale,
+                    duration, segments, available_from, last_index))
+    return indexes
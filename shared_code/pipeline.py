@@ -0,0 +1,546 @@
+"""
+The stages of handling a proxy request, which are shared by the Azure
+functions and by both pyproxy servers. Each transport parses the client
+request, makes the origin requests and writes the response in its own
+way, but uses the same pipeline to decide what to fetch from origin, to
+transform and cache the origin response and to create the response.
+
+The stages do not perform any network I/O, so they can be used from
+blocking code and from coroutines.
+"""
+import json
+import logging
+import time
+from typing import (TYPE_CHECKING, Dict, Iterable, Iterator, List, Mapping, NamedTuple,
+    Optional, Union)
+import urllib.parse
+
+from . import metrics
+from .admission import Overloaded
+from .batch import NDJSON_MIMETYPE, batch_items, is_ndjson, wrap_batch
+from .cache import (CacheEntry, CacheWriter, ManifestCache, SegmentCache, cache_key,
+    is_not_modified)
+from .compression import (MEDIA_ACCEPT_ENCODING, ORIGIN_ACCEPT_ENCODING,
+    accept_encoding_headers, choose_encoding, compress, compressible, encoded_headers)
+from .constants import CONDITIONAL_HEADERS, EXCLUDED_HTTP_HEADERS
+from .isobmff import Buffer, PiffStreamPatcher
+from .manifest import (CREATE_FORM_HTML, IncrementalRewriter, extract_url_field,
+    minimum_update_period, proxy_prefix, rewrite_base_urls, wrap_manifest_url)
+from .ranges import (ByteRange, MediaIndex, MediaIndexCache, RangeResponse, RangeWindow,
+    needs_index, origin_range_headers, parse_range, plan_range, range_response)
+from .request import decode_url
+
+if TYPE_CHECKING:
+    from .hedging import HedgePolicy
+    from .prefetch import Prefetcher
+
+class Routes(NamedTuple):
+    """
+    The URL paths of the services provided by the proxy
+    """
+    create: str
+    manifest: str
+    media: str
+
+# The routes of the pyproxy server
+PROXY_ROUTES = Routes('/create', '/mpd/', '/media/')
+
+# The routes of the Azure functions. The function host adds the "/api"
+# prefix to the route of each function.
+AZURE_ROUTES = Routes('/api/create', '/api/dash/', '/api/media/')
+
+
+class ClientRequest(NamedTuple):
+    """
+    The parts of a client request that are used by the pipeline
+    """
+    url: str  # the absolute URL that was used to access the proxy
+    headers: Mapping[str, str]
+    query: Optional[Dict]
+
+
+class OriginRequest(NamedTuple):
+    """
+    A request that needs to be made to origin
+    """
+    url: str
+    headers: Dict[str, str]
+    query: Optional[Dict]
+    key: str
+    entry: Optional[CacheEntry]  # a cached response that is being revalidated
+
+
+class Response:
+    """
+    A response to a client request. The complete body is usually
+    available, but "parts" can also be an iterator that creates the body
+    as it is sent, in which case content_length is None.
+    """
+    __slots__ = ('status_code', 'mimetype', 'headers', 'parts', 'content_length',
+                 'content_encoding', 'entry')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, status_code: int, mimetype: str, headers: Mapping[str, str],
+                 parts: Union[List[Buffer], Iterator[Buffer]],
+                 content_encoding: Optional[str] = None,
+                 entry: Optional[CacheEntry] = None) -> None:
+        self.status_code = status_code
+        self.mimetype = mimetype
+        self.headers = response_headers(headers)
+        self.parts = parts
+        # a 304 Not Modified response does not describe the length of the body
+        self.content_length: Optional[int] = None
+        if status_code != 304 and isinstance(parts, list):
+            self.content_length = sum([len(part) for part in parts])
+        self.content_encoding = content_encoding
+        self.entry = entry  # the cache entry that the body came from
+
+    @property
+    def body(self) -> bytes:
+        """
+        The complete body, as one buffer
+        """
+        if isinstance(self.parts, list) and len(self.parts) == 1:
+            return bytes(self.parts[0])
+        return b''.join(self.parts)
+
+
+def response_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    """
+    The HTTP headers of an origin response that are copied into the
+    response to the client
+    """
+    return {name: value for name, value in headers.items()
+            if name.lower() not in EXCLUDED_HTTP_HEADERS}
+
+def revalidate_headers(headers: Mapping[str, str],
+                       entry: Optional[CacheEntry]) -> Dict[str, str]:
+    """
+    The HTTP headers of an origin request made by a proxy that checks
+    the client's conditional headers itself, so that origin always
+    provides a response that can be cached and shared with other clients
+    """
+    result = {name: value for name, value in headers.items()
+              if name.lower() not in CONDITIONAL_HEADERS}
+    if entry is not None:
+        result.update(entry.validators())
+    return result
+
+def overloaded_response(err: Overloaded) -> Response:
+    """
+    The response to a request whose origin request was rejected by
+    admission control
+    """
+    return Response(503, 'text/plain', {'Retry-After': str(err.retry_after)},
+                    [bytes(str(err), 'utf-8')])
+
+def create_url(routes: Routes, request: ClientRequest, method: str,
+               body: Optional[bytes] = None) -> Response:
+    """
+    Encodes a manifest URL so that it points to the manifest route of
+    the proxy, which is able to extract the original URL and fetch it
+    from origin. A POST request can also encode a batch of URLs (see
+    batch.py).
+    """
+    if method != 'POST' and not request.query:
+        return Response(200, 'text/html', {}, [bytes(CREATE_FORM_HTML, 'utf-8')])
+    content_type = request.headers.get('Content-Type', '')
+    logging.debug('content type: %s', content_type)
+    if method == 'POST':
+        try:
+            items = batch_items(content_type, body)
+        except ValueError as err:
+            return Response(400, 'text/plain', {}, [bytes(f'Invalid batch: {err}', 'utf-8')])
+        if items is not None:
+            ndjson = is_ndjson(content_type)
+            prefix = ''.join(proxy_prefix(request.url) + [routes.manifest])
+            return Response(200, NDJSON_MIMETYPE if ndjson else 'application/json', {},
+                            wrap_batch(items, prefix, ndjson))
+    try:
+        mpd_url = extract_url_field(request.query, content_type, body)
+    except (ValueError, KeyError) as err:
+        logging.error("Failed to extract URL field: %s %s", type(err), err)
+        mpd_url = None
+    if not mpd_url:
+        return Response(
+            400, 'text/plain', {},
+            [b'Field "url" is required either in the query string or in the request body'])
+    result = dict(url=wrap_manifest_url(mpd_url, request.url, routes.manifest))
+    return Response(200, 'application/json', {}, [bytes(json.dumps(result), 'utf-8')])
+
+
+class ManifestPipeline:
+    """
+    Fetches a manifest from origin and wraps the BaseURL fields in the
+    manifest, so that all requests for media segments are directed to
+    the media route of the proxy
+    """
+
+    def __init__(self, routes: Routes, cache: Optional[ManifestCache] = None,
+                 rewriter: Optional[IncrementalRewriter] = None,
+                 prefetcher: Optional["Prefetcher"] = None,
+                 hedging: Optional["HedgePolicy"] = None) -> None:
+        self.routes = routes
+        self.cache = cache
+        self.rewriter = rewriter
+        self.prefetcher = prefetcher
+        self.hedging = hedging
+
+    def begin(self, request: ClientRequest, path: str) -> Union[Response, OriginRequest]:
+        """
+        Respond using the cached manifest, or create the origin request
+        for the encoded manifest URL in "path"
+        """
+        logging.debug('Processing manifest request %s', path)
+        manifest_url = decode_url(path)
+        logging.debug('Manifest origin URL: %s', manifest_url)
+        key = ManifestCache.manifest_key(manifest_url, request.query, request.url)
+        entry: Optional[CacheEntry] = None
+        headers: Mapping[str, str] = request.headers
+        if self.cache is not None:
+            entry = self.cache.get(key)
+            if entry is not None and entry.is_fresh():
+                return self.cached_response(request, entry)
+            # revalidate the cached manifest, rather than passing the
+            # client's conditional headers to origin
+            headers = revalidate_headers(request.headers, entry)
+        return OriginRequest(manifest_url,
+                             accept_encoding_headers(headers, ORIGIN_ACCEPT_ENCODING),
+                             request.query, key, entry)
+
+    def complete(self, request: ClientRequest, origin: OriginRequest, status_code: int,
+                 headers: Mapping[str, str], body: bytes) -> Response:
+        """
+        Rewrite the manifest from the origin response and cache it
+        """
+        if origin.entry is not None and status_code == 304:
+            # the manifest has not changed, so the previous rewrite can be used
+            if not origin.entry.refresh(headers):
+                self.cache.remove(origin.key)
+            return self.cached_response(request, origin.entry)
+        mimetype = headers.get('Content-Type', 'text/dash+xml')
+        parts: List[Buffer] = [body]
+        ttl_hint: Optional[float] = None
+        if status_code == 200 and mimetype == 'application/dash+xml':
+            if self.prefetcher is not None:
+                self.prefetcher.manifest_updated(origin.url, body)
+            if self.hedging is not None:
+                self.hedging.manifest_updated(origin.url, body)
+            started = time.perf_counter()
+            ttl_hint = minimum_update_period(body)
+            # replace the original BaseURL with a URL that points to the
+            # media route of this proxy
+            if ttl_hint is not None and self.rewriter is not None:
+                # a live manifest, where only the end of the manifest
+                # changes each time it is updated
+                parts = [self.rewriter.rewrite(origin.key, body, request.url, self.routes.media)]
+            else:
+                parts = rewrite_base_urls(body, request.url, self.routes.media)
+            metrics.record_stage('manifest_rewrite', time.perf_counter() - started)
+        if self.cache is not None and self.cache.cacheable(status_code, headers, ttl_hint):
+            entry = self.cache.put(origin.key, status_code, mimetype, headers,
+                                   b''.join(parts), ttl_hint)
+            if entry is not None:
+                return self.cached_response(request, entry)
+        encoding: Optional[str] = None
+        if compressible(status_code, mimetype, sum([len(part) for part in parts])):
+            encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is not None:
+            parts = [compress(b''.join(parts), encoding)]
+        return Response(status_code, mimetype, encoded_headers(headers, encoding), parts,
+                        content_encoding=encoding)
+
+    def cached_response(self, request: ClientRequest, entry: CacheEntry) -> Response:
+        """
+        Respond using a cached manifest, or with a 304 Not Modified if
+        the client already has this version of the manifest. The manifest
+        is compressed using a content encoding accepted by the client.
+        """
+        encoding: Optional[str] = None
+        if compressible(entry.status_code, entry.mimetype, len(entry.body)):
+            encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        headers = encoded_headers(entry.response_headers(), encoding)
+        if entry.not_modified(request.headers):
+            return Response(304, entry.mimetype, headers, [])
+        body = entry.body
+        if encoding is not None:
+            body = self.cache.encoded_body(entry, encoding)
+        return Response(entry.status_code, entry.mimetype, headers, [body],
+                        content_encoding=encoding)
+
+
+class MediaTransform:
+    """
+    Patches the PIFF boxes of a media segment as it passes from origin to
+    the client, recording it for the segment cache. The transport feeds
+    each chunk from origin to feed() and sends the returned parts to the
+    client, then calls flush() and finish().
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, pipeline: "MediaPipeline", key: str, status_code: int,
+                 headers: Mapping[str, str], not_modified: bool) -> None:
+        self.pipeline = pipeline
+        self.key = key
+        self.status_code = status_code
+        self.origin_headers = headers
+        self.mimetype = headers.get('Content-Type', 'application/octet-stream')
+        self.headers = response_headers(headers)
+        # the client already has this segment, but it is still
+        # downloaded for the cache and any waiting requests
+        self.not_modified = not_modified
+        # The length of the response is only known in advance if the
+        # body is not being decompressed by the origin HTTP client
+        self.content_length: Optional[int] = None
+        if 'Content-Encoding' not in headers:
+            try:
+                self.content_length = int(headers['Content-Length'])
+            except (KeyError, ValueError):
+                pass
+        self.patcher: Optional[PiffStreamPatcher] = None
+        if status_code == 200 and 'text' not in self.mimetype:
+            # replace PIFF_UUID with FREE_UUID as the segment passes through
+            self.patcher = PiffStreamPatcher()
+        self.writer: Optional[CacheWriter] = None
+        cache = pipeline.cache
+        if cache is not None and cache.cacheable(status_code, headers):
+            self.writer = CacheWriter(cache.max_entry_bytes, self.content_length)
+
+    @property
+    def response_status(self) -> int:
+        """
+        The HTTP status code of the response to the client
+        """
+        return 304 if self.not_modified else self.status_code
+
+    @property
+    def boxes_patched(self) -> int:
+        """
+        The number of PIFF boxes that have been patched
+        """
+        return 0 if self.patcher is None else self.patcher.boxes_patched
+
+    def feed(self, chunk: Buffer) -> List[Buffer]:
+        """
+        Process the next chunk from origin and return the parts to send
+        """
+        parts = [chunk] if self.patcher is None else self.patcher.feed_parts(chunk)
+        if self.writer is not None:
+            for part in parts:
+                self.writer.record(part)
+        return parts
+
+    def flush(self) -> List[Buffer]:
+        """
+        Called once the complete body has been received from origin
+        """
+        parts: List[Buffer] = []
+        if self.patcher is not None:
+            data = self.patcher.flush()
+            if data:
+                parts.append(data)
+                if self.writer is not None:
+                    self.writer.record(data)
+        if self.writer is not None:
+            self.writer.finish()
+        return parts
+
+    def patch(self, chunks: Iterable[Buffer]) -> Iterator[Buffer]:
+        """
+        Generator that transforms each chunk of the segment
+        """
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        yield from self.flush()
+
+    def finish(self) -> None:
+        """
+        Record the patch metrics and store the segment in the cache,
+        once the response has been sent
+        """
+        if self.patcher is not None:
+            logging.debug("PIFF boxes patched: %d", self.patcher.boxes_patched)
+            metrics.record_patch(self.patcher.boxes_patched, self.patcher.elapsed)
+        if self.writer is not None:
+            body = self.writer.body()
+            if body is not None:
+                self.pipeline.cache.put(self.key, self.status_code, self.mimetype,
+                                        self.origin_headers, body)
+
+
+class RangeRequest:
+    """
+    A client request for part of a media file
+    """
+    __slots__ = ('url', 'query', 'key', 'byte_range', 'index', 'window')
+
+    def __init__(self, url: str, query: Optional[Dict], key: str,
+                 byte_range: Optional[ByteRange], index: Optional[MediaIndex]) -> None:
+        self.url = url
+        self.query = query
+        self.key = key
+        self.byte_range = byte_range
+        self.index = index
+        self.window: Optional[RangeWindow] = None
+
+    @property
+    def needs_index(self) -> bool:
+        """
+        Does the box index of the file need to be fetched from origin
+        """
+        return (self.byte_range is not None and self.index is None and
+                needs_index(self.byte_range))
+
+
+class MediaPipeline:
+    """
+    Fetches media segments from origin and removes the PIFF boxes by
+    translating them into "free" boxes
+    """
+
+    def __init__(self, routes: Routes, cache: Optional[SegmentCache] = None,
+                 prefetcher: Optional["Prefetcher"] = None,
+                 media_indexes: Optional[MediaIndexCache] = None,
+                 hedging: Optional["HedgePolicy"] = None) -> None:
+        self.routes = routes
+        self.cache = cache
+        self.prefetcher = prefetcher
+        # the transports use this to hedge the origin requests of segments
+        self.hedging = hedging
+        if media_indexes is None:
+            media_indexes = MediaIndexCache()
+        self.media_indexes = media_indexes
+
+    @staticmethod
+    def origin_url(origin: str, path: str) -> str:
+        """
+        Extract the original BaseURL from the encoded "origin" part of
+        the media route and then append the segment path, to create the
+        URL to fetch from origin
+        """
+        logging.debug('Processing media request %s  %s', origin, path)
+        return urllib.parse.urljoin(decode_url(origin), path)
+
+    def origin_url_from_path(self, path: str) -> str:
+        """
+        The origin URL of a path that follows the media route
+        """
+        origin, _, segment = path.partition('/')
+        return self.origin_url(origin, segment)
+
+    def begin(self, request: ClientRequest, origin_url: str,
+              shared: bool = False) -> Union[Response, OriginRequest]:
+        """
+        Respond using the segment cache, or create the origin request. If
+        "shared" is True, the origin response will be shared with other
+        requests for the same segment.
+        """
+        key = cache_key(origin_url, request.query)
+        if self.cache is not None and self.prefetcher is not None:
+            self.prefetcher.segment_requested(origin_url, request.query)
+        entry: Optional[CacheEntry] = None
+        if self.cache is not None:
+            entry = self.cache.get(key)
+            if entry is not None and entry.is_fresh():
+                return self.cached_response(request, entry)
+        headers: Mapping[str, str] = request.headers
+        if self.cache is not None or shared:
+            headers = revalidate_headers(request.headers, entry)
+        return OriginRequest(origin_url,
+                             accept_encoding_headers(headers, MEDIA_ACCEPT_ENCODING),
+                             request.query, key, entry)
+
+    def revalidated(self, request: ClientRequest, origin: OriginRequest, status_code: int,
+                    headers: Mapping[str, str]) -> Optional[Response]:
+        """
+        Respond using the cached segment if origin has confirmed that it
+        has not changed. Returns None if the origin response needs to be
+        transformed.
+        """
+        if origin.entry is None or status_code != 304:
+            return None
+        if not origin.entry.refresh(headers):
+            self.cache.remove(origin.key)
+        return self.cached_response(request, origin.entry)
+
+    def transform(self, request: ClientRequest, origin: OriginRequest, status_code: int,
+                  headers: Mapping[str, str], shared: bool = False) -> MediaTransform:
+        """
+        Create the transform of a media segment from origin
+        """
+        logging.debug("Origin response: %d", status_code)
+        not_modified = ((self.cache is not None or shared) and status_code == 200 and
+                        is_not_modified(request.headers, headers.get('ETag'),
+                                        headers.get('Last-Modified')))
+        return MediaTransform(self, origin.key, status_code, headers, not_modified)
+
+    @staticmethod
+    def cached_response(request: ClientRequest, entry: CacheEntry) -> Response:
+        """
+        Respond using a cached origin response, or with a 304 Not
+        Modified if the client already has this version of the response
+        """
+        if entry.not_modified(request.headers):
+            return Response(304, entry.mimetype, entry.response_headers(), [])
+        return Response(entry.status_code, entry.mimetype, entry.response_headers(),
+                        [entry.body], entry=entry)
+
+    def begin_range(self, request: ClientRequest, origin_url: str) -> RangeRequest:
+        """
+        Start a Range request. The segment cache only holds complete
+        segments, so Range requests always go to origin. If the
+        needs_index property of the result is True, the transport must
+        fetch the box index of the file and pass it to index_fetched().
+        """
+        key = cache_key(origin_url, request.query)
+        byte_range = parse_range(request.headers.get('Range'))
+        index: Optional[MediaIndex] = None
+        if byte_range is not None and needs_index(byte_range):
+            index = self.media_indexes.get(key)
+        return RangeRequest(origin_url, request.query, key, byte_range, index)
+
+    def index_fetched(self, rng: RangeRequest, index: MediaIndex, probes: int) -> None:
+        """
+        Store the box index of a media file, which needed "probes" origin
+        requests to create
+        """
+        self.media_indexes.put(rng.key, index, probes)
+        rng.index = index
+
+    @staticmethod
+    def range_origin(request: ClientRequest, rng: RangeRequest) -> OriginRequest:
+        """
+        The origin request for a Range request. The range requested from
+        origin is widened to start at a box boundary, so that the PIFF
+        boxes that overlap the requested range can be patched.
+        """
+        if rng.byte_range is not None:
+            rng.window = plan_range(rng.byte_range, rng.index)
+        headers = origin_range_headers(request.headers, rng.window, rng.index)
+        return OriginRequest(rng.url, headers, rng.query, rng.key, None)
+
+    def range_response(self, rng: RangeRequest, status_code: int,
+                       headers: Mapping[str, str]) -> RangeResponse:
+        """
+        Create the response to a Range request from the origin response.
+        If the response has a body, it is passed through the response's
+        slicer, when it has one.
+        """
+        mimetype = headers.get('Content-Type', 'application/octet-stream')
+        response = range_response(rng.window, status_code, headers, mimetype, rng.index)
+        if not response.index_valid:
+            self.media_indexes.remove(rng.key)
+        return response._replace(headers=response_headers(response.headers))
+
+    @staticmethod
+    def range_finished(response: RangeResponse) -> int:
+        """
+        Record the patch metrics of a Range response, once it has been
+        sent. Returns the number of PIFF boxes that were patched.
+        """
+        if response.slicer is None:
+            return 0
+        patcher = response.slicer.patcher
+        logging.debug("PIFF boxes patched: %d", patcher.boxes_patched)
+        metrics.record_patch(patcher.boxes_patched, patcher.elapsed)
+        return patcher.boxes_patched
@@ -0,0 +1,315 @@
+"""
+Background prefetching of media segments. The manifests that pass
+through the proxy are used to predict the segments that a player will
+request next, which are fetched, patched and stored in the segment cache
+before the player asks for them.
+"""
+from collections import OrderedDict
+import logging
+import queue
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import urllib.parse
+
+from . import metrics
+from .cache import CacheEntry, CacheWriter, SegmentCache, cache_key
+from .compression import MEDIA_ACCEPT_ENCODING
+from .constants import SEGMENT_CHUNK_SIZE
+from .isobmff import Buffer, PiffStreamPatcher
+from .mpd import SegmentIndex, segment_indexes
+from .request import fetch
+from .singleflight import Flight, SingleFlight
+
+# A representation that is being played: the origin URL and query of the
+# last segment requested by a player and when it was requested
+ActiveRepresentation = Tuple[str, Optional[Dict], float]
+
+
+class Prefetcher:
+    """
+    Fetches the segments that follow the segments being requested by
+    players. Only representations that a player has requested within
+    the last active_timeout seconds are prefetched. The prefetching is
+    done by a small pool of threads, whose combined download rate is
+    limited to max_bytes_per_sec.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, cache: SegmentCache, segments: int, workers: int = 2,
+                 max_bytes_per_sec: Optional[float] = None,
+                 flights: Optional[SingleFlight] = None, max_queue: int = 64,
+                 active_timeout: float = 30.0, max_manifests: int = 32) -> None:
+        self.cache = cache
+        self.segments = segments
+        self.num_workers = workers
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.flights = flights
+        self.active_timeout = active_timeout
+        self.max_manifests = max_manifests
+        self.jobs: "queue.Queue[Optional[Tuple]]" = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.workers: List[threading.Thread] = []
+        self.manifests: "OrderedDict[str, List[SegmentIndex]]" = OrderedDict()
+        self.active: Dict[Tuple[str, str], ActiveRepresentation] = {}
+        self.pending: Set[str] = set()
+        self.prefetched: "OrderedDict[str, None]" = OrderedDict()
+        self.throttle_until = 0.0
+        self.counters = dict(queued=0, fetched=0, fresh=0, busy=0, dropped=0, errors=0,
+                             hits=0, bytes=0)
+
+    def manifest_updated(self, manifest_url: str, body: bytes) -> None:
+        """
+        Called each time a manifest has been received from origin
+        """
+        self.submit(('manifest', manifest_url, body))
+
+    def segment_requested(self, origin_url: str, query: Optional[Dict]) -> None:
+        """
+        Called for each media segment request from a player, before the
+        segment cache is checked
+        """
+        key = cache_key(origin_url, query)
+        path = urllib.parse.urlsplit(origin_url).path
+        now = time.time()
+        urls: List[str] = []
+        with self.lock:
+            if key in self.prefetched:
+                del self.prefetched[key]
+                self.counters['hits'] += 1
+            found = self.find_index(path)
+            if found is not None:
+                manifest_url, index = found
+                self.active[(manifest_url, index.pattern)] = (origin_url, query, now)
+                urls = [self.origin_url(origin_url, url)
+                        for url in index.following(path, self.segments, now)]
+        for url in urls:
+            self.prefetch(url, query)
+
+    def find_index(self, path: str) -> Optional[Tuple[str, SegmentIndex]]:
+        """
+        Find the manifest and representation of a segment
+        """
+        for manifest_url, indexes in self.manifests.items():
+            for index in indexes:
+                if path.startswith(index.prefix) and index.path_re.match(path) is not None:
+                    return manifest_url, index
+        return None
+
+    @staticmethod
+    def origin_url(requested_url: str, predicted_url: str) -> str:
+        """
+        Use the scheme and host of the player's request, which might be
+        using a different BaseURL to the one found in the manifest
+        """
+        requested = urllib.parse.urlsplit(requested_url)
+        predicted = urllib.parse.urlsplit(predicted_url)
+        return urllib.parse.urlunsplit((requested.scheme, requested.netloc, predicted.path,
+                                        predicted.query, ''))
+
+    def prefetch(self, url: str, query: Optional[Dict]) -> None:
+        """
+        Add a segment to the prefetch queue, unless it is already queued
+        or has already been prefetched
+        """
+        key = cache_key(url, query)
+        with self.lock:
+            if key in self.pending or key in self.prefetched:
+                return
+            self.pending.add(key)
+        if not self.submit(('segment', url, query, key)):
+            with self.lock:
+                self.pending.discard(key)
+
+    def submit(self, job: Tuple) -> bool:
+        """
+        Add a job to the queue, starting the worker threads if needed.
+        The job is dropped if the queue is full, as prefetching must not
+        delay the requests from players.
+        """
+        with self.lock:
+            if not self.workers:
+                for idx in range(self.num_workers):
+                    worker = threading.Thread(target=self.run, name=f'prefetch-{idx}')
+                    worker.daemon = True
+                    worker.start()
+                    self.workers.append(worker)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                self.counters['dropped'] += 1
+            return False
+        if job[0] == 'segment':
+            with self.lock:
+                self.counters['queued'] += 1
+        return True
+
+    def run(self) -> None:
+        """
+        The main loop of each worker thread
+        """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                if job[0] == 'manifest':
+                    self.parse_manifest(job[1], job[2])
+                else:
+                    self.fetch_segment(job[1], job[2], job[3])
+            except Exception as err: # pylint: disable=broad-except
+                # a failed prefetch must not stop the worker thread
+                logging.warning('Prefetch of %s failed: %s', job[1], err)
+                with self.lock:
+                    self.counters['errors'] += 1
+            finally:
+                if job[0] == 'segment':
+                    with self.lock:
+                        self.pending.discard(job[3])
+
+    def parse_manifest(self, manifest_url: str, body: bytes) -> None:
+        """
+        Update the segment indexes of a manifest and prefetch the segments
+        that are now available for the representations being played
+        """
+        indexes = segment_indexes(manifest_url, body)
+        now = time.time()
+        urls: List[Tuple[str, Optional[Dict]]] = []
+        with self.lock:
+            self.manifests.pop(manifest_url, None)
+            if indexes:
+                self.manifests[manifest_url] = indexes
+            while len(self.manifests) > self.max_manifests:
+                self.manifests.popitem(last=False)
+            self.active = {key: value for key, value in self.active.items()
+                           if now - value[2] < self.active_timeout}
+            for index in indexes:
+                active = self.active.get((manifest_url, index.pattern))
+                if active is None:
+                    continue
+                origin_url, query, _ = active
+                path = urllib.parse.urlsplit(origin_url).path
+                urls += [(self.origin_url(origin_url, url), query)
+                         for url in index.following(path, self.segments, now)]
+        for url, query in urls:
+            self.prefetch(url, query)
+
+    def fetch_segment(self, url: str, query: Optional[Dict], key: str) -> None:
+        """
+        Fetch a segment from origin, remove its PIFF boxes and store it
+        in the segment cache
+        """
+        entry = self.cache.peek(key)
+        if entry is not None and entry.is_fresh():
+            with self.lock:
+                self.counters['fresh'] += 1
+            return
+        flight = None
+        if self.flights is not None:
+            flight = self.flights.lead(key)
+            if flight is None:
+                # a player is already fetching this segment
+                with self.lock:
+                    self.counters['busy'] += 1
+                return
+        try:
+            self.fetch_and_store(url, query, key, entry, flight)
+        except BaseException as err:
+            if flight is not None:
+                flight.finish(err)
+            raise
+        finally:
+            if flight is not None:
+                self.flights.leave(flight)
+
+    # pylint: disable=too-many-arguments
+    def fetch_and_store(self, url: str, query: Optional[Dict], key: str,
+                        entry: Optional[CacheEntry], flight: Optional[Flight]) -> None:
+        """
+        Make the origin request of a prefetch. Prefetch requests do not
+        contain any of the HTTP headers of a player's request.
+        """
+        origin_headers = {} if entry is None else entry.validators()
+        origin_headers['Accept-Encoding'] = MEDIA_ACCEPT_ENCODING
+        origin = fetch(url, origin_headers, query, stream=True)
+        try:
+            if entry is not None and origin.status_code == 304:
+                if not entry.refresh(origin.headers):
+                    self.cache.remove(key)
+                with self.lock:
+                    self.counters['fresh'] += 1
+                return
+            mimetype = origin.headers.get('Content-Type', 'application/octet-stream')
+            if (origin.status_code != 200 or 'text' in mimetype or
+                    not self.cache.cacheable(origin.status_code, origin.headers)):
+                logging.debug('Prefetch of %s not cacheable: %d', url, origin.status_code)
+                return
+            content_length: Optional[int] = None
+            if 'Content-Encoding' not in origin.headers:
+                try:
+                    content_length = int(origin.headers['Content-Length'])
+                except (KeyError, ValueError):
+                    pass
+            patcher = PiffStreamPatcher()
+            chunks = patcher.patch(self.throttle(metrics.timed_chunks(
+                origin.iter_content(chunk_size=SEGMENT_CHUNK_SIZE))))
+            writer = CacheWriter(self.cache.max_entry_bytes, content_length)
+            chunks = writer.tee(chunks)
+            if flight is not None:
+                flight.start(origin.status_code, mimetype, origin.headers, content_length)
+                chunks = flight.publish(chunks)
+            for _ in chunks:
+                pass
+        finally:
+            origin.close()
+        metrics.record_patch(patcher.boxes_patched, patcher.elapsed)
+        body = writer.body()
+        if body is None:
+            return
+        self.cache.put(key, origin.status_code, mimetype, origin.headers, body)
+        with self.lock:
+            self.counters['fetched'] += 1
+            self.counters['bytes'] += len(body)
+            self.prefetched[key] = None
+            while len(self.prefetched) > 4 * self.jobs.maxsize:
+                self.prefetched.popitem(last=False)
+
+    def throttle(self, chunks: Iterable[Buffer]) -> Iterator[Buffer]:
+        """
+        Generator that delays each chunk, so that the combined download
+        rate of all of the workers does not exceed max_bytes_per_sec
+        """
+        for chunk in chunks:
+            if self.max_bytes_per_sec:
+                now = time.monotonic()
+                with self.lock:
+                    start = max(now, self.throttle_until)
+                    self.throttle_until = start + len(chunk) / self.max_bytes_per_sec
+                if start > now:
+                    time.sleep(start - now)
+            yield chunk
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Prefetch statistics
+        """
+        with self.lock:
+            result = dict(self.counters)
+            result['pending'] = len(self.pending)
+            result['manifests'] = len(self.manifests)
+            result['active'] = len(self.active)
+            return result
+
+    def stop(self) -> None:
+        """
+        Stop the worker threads, once they have finished their current job
+        """
+        with self.lock:
+            workers = self.workers
+            self.workers = []
+        for _ in workers:
+            try:
+                self.jobs.put(None, timeout=1.0)
+            except queue.Full:
+                break
@@ -0,0 +1,435 @@
+"""
+HTTP Range requests for media files that contain PIFF boxes. The
+PiffStreamPatcher can only walk the boxes of a file from the start of a
+box, so the range that is requested from origin is widened to start at
+the nearest box boundary before the range requested by the client. The
+box boundaries of each file are found from its segment index (sidx) box.
+"""
+from bisect import bisect_right
+from collections import OrderedDict
+import logging
+import re
+import threading
+from typing import Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple
+
+from .compression import MEDIA_ACCEPT_ENCODING
+from .constants import CONDITIONAL_HEADERS, PIFF_UUID
+from .isobmff import Buffer, PiffStreamPatcher, parse_box_header, parse_sidx
+from .request import fetch
+
+RANGE_RE = re.compile(r'^bytes=\s*(?P<first>\d*)\s*-\s*(?P<last>\d*)\s*$')
+
+CONTENT_RANGE_RE = re.compile(r'^bytes\s+(?P<first>\d+)-(?P<last>\d+)/(?P<total>\d+|\*)$')
+
+# Number of bytes requested from origin for each search for the sidx box
+INDEX_PROBE_SIZE = 64 * 1024
+
+# Maximum number of origin requests used to search for the sidx box
+MAX_INDEX_PROBES = 4
+
+# Maximum number of bytes before the requested range that will be fetched
+# from origin, to start at a box boundary. If the nearest known boundary
+# is further away, the Range header is ignored and the complete file is sent.
+MAX_RANGE_WIDEN = 8 * 1024 * 1024
+
+# Boxes that contain media data, which are not followed by a sidx box
+MEDIA_BOXES = frozenset({b'moof', b'mdat'})
+
+
+class ByteRange(NamedTuple):
+    """
+    A single range from a Range header. Either "first" is set, or it is
+    a suffix range of the last "suffix" bytes of the file.
+    """
+    first: Optional[int]
+    last: Optional[int]
+    suffix: Optional[int]
+
+def parse_range(value: Optional[str]) -> Optional[ByteRange]:
+    """
+    Parse the Range header of a request. Returns None if the header is
+    not a valid single byte range, in which case it is ignored.
+    """
+    if not value:
+        return None
+    match = RANGE_RE.match(value.strip())
+    if match is None:
+        return None
+    first, last = match.group('first'), match.group('last')
+    if not first:
+        if not last or int(last) == 0:
+            return None
+        return ByteRange(None, None, int(last))
+    if last and int(last) < int(first):
+        return None
+    return ByteRange(int(first), int(last) if last else None, None)
+
+def parse_content_range(value: Optional[str]) -> Optional[Tuple[int, int, Optional[int]]]:
+    """
+    Parse the Content-Range header of a 206 response, into the first and
+    last byte and the total length (if known)
+    """
+    if not value:
+        return None
+    match = CONTENT_RANGE_RE.match(value.strip())
+    if match is None:
+        return None
+    total = None if match.group('total') == '*' else int(match.group('total'))
+    return int(match.group('first')), int(match.group('last')), total
+
+
+class MediaIndex:
+    """
+    The known box boundaries of one media file. It is created by walking
+    the top level boxes from the start of the file until the sidx box
+    is found, which provides the offset of every subsegment.
+    """
+
+    def __init__(self) -> None:
+        self.boundaries: List[int] = [0]
+        self.size: Optional[int] = None
+        self.etag: Optional[str] = None
+        self.next_offset: Optional[int] = 0  # the next box header to read from origin
+        self.has_sidx = False
+
+    def probe_range(self) -> str:
+        """
+        The Range header of the next origin request for the box headers
+        """
+        return f'bytes={self.next_offset}-{self.next_offset + INDEX_PROBE_SIZE - 1}'
+
+    def add_response(self, status_code: int, headers: Mapping[str, str], body: Buffer) -> bool:
+        """
+        Walk the boxes in a response to a request using probe_range().
+        Returns False if the response could not be used.
+        """
+        self.etag = headers.get('ETag')
+        if status_code == 200:
+            # origin does not support Range requests
+            self.size = len(body)
+            self.next_offset = 0
+            self.add(body, 0)
+            return True
+        content_range = parse_content_range(headers.get('Content-Range'))
+        if status_code != 206 or content_range is None or content_range[0] != self.next_offset:
+            self.next_offset = None
+            return False
+        self.size = content_range[2]
+        self.add(body, content_range[0])
+        return True
+
+    def add(self, data: Buffer, start: int) -> None:
+        """
+        Walk the top level boxes in the given data, which starts at the
+        box header at file offset "start"
+        """
+        view = memoryview(data)
+        offset = start
+        self.next_offset = None
+        while self.size is None or offset < self.size:
+            try:
+                header = parse_box_header(view, offset - start)
+            except ValueError:
+                return
+            if header is None:
+                # the box header is in the next probe
+                self.next_offset = offset
+                return
+            self.add_boundary(offset)
+            if header.size == 0:
+                return
+            if header.box_type in MEDIA_BOXES and offset + header.size - start > len(view):
+                # without a sidx box, finding the rest of the boundaries
+                # would need an origin request for every fragment
+                return
+            if header.box_type == b'sidx':
+                if offset + header.size - start > len(view):
+                    self.next_offset = offset
+                    return
+                try:
+                    subsegments = parse_sidx(view, offset - start, header)
+                except ValueError:
+                    return
+                for boundary in subsegments:
+                    self.add_boundary(start + boundary)
+                self.has_sidx = True
+                return
+            offset += header.size
+            if offset - start >= len(view):
+                self.next_offset = offset
+                return
+
+    def add_boundary(self, offset: int) -> None:
+        """
+        Record the file offset of the start of a top level box
+        """
+        idx = bisect_right(self.boundaries, offset)
+        if self.boundaries[idx - 1] != offset:
+            self.boundaries.insert(idx, offset)
+
+    def boundary_before(self, offset: int) -> int:
+        """
+        The offset of the last known box boundary at or before "offset"
+        """
+        return self.boundaries[bisect_right(self.boundaries, offset) - 1]
+
+
+class MediaIndexCache:
+    """
+    A thread-safe least-recently-used cache of MediaIndex objects, so
+    that only the first Range request for each file needs to search for
+    its sidx box
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, MediaIndex]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+
+    def get(self, key: str) -> Optional[MediaIndex]:
+        """
+        Find the index of a media file
+        """
+        with self.lock:
+            index = self.entries.get(key)
+            if index is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return index
+
+    def put(self, key: str, index: MediaIndex, probes: int) -> None:
+        """
+        Store the index of a media file, that needed "probes" origin requests
+        """
+        with self.lock:
+            self.probes += probes
+            self.entries[key] = index
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def remove(self, key: str) -> None:
+        """
+        Remove the index of a media file, e.g. because the file has changed
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Index cache statistics
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'probes': self.probes,
+            }
+
+
+class RangeWindow(NamedTuple):
+    """
+    The range requested by the client (first to last) and the wider
+    range that is requested from origin (start to end). A value of None
+    for "last" or "end" means the end of the file.
+    """
+    first: int
+    last: Optional[int]
+    start: int
+    end: Optional[int]
+
+    def origin_range(self) -> str:
+        """
+        The Range header of the origin request
+        """
+        return f'bytes={self.start}-{"" if self.end is None else self.end}'
+
+def needs_index(byte_range: ByteRange) -> bool:
+    """
+    Check if the box boundaries of the file are needed for this range
+    """
+    return byte_range.first != 0
+
+def plan_range(byte_range: ByteRange, index: Optional[MediaIndex]) -> Optional[RangeWindow]:
+    """
+    Decide which part of the file to request from origin. Returns None if
+    the range cannot be served, in which case the complete file is sent.
+    """
+    first = byte_range.first
+    last = byte_range.last
+    if first is None:
+        if index is None or index.size is None:
+            return None
+        first = max(0, index.size - byte_range.suffix)
+    start = 0 if index is None else index.boundary_before(first)
+    if first - start > MAX_RANGE_WIDEN:
+        return None
+    end: Optional[int] = None
+    if last is not None:
+        # enough extra bytes to check if a box header that overlaps the
+        # end of the range is a PIFF box
+        end = last + len(PIFF_UUID)
+    return RangeWindow(first, last, start, end)
+
+def probe_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    """
+    The HTTP headers of the origin requests made by fetch_index(), which
+    are the client's headers without any that would change the response
+    """
+    result = {name: value for name, value in headers.items()
+              if name.lower() not in CONDITIONAL_HEADERS and
+              name.lower() not in {'range', 'if-range', 'accept-encoding'}}
+    result['Accept-Encoding'] = MEDIA_ACCEPT_ENCODING
+    return result
+
+def origin_range_headers(headers: Mapping[str, str], window: Optional[RangeWindow],
+                         index: Optional[MediaIndex]) -> Dict[str, str]:
+    """
+    The HTTP headers of the origin request for a client's Range request.
+    If-Range is used to make sure that the file has not changed since
+    its index was created, as otherwise the range might not start at a
+    box boundary.
+    """
+    origin_headers = {name: value for name, value in headers.items()
+                      if name.lower() not in {'range', 'accept-encoding'}}
+    # byte ranges only make sense for the uncompressed file
+    origin_headers['Accept-Encoding'] = MEDIA_ACCEPT_ENCODING
+    if window is None:
+        return origin_headers
+    origin_headers['Range'] = window.origin_range()
+    if (index is not None and index.etag and not index.etag.startswith('W/') and
+            not any(name.lower() == 'if-range' for name in origin_headers)):
+        origin_headers['If-Range'] = index.etag
+    return origin_headers
+
+def fetch_index(url: str, headers: Mapping[str, str],
+                params: Optional[Dict]) -> Tuple[MediaIndex, int]:
+    """
+    Create the index of a media file, using Range requests for the box
+    headers at the start of the file. Returns the index and the number
+    of origin requests that were made.
+    """
+    index = MediaIndex()
+    probes = 0
+    while index.next_offset is not None and probes < MAX_INDEX_PROBES:
+        origin_headers = dict(headers)
+        origin_headers['Range'] = index.probe_range()
+        response = fetch(url, origin_headers, params)
+        probes += 1
+        if not index.add_response(response.status_code, response.headers, response.content):
+            break
+    return index, probes
+
+
+class RangeSlicer:
+    """
+    Patches the PIFF boxes of an origin response that starts at file
+    offset "start" and passes on only the bytes from "first" to "last"
+    """
+
+    def __init__(self, start: int, first: int, last: Optional[int]) -> None:
+        self.patcher = PiffStreamPatcher(start)
+        self.position = start  # file offset of the next byte from the patcher
+        self.first = first
+        self.last = last
+
+    def feed_parts(self, chunk: Buffer) -> List[Buffer]:
+        """
+        Process the next chunk of the origin response and return the
+        data that can be sent to the client
+        """
+        return self.trim(self.patcher.feed_parts(chunk))
+
+    def flush(self) -> List[Buffer]:
+        """
+        The data that is still being held back by the patcher
+        """
+        return self.trim([self.patcher.flush()])
+
+    def trim(self, parts: List[Buffer]) -> List[Buffer]:
+        """
+        Remove any data that is outside of the requested range
+        """
+        result: List[Buffer] = []
+        for part in parts:
+            pos = self.position
+            self.position += len(part)
+            begin = max(self.first - pos, 0)
+            end = len(part)
+            if self.last is not None:
+                end = min(end, self.last + 1 - pos)
+            if begin == 0 and end == len(part):
+                result.append(part)
+            elif begin < end:
+                result.append(memoryview(part)[begin:end])
+        return result
+
+    def patch(self, chunks: Iterable[Buffer]) -> Iterator[Buffer]:
+        """
+        Generator that patches and trims each chunk of the origin response
+        """
+        for chunk in chunks:
+            yield from self.feed_parts(chunk)
+        yield from self.flush()
+
+
+class RangeResponse(NamedTuple):
+    """
+    The response to send to a client for a Range request
+    """
+    status_code: int
+    headers: Dict[str, str]
+    content_length: Optional[int]
+    slicer: Optional[RangeSlicer]  # None if the origin response is sent unmodified
+    send_body: bool
+    index_valid: bool  # False if the MediaIndex of the file is out of date
+
+def range_response(window: Optional[RangeWindow], status_code: int,
+                   headers: Mapping[str, str], mimetype: str,
+                   index: Optional[MediaIndex] = None) -> RangeResponse:
+    """
+    Decide how to respond to the client, using the origin response to
+    the Range request described by "window"
+    """
+    out_headers = {name: value for name, value in headers.items()
+                   if name.lower() != 'content-range'}
+    content_length: Optional[int] = None
+    if 'Content-Encoding' not in headers:
+        try:
+            content_length = int(headers['Content-Length'])
+        except (KeyError, ValueError):
+            pass
+    patch = 'text' not in mimetype
+    etag = headers.get('ETag')
+    index_valid = index is None or etag is None or index.etag == etag
+    if status_code == 200:
+        # the Range header was ignored, or the file has changed since the
+        # index was created and origin did not accept the If-Range header
+        return RangeResponse(200, out_headers, content_length,
+                             RangeSlicer(0, 0, None) if patch else None, True, index_valid)
+    content_range = parse_content_range(headers.get('Content-Range'))
+    if status_code != 206 or window is None or content_range is None:
+        return RangeResponse(status_code, dict(headers), content_length, None, True,
+                             index_valid)
+    start, end, total = content_range
+    if start != window.start:
+        # the patcher needs to start at the box boundary that was requested
+        logging.warning('Origin sent bytes %d-%d when %s was requested', start, end,
+                        window.origin_range())
+        return RangeResponse(502, {}, 0, None, False, False)
+    last = end if window.last is None else min(window.last, end)
+    if window.first > last:
+        out_headers['Content-Range'] = f'bytes */{"*" if total is None else total}'
+        return RangeResponse(416, out_headers, 0, None, False, index_valid)
+    out_headers['Content-Range'] = (f'bytes {window.first}-{last}/'
+                                    f'{"*" if total is None else total}')
+    slicer = RangeSlicer(start, window.first, last)
+    if not patch:
+        slicer.patcher.next_box = None
+    return RangeResponse(206, out_headers, last + 1 - window.first, slicer, True, index_valid)
@@ -1,11 +1,19 @@
 """
 Utility function to make an HTTP request to origin
 """
+import functools
 import logging
-from typing import Dict, Optional
-import urllib
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Mapping, Optional, Tuple
+import urllib.parse
 
-import requests
+from . import metrics
+from .constants import HOP_BY_HOP_HEADERS
+
+if TYPE_CHECKING:
+    import requests
 
 ESCAPE_TABLE = [
     ('!', '!!'),
@@ -16,6 +24,12 @@ ESCAPE_TABLE = [
     ('?', '!4'),
 ]
 
+# The number of URLs remembered by encode_url and decode_url. A session
+# only uses a small number of manifest and BaseURL values, which are
+# encoded for every manifest and decoded for every media segment.
+URL_CODEC_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=URL_CODEC_CACHE_SIZE)
 def encode_url(url: str) -> str:
     """
     Wrap the given URL into a form that can be used as a path
@@ -30,25 +44,172 @@ def encode_url(url: str) -> str:
         url = url.replace(in_chr, out_str)
     return url
 
+@functools.lru_cache(maxsize=URL_CODEC_CACHE_SIZE)
 def decode_url(url: str) -> str:
     """
     Undo the output of encode_url function
     """
-    for in_chr, out_str in reversed(ESCAPE_TABLE):
+    if '!!' in url:
+        # An escaped "!" must be decoded first, without it being combined
+        # with the following character, so that "!!0" becomes "!0"
+        return '!'.join([_unescape(part) for part in url.split('!!')])
+    return _unescape(url)
+
+def _unescape(url: str) -> str:
+    """
+    Decode all escape sequences except "!!"
+    """
+    for in_chr, out_str in ESCAPE_TABLE[1:]:
         url = url.replace(out_str, in_chr)
     return url
 
-def fetch(url: str, headers: Dict, params: Optional[Dict]) -> requests.Response:
+class OriginPool:
+    """
+    A thread-safe pool of keep-alive connections to origin servers.
+    Up to "pool_size" connections are kept open for each origin host,
+    so that requests for manifests and media segments can re-use an
+    existing TCP (and TLS) connection.
     """
-    Make an HTTP GET request to origin. It copies the HTTP headers
-    from the client request into the origin request. Any query
-    parameters are also copied into the origin request.
 
-    :req: the client request
-    :url: The origin URL
+    def __init__(self, pool_size: int = 10, retries: int = 2,
+                 connect_timeout: float = 3.05, read_timeout: float = 30.0,
+                 max_hosts: int = 32) -> None:
+        self.pool_size = pool_size
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_hosts = max_hosts
+        # requests is imported when the first pool is created, rather than
+        # when this module is imported, so that an Azure function that
+        # does not make origin requests starts more quickly
+        # pylint: disable=import-outside-toplevel
+        from http.cookiejar import DefaultCookiePolicy
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.session = requests.Session()
+        # The session is shared by all clients of the proxy, so cookies
+        # from one origin response must never be sent on another request
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        retry = Retry(total=retries, status_forcelist=(), backoff_factor=0.1,
+                      allowed_methods=frozenset({'GET', 'HEAD'}), raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=pool_size,
+                                   max_retries=retry)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    @classmethod
+    def from_environment(cls, env: Optional[Dict] = None) -> "OriginPool":
+        """
+        Create a pool using the settings from environment variables,
+        such as the application settings of an Azure function
+        """
+        if env is None:
+            env = os.environ
+        return cls(pool_size=int(env.get('DASHPIFF_POOL_SIZE', 10)),
+                   retries=int(env.get('DASHPIFF_RETRIES', 2)),
+                   connect_timeout=float(env.get('DASHPIFF_CONNECT_TIMEOUT', 3.05)),
+                   read_timeout=float(env.get('DASHPIFF_READ_TIMEOUT', 30.0)),
+                   max_hosts=int(env.get('DASHPIFF_POOL_HOSTS', 32)))
+
+    def get(self, url: str, headers: Dict, stream: bool = False) -> "requests.Response":
+        """
+        Make an HTTP GET request using a pooled connection
+        """
+        return self.session.get(url, headers=headers, stream=stream,
+                                timeout=(self.connect_timeout, self.read_timeout))
+
+    def warm(self, url: str) -> bool:
+        """
+        Open a keep-alive connection to the origin of the given URL,
+        using a HEAD request, so that the first request to that origin
+        does not need to wait for a new TCP (and TLS) connection.
+        Returns False if the request failed.
+        """
+        try:
+            self.session.head(url, timeout=(self.connect_timeout, self.read_timeout))
+        except Exception as err: # pylint: disable=broad-except
+            logging.warning('Failed to connect to %s: %s', url, err)
+            return False
+        return True
+
+    def stats(self) -> Dict:
+        """
+        Connection re-use statistics for each origin host.
+        "hits" is the number of requests that re-used an existing connection.
+        """
+        hosts: Dict[str, Dict[str, int]] = {}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            name = f'{pool.scheme}://{pool.host}:{pool.port}'
+            hosts[name] = {
+                'requests': pool.num_requests,
+                'connections': pool.num_connections,
+                'hits': max(0, pool.num_requests - pool.num_connections),
+            }
+        total_requests = sum(host['requests'] for host in hosts.values())
+        total_hits = sum(host['hits'] for host in hosts.values())
+        return {
+            'requests': total_requests,
+            'connections': sum(host['connections'] for host in hosts.values()),
+            'hits': total_hits,
+            'reuse_ratio': (total_hits / total_requests) if total_requests else 0.0,
+            'hosts': hosts,
+        }
+
+
+_pool_lock = threading.Lock()
+_origin_pool: Optional[OriginPool] = None
+
+def configure_pool(**kwargs) -> OriginPool:
+    """
+    Replace the origin connection pool with one that uses the given
+    settings. See OriginPool for the available settings.
+    """
+    global _origin_pool # pylint: disable=global-statement
+    with _pool_lock:
+        _origin_pool = OriginPool(**kwargs)
+        return _origin_pool
+
+def origin_pool() -> OriginPool:
+    """
+    Get the origin connection pool, creating it from the environment
+    settings if configure_pool() has not been called.
+    """
+    global _origin_pool # pylint: disable=global-statement
+    with _pool_lock:
+        if _origin_pool is None:
+            _origin_pool = OriginPool.from_environment()
+        return _origin_pool
+
+def pool_stats() -> Dict:
+    """
+    The statistics of the origin connection pool, without creating the
+    pool (and importing requests) if no origin requests have been made
+    """
+    with _pool_lock:
+        pool = _origin_pool
+    if pool is None:
+        return {'requests': 0, 'connections': 0, 'hits': 0, 'reuse_ratio': 0.0, 'hosts': {}}
+    return pool.stats()
+
+def origin_request(url: str, headers: Mapping[str, str],
+                   params: Optional[Dict]) -> Tuple[str, Dict[str, str]]:
+    """
+    Create the URL and HTTP headers of an origin request. It copies the
+    HTTP headers from the client request into the origin request. Any
+    query parameters are also copied into the origin request.
     """
     origin_headers: Dict[str, str] = {}
-    origin_headers.update(headers)
+    for key, value in headers.items():
+        # hop-by-hop headers (e.g. "Connection: close") apply to the client
+        # connection and must not stop the origin connection being re-used
+        if key.lower() not in HOP_BY_HOP_HEADERS:
+            origin_headers[key] = value
     parts = urllib.parse.urlparse(url)
     query = parts.query
     if params:
@@ -59,5 +220,31 @@ def fetch(url: str, headers: Dict, params: Optional[Dict]) -> requests.Response:
     origin_headers['host'] = parts.hostname
     origin_url = urllib.parse.urlunsplit((parts.scheme, parts.netloc,
         parts.path, query, parts.fragment))
+    return origin_url, origin_headers
+
+def fetch(url: str, headers: Dict, params: Optional[Dict],
+          stream: bool = False) -> "requests.Response":
+    """
+    Make an HTTP GET request to origin. It copies the HTTP headers
+    from the client request into the origin request. Any query
+    parameters are also copied into the origin request.
+
+    :url: The origin URL
+    :headers: the HTTP headers from the client request
+    :params: the query parameters from the client request
+    :stream: if True, the body is not downloaded until it is read from
+        the response using iter_content()
+    """
+    origin_url, origin_headers = origin_request(url, headers, params)
     logging.debug("Origin request %s", origin_url)
-    return requests.get(origin_url, headers=origin_headers)
+    started = time.perf_counter()
+    response = origin_pool().get(origin_url, headers=origin_headers, stream=stream)
+    # the elapsed time is from sending the request until the response
+    # headers have been parsed, which includes connecting to origin
+    ttfb = response.elapsed.total_seconds()
+    metrics.record_stage('origin_ttfb', ttfb)
+    if not stream:
+        metrics.record_stage('origin_download',
+                             max(0.0, time.perf_counter() - started - ttfb))
+        metrics.record_bytes('in', len(response.content))
+    return response
@@ -0,0 +1,256 @@
+"""
+Request coalescing, so that concurrent requests for the same origin URL
+share one origin request
+"""
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from .isobmff import Buffer
+
+class FlightError(Exception):
+    """
+    The origin request that was being waited for failed
+    """
+
+class FlightTimeout(FlightError):
+    """
+    Timed out waiting for the origin request
+    """
+
+class FlightAbandoned(FlightError):
+    """
+    The origin request was not completed, because the client that
+    made it did not need the response body. The waiting requests need
+    to make their own origin request.
+    """
+
+
+class Flight:
+    """
+    One origin request, the response of which is shared by every request
+    that was waiting for it. The response can either be streamed, while
+    it is still being received from origin, or buffered. The chunks of
+    the response are kept for the lifetime of the flight, so that a request
+    that joins late can replay them. If the response grows beyond max_bytes
+    while no request is waiting, its chunks are dropped and the flight
+    stops accepting new requests.
+    """
+
+    def __init__(self, key: str, timeout: float, max_bytes: int = 0) -> None:
+        self.key = key
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        self.started = False
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.status_code: int = 0
+        self.mimetype: str = ''
+        self.headers: Mapping[str, str] = {}
+        self.content_length: Optional[int] = None
+        self.chunks: List[Buffer] = []
+        self.size: int = 0
+        self.waiters: int = 0
+        self.joinable = True
+
+    def start(self, status_code: int, mimetype: str, headers: Mapping[str, str],
+              content_length: Optional[int] = None) -> None:
+        """
+        Called by the leader once the origin response headers are available
+        """
+        with self.cond:
+            self.status_code = status_code
+            self.mimetype = mimetype
+            self.headers = headers
+            self.content_length = content_length
+            self.started = True
+            self.cond.notify_all()
+
+    def add_waiter(self) -> bool:
+        """
+        Join the flight as a waiting request. Returns False if the flight
+        is no longer keeping the chunks of its response.
+        """
+        with self.cond:
+            if not self.joinable:
+                return False
+            self.waiters += 1
+            return True
+
+    def leader_gone(self) -> bool:
+        """
+        Called when the client that made the origin request has gone. New
+        requests can no longer join the flight. Returns True if the
+        response is still needed by the requests that are waiting for it.
+        """
+        with self.cond:
+            self.joinable = False
+            return self.waiters > 0
+
+    def publish(self, chunks: Iterable[Buffer]) -> Iterator[Buffer]:
+        """
+        Generator used by the leader that shares each chunk of the response
+        with the waiting requests as it passes through. The chunks are
+        shared without being copied, so they must not be modified.
+        """
+        try:
+            for chunk in chunks:
+                with self.cond:
+                    if (self.joinable and not self.waiters and
+                            self.size + len(chunk) > self.max_bytes):
+                        # too large to keep on the chance that another
+                        # request will arrive for it
+                        self.joinable = False
+                        self.chunks = []
+                        self.size = 0
+                    if self.joinable or self.waiters:
+                        self.chunks.append(chunk)
+                        self.size += len(chunk)
+                        self.cond.notify_all()
+                yield chunk
+        except GeneratorExit:
+            self.finish(FlightError(f'Origin request for {self.key} was cancelled'))
+            raise
+        except Exception as err:
+            self.finish(err)
+            raise
+        self.finish()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """
+        Mark the origin request as complete. Has no effect if it
+        was already complete.
+        """
+        with self.cond:
+            if self.done:
+                return
+            self.error = error
+            self.done = True
+            self.cond.notify_all()
+
+    def wait_started(self, timeout: Optional[float] = None) -> None:
+        """
+        Wait for the response headers to be available
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not self.started:
+                if self.done:
+                    raise self._failure()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise FlightTimeout(f'Timeout waiting for origin request for {self.key}')
+                self.cond.wait(remaining)
+
+    def iter_chunks(self, timeout: Optional[float] = None) -> Iterator[Buffer]:
+        """
+        Generator that yields each chunk of the response as it is received.
+        The timeout applies to the wait for each chunk.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        self.wait_started(timeout)
+        index = 0
+        while True:
+            with self.cond:
+                deadline = time.monotonic() + timeout
+                while index >= len(self.chunks) and not self.done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise FlightTimeout(f'Timeout waiting for origin data for {self.key}')
+                    self.cond.wait(remaining)
+                pending = self.chunks[index:]
+                if not pending and self.done:
+                    if self.error is not None:
+                        raise self._failure()
+                    return
+            index += len(pending)
+            for chunk in pending:
+                yield chunk
+
+    def body(self, timeout: Optional[float] = None) -> bytes:
+        """
+        Wait for the complete response body
+        """
+        return b''.join(self.iter_chunks(timeout))
+
+    def _failure(self) -> FlightError:
+        if isinstance(self.error, FlightError):
+            return self.error
+        if self.error is None:
+            return FlightAbandoned(f'Origin request for {self.key} was abandoned')
+        err = FlightError(f'Origin request for {self.key} failed: {self.error}')
+        err.__cause__ = self.error
+        return err
+
+
+class SingleFlight:
+    """
+    Keeps track of the origin requests that are in progress. The first
+    request for a key becomes the leader and makes the origin request,
+    any concurrent requests for the same key wait for its response.
+    Up to max_bytes of each response is kept for requests that arrive
+    after it has started to be received.
+    """
+
+    def __init__(self, timeout: float = 10.0, max_bytes: int = 16 * 1024 * 1024) -> None:
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """
+        Join the flight for the given key. Returns the flight and True if
+        the caller is the leader that must make the origin request.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and flight.add_waiter():
+                self.followers += 1
+                return flight, False
+            flight = Flight(key, self.timeout, self.max_bytes)
+            self.flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def lead(self, key: str) -> Optional[Flight]:
+        """
+        Start a flight for the given key, unless one is already in progress.
+        Used by background requests (e.g. prefetching) that have no need to
+        wait for another request's response.
+        """
+        with self.lock:
+            if key in self.flights:
+                return None
+            flight = Flight(key, self.timeout, self.max_bytes)
+            self.flights[key] = flight
+            self.leaders += 1
+            return flight
+
+    def leave(self, flight: Flight) -> None:
+        """
+        Called by the leader once it has finished with the origin request.
+        Any request that arrives after this point will make a new
+        origin request.
+        """
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        flight.finish()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Request coalescing statistics
+        """
+        with self.lock:
+            return {
+                'in_flight': len(self.flights),
+                'leaders': self.leaders,
+                'followers': self.followers,
+            }
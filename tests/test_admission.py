@@ -0,0 +1,30 @@
+"""
+Tests of the admission control of origin requests
+"""
+from typing import List
+
+import pytest
+
+from shared_code.admission import AdmissionControl, Overloaded, Ticket, Waiter
+
+
+def test_full_queue_rejects_requests() -> None:
+    control = AdmissionControl(max_active=1, max_queue=1)
+    assert isinstance(control.begin('origin.example', lambda: None), Ticket)
+    assert isinstance(control.begin('origin.example', lambda: None), Waiter)
+    with pytest.raises(Overloaded):
+        control.begin('origin.example', lambda: None)
+    assert control.counters['rejected_queue_full'] == 1
+
+
+def test_max_queue_of_zero_does_not_limit_queue() -> None:
+    control = AdmissionControl(max_active=1, max_queue=0)
+    woken: List[int] = []
+    ticket = control.begin('origin.example', lambda: None)
+    assert isinstance(ticket, Ticket)
+    waiters = [control.begin('origin.example', lambda: woken.append(1)) for _ in range(5)]
+    assert all(isinstance(waiter, Waiter) for waiter in waiters)
+    assert control.counters['rejected_queue_full'] == 0
+    control.release(ticket)
+    assert woken == [1]
+    assert isinstance(control.wait_finished(waiters[0]), Ticket)
@@ -0,0 +1,71 @@
+"""
+Tests of the HTTP headers that the asyncio server's origin client sends
+to origin
+"""
+import asyncio
+from typing import Dict, List, Mapping
+
+from pyproxy.asyncproxy import AsyncOriginClient, origin_accept_encoding
+from shared_code.pipeline import PROXY_ROUTES, ClientRequest, MediaPipeline
+
+BODY = b'0123456789' * 10
+
+
+async def fetch_from_stub(path: str, headers: Mapping[str, str]) -> Dict[str, str]:
+    """
+    Make an origin request using the async client to a stub origin
+    server, returning the HTTP headers that reached the stub
+    """
+    received: List[Dict[str, str]] = []
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await reader.readline()
+        request_headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in {b'\r\n', b'\n', b''}:
+                break
+            name, _, value = str(line, 'latin-1').partition(':')
+            request_headers[name.strip().lower()] = value.strip()
+        received.append(request_headers)
+        writer.write(b'HTTP/1.1 206 Partial Content\r\nContent-Type: video/mp4\r\n'
+                     b'Content-Range: bytes 0-99/1000\r\n'
+                     b'Content-Length: %d\r\n\r\n' % len(BODY) + BODY)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    client = AsyncOriginClient(retries=0)
+    try:
+        async with server:
+            response = await client.get(f'http://127.0.0.1:{port}{path}', headers, None)
+            assert await response.read() == BODY
+            response.close()
+    finally:
+        client.close()
+    return received[0]
+
+
+def test_range_request_asks_origin_for_identity_encoding() -> None:
+    pipeline = MediaPipeline(PROXY_ROUTES)
+    request = ClientRequest('http://proxy.example/media/x/1.m4s',
+                            {'Range': 'bytes=0-99', 'Accept-Encoding': 'gzip, br'}, None)
+    rng = pipeline.begin_range(request, 'http://origin.example/dash/1.m4s')
+    assert not rng.needs_index
+    origin = pipeline.range_origin(request, rng)
+    headers = asyncio.run(fetch_from_stub('/dash/1.m4s', origin.headers))
+    assert headers['accept-encoding'] == 'identity'
+    assert headers['range'].startswith('bytes=0-')
+
+
+def test_manifest_request_defaults_to_compressed() -> None:
+    headers = asyncio.run(fetch_from_stub('/manifest.mpd', {}))
+    assert headers['accept-encoding'] == 'gzip, deflate'
+
+
+def test_accept_encoding_is_limited_to_decodable_encodings() -> None:
+    assert origin_accept_encoding('identity') == 'identity'
+    assert origin_accept_encoding('gzip, deflate, br') == 'gzip, deflate'
+    assert origin_accept_encoding('br') == 'identity'
+    assert origin_accept_encoding(None) == 'gzip, deflate'
@@ -0,0 +1,55 @@
+"""
+Tests of the responses that the asyncio server streams to its clients
+"""
+import asyncio
+from email.message import Message
+from types import SimpleNamespace
+from typing import AsyncIterator, List
+
+from pyproxy.asyncproxy import AsyncProxyServer, AsyncRequest
+
+
+class RecordingWriter:
+    """
+    Stand-in for an asyncio.StreamWriter that keeps everything written to it
+    """
+
+    def __init__(self) -> None:
+        self.parts: List[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        self.parts.append(bytes(data))
+
+    def writelines(self, data: List[bytes]) -> None:
+        self.parts += [bytes(part) for part in data]
+
+    async def drain(self) -> None:
+        pass
+
+
+async def stream_chunks(chunks: List[bytes]) -> bytes:
+    """
+    Send the given chunks using respond_stream() without a Content-Length
+    and return the bytes written to the client
+    """
+    async def source() -> AsyncIterator[bytes]:
+        for chunk in chunks:
+            yield chunk
+
+    options = SimpleNamespace(pool_size=1, retries=0, connect_timeout=1.0, read_timeout=1.0)
+    server = AsyncProxyServer(options)
+    writer = RecordingWriter()
+    request = AsyncRequest('GET', '/media/x/1.m4s', 'HTTP/1.1', Message(),
+                           asyncio.StreamReader(), writer)  # type: ignore[arg-type]
+    try:
+        await server.respond_stream(request, 200, source(), 'video/mp4')
+    finally:
+        server.client.close()
+    return b''.join(writer.parts)
+
+
+def test_empty_chunk_does_not_end_chunked_response() -> None:
+    output = asyncio.run(stream_chunks([b'abc', b'', b'defgh']))
+    _, body = output.split(b'\r\n\r\n', 1)
+    assert b'Transfer-Encoding: chunked' in output
+    assert body == b'3\r\nabc\r\n5\r\ndefgh\r\n0\r\n\r\n'
@@ -0,0 +1,21 @@
+"""
+Tests of the command line options of the pyproxy server
+"""
+from types import SimpleNamespace
+
+from pyproxy.proxy import ProxyDaemon, create_parser
+
+
+def test_hedging_is_disabled_by_default() -> None:
+    daemon = ProxyDaemon(create_parser().parse_args([]), {})
+    assert daemon.hedging is None
+    daemon = ProxyDaemon(create_parser().parse_args(['--hedge-percentile', '95']), {})
+    assert daemon.hedging is not None
+
+
+def test_options_of_older_callers_are_accepted() -> None:
+    daemon = ProxyDaemon(SimpleNamespace(bind='127.0.0.1', port=0, verbosity=0), {})
+    assert daemon.hedging is None
+    assert daemon.flights is not None
+    assert daemon.segment_cache is not None
+    assert daemon.server_type() == 'threaded'
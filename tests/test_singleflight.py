@@ -0,0 +1,44 @@
+"""
+Tests of request coalescing
+"""
+from typing import Iterator, List
+
+from shared_code.singleflight import SingleFlight
+
+
+def test_late_request_joins_after_first_chunk() -> None:
+    flights = SingleFlight(timeout=1.0)
+    flight, leader = flights.join('seg1')
+    assert leader
+    flight.start(200, 'video/mp4', {}, 9)
+    received: List[bytes] = []
+    followers: List[Iterator] = []
+
+    def origin() -> Iterator[bytes]:
+        yield b'abc'
+        # a second request arrives after the first chunk has been sent
+        late, late_leader = flights.join('seg1')
+        assert late is flight
+        assert not late_leader
+        followers.append(late.iter_chunks())
+        yield b'def'
+        yield b'ghi'
+
+    for chunk in flight.publish(origin()):
+        received.append(chunk)
+    flights.leave(flight)
+    assert b''.join(received) == b'abcdefghi'
+    assert b''.join(followers[0]) == b'abcdefghi'
+    assert flights.stats() == {'in_flight': 0, 'leaders': 1, 'followers': 1}
+
+
+def test_large_response_stops_accepting_requests() -> None:
+    flights = SingleFlight(timeout=1.0, max_bytes=4)
+    flight, _ = flights.join('seg2')
+    flight.start(200, 'video/mp4', {}, 9)
+    for _ in flight.publish([b'abc', b'def', b'ghi']):
+        pass
+    assert not flight.joinable
+    assert flight.chunks == []
+    _, leader = flights.join('seg2')
+    assert leader
@@ -0,0 +1,63 @@
+"""
+Tests of encode_url() and decode_url(), which wrap an origin URL so that
+it can be used as a path component of the URLs of the proxy
+"""
+from hypothesis import example, given, strategies as st
+
+from shared_code.request import ESCAPE_TABLE, decode_url, encode_url
+
+# the characters that are replaced by an escape sequence
+ESCAPED = ''.join([in_chr for in_chr, _ in ESCAPE_TABLE])
+
+# text that is mostly made from the escaped characters and the characters
+# used in the escape sequences, which is where decoding can go wrong
+ESCAPE_HEAVY = st.text(alphabet=st.sampled_from(ESCAPED + '012345ab'))
+
+URLS = st.builds(lambda scheme, host, path: f'{scheme}://{host}/{path}',
+                 st.sampled_from(['http', 'https']),
+                 st.from_regex(r'[a-z0-9]+(\.[a-z0-9]+)*(:[0-9]{1,5})?', fullmatch=True),
+                 st.text())
+
+
+@given(ESCAPE_HEAVY)
+@example('!!0')
+@example('!!!')
+@example('!:')
+@example('!0')
+@example('!/')
+@example('x!')
+def test_round_trip_of_escaped_characters(text: str) -> None:
+    assert decode_url(encode_url(text)) == text
+
+
+@given(URLS)
+def test_round_trip_of_urls(url: str) -> None:
+    assert decode_url(encode_url(url)) == url
+
+
+@given(st.text())
+def test_round_trip_of_any_text(text: str) -> None:
+    assert decode_url(encode_url(text)) == text
+
+
+@given(st.one_of(ESCAPE_HEAVY, URLS))
+def test_encoded_url_is_one_path_component(url: str) -> None:
+    encoded = encode_url(url)
+    assert not any(in_chr in encoded for in_chr in ESCAPED if in_chr != '!')
+
+
+@given(st.one_of(ESCAPE_HEAVY, URLS))
+def test_memo_matches_uncached_functions(url: str) -> None:
+    encoded = encode_url.__wrapped__(url)
+    assert encode_url(url) == encoded
+    assert decode_url(encoded) == decode_url.__wrapped__(encoded)
+
+
+def test_escaped_escape_character() -> None:
+    # "!!0" is an escaped "!" followed by "0", not "!" followed by ":"
+    assert decode_url('!!0') == '!0'
+    assert encode_url('!0') == '!!0'
+    assert decode_url('!!!0') == '!:'
+    assert encode_url('!!!') == '!!!!!!'
+    assert decode_url('!!!!!!') == '!!!'
+    assert decode_url('!!!1!!') == '!/!'